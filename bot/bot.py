@@ -8,6 +8,7 @@ remote commands via MeshCentral API, PDF inventory export.
 """
 
 import asyncio
+import copy
 import json
 import os
 import subprocess
@@ -24,6 +25,7 @@ import socket
 import ipaddress
 from datetime import datetime, timezone, timedelta
 from pathlib import Path
+from typing import Callable
 
 import aiohttp
 import psutil
@@ -48,11 +50,27 @@ from aiogram.types import (
     InlineKeyboardMarkup, InlineKeyboardButton,
     ReplyKeyboardMarkup, KeyboardButton,
 )
+from aiogram.exceptions import TelegramRetryAfter
 from aiogram.filters import Command
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
 
+from mc_bulk import CANCELLED, ERROR, OK, SKIPPED, TIMEOUT, BulkRun, BulkRunner, DeviceResult
+from mc_control import MCControlChannel, MCControlError, MCNotConnected
+from mc_db import MCRecordSet, NeDBTail, load_export
+from mc_devices import Device, DeviceCache, DeviceIndex
+from mc_events import ADDED, HARDWARE, ONLINE, REMOVED, DeviceEvent, DeviceEventBus
+from mc_health import HALF_OPEN, CircuitBreaker
+from mc_scheduler import Daily, Every, Scheduler
+from mc_presence import PresenceTracker
+from mc_probes import ProbeBundle, ProbeRunner, ProbeScript, extract_json, parse_bundle
+from mc_search import SearchIndex
+from mc_state import StateStore, WriteBehind
+from mc_uptime import UptimeStore
+from mc_forecast import DiskForecaster
+from mc_temps import COOL, HOT, TempHistory, alert_step, sparkline
+
 # ─── Config ───────────────────────────────────────────────────────────
 
 load_dotenv("/opt/meshcentral-bot/.env")
@@ -63,6 +81,11 @@ MC_DATA = os.getenv("MC_DATA", "/opt/meshcentral/meshcentral-data")
 MC_DIR = os.getenv("MC_DIR", "/opt/meshcentral")
 MC_WSS = os.getenv("MC_WSS", "wss://hub.office.mooo.com:443")
 MESHCTRL = f"{MC_DIR}/node_modules/meshcentral/meshctrl.js"
+MC_LOGIN = os.getenv("MC_LOGIN", "admin")
+MC_PASS = os.getenv("MC_PASS", "")
+MC_TOKEN_KEY = os.getenv("MC_TOKEN_KEY", "")   # pre-generated --logintokenkey (optional)
+LOGIN_KEY_TTL = 3600              # seconds
+LOGIN_KEY_REFRESH_AHEAD = 300     # refresh in background this long before expiry
 ADMIN_FILE = "/opt/meshcentral-bot/admin.json"
 DATA_DIR = Path("/opt/meshcentral-bot")
 HISTORY_FILE = DATA_DIR / "history.json"
@@ -86,7 +109,8 @@ PRINTERS_FILE          = DATA_DIR / "printers.json"
 PRINTER_INK_PS1        = DATA_DIR / "printer_ink.ps1"
 INK_ALERTS_FILE        = DATA_DIR / "ink_alerts.json"
 INK_WARN_PCT           = 20   # % threshold for low ink alert
-NETMAP_INTERVAL        = 60   # seconds
+NETMAP_INTERVAL        = 900  # seconds — regenerated on device events, this is the floor
+NETMAP_DEBOUNCE_SEC    = 5    # batch device events before regenerating
 WIFI_POLL_INTERVAL     = 300  # seconds (5 min)
 # ── New features ──
 HW_INVENTORY_FILE  = DATA_DIR / "hw_inventory.json"
@@ -94,17 +118,45 @@ HW_INVENTORY_PS1   = DATA_DIR / "hw_inventory.ps1"
 TEMP_DATA_FILE     = DATA_DIR / "temp_data.json"
 TEMP_PROBE_PS1     = DATA_DIR / "temp_probe.ps1"
 STATUS_HTML_FILE   = DATA_DIR / "public" / "status.html"
-HW_POLL_INTERVAL   = 4 * 3600   # 4 hours
+HW_POLL_INTERVAL   = 4 * 3600   # 4 hours — inventory older than this is re-collected
 TEMP_POLL_INTERVAL = 900         # 15 minutes
+DEVICE_PROBE_PS1   = DATA_DIR / "device_probe.ps1"
+# sections of the bundled probe and how often each is due per online device (0 = on demand
+# only); sections due at the same time share one agent round trip, see probe_job
+PROBE_INTERVALS = {"temp": TEMP_POLL_INTERVAL, "hw": HW_POLL_INTERVAL, "usb": HW_POLL_INTERVAL, "printers": 0}
+PROBE_FLUSH_EVERY = 25    # probe results are written to disk every N devices
+PROBE_FLUSH_SEC = 30      # ... or this often, whichever comes first
 TEMP_WARN_C        = 75          # °C alert threshold
+TEMP_HYSTERESIS_C  = 5           # alert clears only this far below the threshold
+TEMP_ALERT_COOLDOWN = 6 * 3600   # no repeat alert for the same device within this
+TEMP_HISTORY_FILE  = DATA_DIR / "temp_history.jsonl"
+STATE_DB_FILE      = DATA_DIR / "state.db"   # the *_FILE JSON files above are migrated into it once
+UPTIME_RUNS_FILE   = DATA_DIR / "uptime.bin"
+UPTIME_KEEP_SEC    = 7 * 86400
+TEMP_HISTORY_DAYS  = int(os.getenv("TEMP_HISTORY_DAYS", "7"))
+STATE_FLUSH_SEC    = int(os.getenv("STATE_FLUSH_SEC", "30"))   # write-behind of the polled data
 
 HEALTH_CHECK_INTERVAL = 60
 DEVICE_CHECK_INTERVAL = 45
+# online set comes from MC nodeconnect events; a full ListDevices only corrects drift
+PRESENCE_RECONCILE_SEC = int(os.getenv("PRESENCE_RECONCILE_SEC", "600"))
+PRESENCE_DEBOUNCE_SEC = 0.5     # connect/disconnect pairs within this window are not reported
+# background jobs that run commands on agents (wifi, snmp, hw, temp, scheduled commands)
+# share this many concurrent slots, so their bursts don't pile up on MeshCentral
+SCHED_MC_BUDGET = int(os.getenv("SCHED_MC_BUDGET", "2"))
+# group commands: concurrency adapts to MC latency/errors up to this many devices at once;
+# a whole run is cut off after BULK_DEADLINE_SEC (devices not reached are reported as skipped)
+BULK_MAX_CONCURRENCY = int(os.getenv("BULK_MAX_CONCURRENCY", "32"))
+BULK_DEADLINE_SEC = int(os.getenv("BULK_DEADLINE_SEC", "600"))
+BULK_EDIT_INTERVAL = 3    # s between progress edits of one message (Telegram flood limits)
 INVENTORY_HOUR = 8
 DAILY_REPORT_HOUR = 9
 WEEKLY_DIGEST_HOUR = 10   # Sunday 10:00 UTC
 UPDATE_CHECK_HOUR = 11
 DB_CACHE_TTL = 60  # seconds — снижено для более актуального статуса
+# auto: tail MC's NeDB file (meshcentral.db) when MC runs on NeDB, else --dbexport
+DB_INGEST_MODE = os.getenv("DB_INGEST_MODE", "auto")   # auto | tail | export
+MC_DB_FILE = os.getenv("MC_DB_FILE", f"{MC_DATA}/meshcentral.db")
 SSL_DOMAINS = [d.strip() for d in os.getenv("SSL_DOMAINS", "hub.office.mooo.com,panelwin.mooo.com,subwin.mooo.com").split(",") if d.strip()]
 # HTTP services to monitor: "Name|url" pairs comma-separated in HTTP_SERVICES env var
 _HTTP_SERVICES_RAW = os.getenv(
@@ -134,25 +186,57 @@ dp.include_router(router)
 
 # ─── State ────────────────────────────────────────────────────────────
 
-_known_devices: dict[str, dict] = {}
-_last_inventory_date = ""
-_last_daily_report = ""
-_last_weekly_digest = ""
-_last_update_check = ""
-_last_ssl_check = ""
 _ssl_cache: list = []  # [{domain, days_left, expires, ok, error}]
 _mc_was_down = False
 _http_down: dict[str, bool] = {}   # service name → was_down flag
-_db_cache: list = []
+_db_cache: MCRecordSet | None = None
 _db_cache_time: float = 0
+_db_tail: NeDBTail | None = None     # incremental reader of meshcentral.db
+_db_lock = asyncio.Lock()
 _online_cache: set = set()       # node IDs currently online (from meshctrl)
 _online_cache_time: float = 0
+_online_cache_gen = 0            # bumped when the online set changes
+_online_inflight: asyncio.Future | None = None
+_devices_memo: tuple = (None, 0.0, ())   # (key, built_at, DeviceIndex) — see _device_snapshot
+_devices_inflight: asyncio.Future | None = None
+_device_cache = DeviceCache()    # parsed devices per node, keyed by record fingerprint
+_search_index: tuple = (None, None)      # (DeviceIndex it was built from, SearchIndex)
+_search_queries: dict[str, str] = {}     # short id → /search query (for page:search callbacks)
+_devices_stats = {"hits": 0, "builds": 0, "waits": 0, "build_ms": 0.0}
 _shutdown_event = asyncio.Event()
-_background_tasks: list[asyncio.Task] = []
+_mc_channel: MCControlChannel | None = None   # persistent control.ashx connection
+_presence: PresenceTracker | None = None      # online node IDs pushed by MC events
+_device_bus = DeviceEventBus()                # events between consecutive device refreshes
+_device_alerts: list[DeviceEvent] = []        # bus events waiting for device_alerts_job
+_scheduler = Scheduler(budget=SCHED_MC_BUDGET)   # all background jobs, see on_startup
+_bulk = BulkRunner(max_concurrency=BULK_MAX_CONCURRENCY)   # "run X on N devices" fan-out
+# probe scripts are installed on the agents once (by content hash), polls send a short call
+_probes = ProbeRunner(lambda nid, cmd, timeout: _mc_run_raw(nid, cmd, powershell=True, timeout=timeout))
+_probe_keenetic = ProbeScript(KEENETIC_PROBE_SCRIPT)
+_probe_snmp = ProbeScript(SNMP_PROBE_SCRIPT)
+_probe_bundle = ProbeBundle({"hw": HW_INVENTORY_PS1, "temp": TEMP_PROBE_PS1,
+                             "printers": PRINTER_INK_PS1, "usb": DEVICE_PROBE_PS1})
+_probe_last: dict = {}    # {node_id: {section: unix time of the last successful probe}}
+_printers_pending: dict = {}  # printers section results not yet written to the state store
+_health = CircuitBreaker()   # per device+probe: polls skip agents that keep failing
 _wifi_clients: dict = {}  # {agent_name: {ok, router, updated, count, clients: [...]}}
 _snmp_data:    dict = {}  # {agent_name: {ok, router, updated, data: {...}, prev: {...}}}
 _hw_inventory: dict = {}  # {device_name: {hostname, cpu_name, ram_total_gb, disks, ...}}
-_temp_data:    dict = {}  # {device_name: {temps, cpu_load_pct, updated}}
+_hw_pending:   dict = {}  # {node_id: Device} queued for probe_job's hw section by device events
+_temp_data:    dict = {}  # {device_name: {temps, cpu_load_pct, updated, alert}}
+_temp_history = TempHistory(TEMP_HISTORY_FILE, retention=TEMP_HISTORY_DAYS * 86400)
+_state = StateStore(STATE_DB_FILE)   # SQLite: device records, histories, mutes, notes, ...
+_uptime = UptimeStore(UPTIME_RUNS_FILE, keep=UPTIME_KEEP_SEC,
+                      gap=3 * DEVICE_CHECK_INTERVAL, step=DEVICE_CHECK_INTERVAL)
+_disk_forecast = DiskForecaster(window=14)   # /disk_trend and the digest, recomputed per disk snapshot
+_alerts_sent: dict = {}   # {"disk_<device>_<date>": True, ...} once-a-day condition alerts
+# the polls change these dicts in memory and _writes.mark() them; state_flush_job writes them
+_writes = WriteBehind(_state, interval=STATE_FLUSH_SEC)
+_writes.bind("hw_inventory", lambda: _hw_inventory)
+_writes.bind("temp_data", lambda: _temp_data)
+_writes.bind("wifi_clients", lambda: _wifi_clients)
+_writes.bind("snmp_data", lambda: _snmp_data)
+_writes.bind("alerts_sent", lambda: _alerts_sent)
 
 # ─── Keyboard ─────────────────────────────────────────────────────────
 
@@ -190,22 +274,46 @@ def _save_json(path: Path, data):
     with open(tmp, "w") as f:
         json.dump(data, f, indent=2, ensure_ascii=False, default=str)
     tmp.replace(path)
+    _json_cache.pop(Path(path), None)
+
+
+_json_cache: dict[Path, tuple] = {}   # path → ((mtime_ns, size) or None, parsed data)
+_json_cache_stats = {"hits": 0, "loads": 0}
+
+def _load_json_cached(path: Path, default=None):
+    """_load_json() kept in memory while the file's mtime and size stay the
+    same (edits by hand are picked up on the next call, _save_json drops the
+    entry). The result is shared: copy it before changing it."""
+    path = Path(path)
+    try:
+        st = path.stat()
+        sig = (st.st_mtime_ns, st.st_size)
+    except OSError:
+        sig = None
+    hit = _json_cache.get(path)
+    if hit is not None and hit[0] == sig:
+        _json_cache_stats["hits"] += 1
+        return hit[1]
+    _json_cache_stats["loads"] += 1
+    data = _load_json(path, default)
+    _json_cache[path] = (sig, data)
+    return data
 
 
 # ─── Admin ────────────────────────────────────────────────────────────
 
 def load_admin() -> dict:
-    return _load_json(Path(ADMIN_FILE))
+    return copy.deepcopy(_load_json_cached(Path(ADMIN_FILE)))
 
 def save_admin(d: dict):
     _save_json(Path(ADMIN_FILE), d)
 
 def get_admin_id() -> int | None:
-    return load_admin().get("admin_id")
+    return _load_json_cached(Path(ADMIN_FILE)).get("admin_id")
 
 def is_admin(uid: int) -> bool:
-    d = load_admin()
-    return True if not d.get("admin_id") else d["admin_id"] == uid
+    admin_id = get_admin_id()
+    return True if not admin_id else admin_id == uid
 
 def lock_admin(uid: int, uname: str) -> bool:
     d = load_admin()
@@ -226,7 +334,7 @@ DEFAULT_ALERTS = {
 }
 
 def load_alerts_cfg() -> dict:
-    cfg = _load_json(ALERTS_FILE, DEFAULT_ALERTS.copy())
+    cfg = copy.deepcopy(_load_json_cached(ALERTS_FILE, DEFAULT_ALERTS))
     for k, v in DEFAULT_ALERTS.items():
         cfg.setdefault(k, v)
     return cfg
@@ -382,13 +490,29 @@ def save_scripts(scripts: dict):
 
 # ─── Maintenance Mode (Mutes) ───────────────────────────────────────
 
+# is_muted() runs for every device on every check: it looks names up in
+# (soonest expiry, {device / group / "__all__": until, 0 = forever}), rebuilt
+# after save_mutes()
+_mute_index: tuple[float, dict[str, float]] | None = None
+
 def load_mutes() -> dict:
-    return _load_json(MUTE_FILE, {})
+    return _state.doc("mutes").all()
 
 def save_mutes(mutes: dict):
-    _save_json(MUTE_FILE, mutes)
+    global _mute_index
+    _state.doc("mutes").replace(mutes)
+    _mute_index = None
+
+def _mutes_compiled() -> tuple[float, dict[str, float]]:
+    global _mute_index
+    if _mute_index is None:
+        until = {k: m.get("until", 0) for k, m in load_mutes().items()}
+        _mute_index = (min((u for u in until.values() if u), default=float("inf")), until)
+    return _mute_index
 
 def cleanup_expired_mutes():
+    if _mutes_compiled()[0] > time.time():
+        return
     mutes = load_mutes()
     now = time.time()
     changed = False
@@ -401,22 +525,14 @@ def cleanup_expired_mutes():
 
 def is_muted(device_name: str, group: str) -> bool:
     cleanup_expired_mutes()
-    mutes = load_mutes()
+    until = _mutes_compiled()[1]
+    if not until:
+        return False
     now = time.time()
-    # Check exact device mute
-    if device_name in mutes:
-        m = mutes[device_name]
-        if m.get("until", 0) == 0 or m["until"] > now:
-            return True
-    # Check group mute
-    if group in mutes:
-        m = mutes[group]
-        if m.get("until", 0) == 0 or m["until"] > now:
-            return True
-    # Check __all__ mute
-    if "__all__" in mutes:
-        m = mutes["__all__"]
-        if m.get("until", 0) == 0 or m["until"] > now:
+    # exact device, then group, then __all__
+    for key in (device_name, group, "__all__"):
+        u = until.get(key)
+        if u is not None and (u == 0 or u > now):
             return True
     return False
 
@@ -496,11 +612,12 @@ ALERT_HELP = {
 
 # ─── DB Export & Parse (cached, async subprocess) ────────────────────
 
-async def _export_db_async() -> list:
+async def _export_db_async() -> MCRecordSet:
     global _db_cache, _db_cache_time
     now = time.time()
     if _db_cache and (now - _db_cache_time) < DB_CACHE_TTL:
         return _db_cache
+    empty = _db_cache or MCRecordSet()
 
     try:
         proc = await asyncio.create_subprocess_exec(
@@ -512,47 +629,65 @@ async def _export_db_async() -> list:
         await asyncio.wait_for(proc.wait(), timeout=30)
     except asyncio.TimeoutError:
         log.error("DB export timed out")
-        return _db_cache or []
+        return empty
     except Exception as e:
         log.error(f"DB export error: {e}")
-        return _db_cache or []
+        return empty
 
     db_file = f"{MC_DATA}/meshcentral.db.json"
     if not os.path.exists(db_file):
-        return _db_cache or []
+        return empty
     try:
-        with open(db_file) as f:
-            data = json.load(f)
+        # streamed record by record: no full json.load of a multi-MB export
+        rs = await asyncio.to_thread(load_export, db_file)
         os.remove(db_file)
-        _db_cache = data
+        rs.generation = (_db_cache.generation if _db_cache else 0) + 1
+        _db_cache = rs
         _db_cache_time = now
     except Exception as e:
         log.error(f"DB parse error: {e}")
-    return _db_cache
+    return _db_cache or empty
+
+
+def _mc_uses_plain_nedb() -> bool:
+    """True if MC stores its DB in an unencrypted NeDB file we can tail."""
+    if not os.path.isfile(MC_DB_FILE):
+        return False
+    try:
+        with open(f"{MC_DATA}/config.json", encoding="utf-8") as f:
+            settings = {k.lower(): v for k, v in (json.load(f).get("settings") or {}).items()}
+    except Exception:
+        settings = {}
+    other_db = ("mongodb", "mariadb", "mysql", "postgres", "acebase", "sqlite3", "dbencryptkey")
+    return not any(k in settings for k in other_db)
+
+
+async def _load_db_records() -> MCRecordSet:
+    """Current MeshCentral records. Tails meshcentral.db (reads only what was
+    appended since the last call) when possible, falls back to --dbexport.
+    """
+    global _db_tail
+    async with _db_lock:
+        if _db_tail is None and (DB_INGEST_MODE == "tail" or
+                                 (DB_INGEST_MODE == "auto" and _mc_uses_plain_nedb())):
+            _db_tail = NeDBTail(MC_DB_FILE)
+            log.info(f"DB ingest: tailing {MC_DB_FILE}")
+        if _db_tail is not None:
+            try:
+                full, changes = await asyncio.to_thread(_db_tail.read)
+                _db_tail.apply(full, changes)
+                return _db_tail.records
+            except Exception as e:
+                log.error(f"DB tail error, using --dbexport: {e}")
+        return await _export_db_async()
 
 
 async def _list_agents_quick() -> list[dict]:
-    """Fast agent list via meshctrl ListDevices (used for WiFi office FSM picker).
+    """Fast agent list via ListDevices (used for WiFi office FSM picker).
     Returns [{name, group, online, id}]. Much faster than get_full_devices().
     """
-    key = await _get_login_key()
-    if not key:
-        return []
     try:
-        proc = await asyncio.create_subprocess_exec(
-            "node", MESHCTRL, "ListDevices",
-            "--url", MC_WSS,
-            "--loginkey", key,
-            "--json",
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-        )
-        stdout, _ = await asyncio.wait_for(proc.communicate(), timeout=20)
-        raw = stdout.decode(errors="replace")
-        idx = raw.find("[")
-        if idx == -1:
-            return []
-        data = json.loads(raw[idx:])
+        data = await _mc_list_devices()
         return [
             {
                 "id":     d.get("_id", ""),
@@ -568,288 +703,115 @@ async def _list_agents_quick() -> list[dict]:
 
 
 async def _get_realtime_online_ids() -> set:
-    """Get set of node IDs currently connected via meshctrl ListDevices.
+    """Get set of node IDs currently connected.
+    While the control channel delivers nodeconnect events (_presence.live) the
+    pushed set is returned as is; otherwise, and every PRESENCE_RECONCILE_SEC
+    to correct drift, it comes from ListDevices (cached for 45 seconds,
+    concurrent callers share one call).
     Falls back to empty set on error (caller will use lastconnect fallback).
-    Cached for 45 seconds.
     """
-    global _online_cache, _online_cache_time
+    global _online_inflight
+    if _presence is not None and _presence.live:
+        return _presence.online
     now = time.time()
     if _online_cache and (now - _online_cache_time) < 45:
         return _online_cache
+    if _online_inflight is not None:
+        return await asyncio.shield(_online_inflight)
 
-    try:
-        login_key = await _get_login_key()
-        if not login_key:
+    async def _fetch() -> set:
+        global _online_cache, _online_cache_time, _online_cache_gen, _online_inflight
+        try:
+            token = _presence.begin() if _presence is not None else None
+            data = await _mc_list_devices()
+            online_ids: set = set()
+            for dev in data:
+                # conn flag 1 = agent connected
+                if dev.get("conn", 0) & 1:
+                    nid = dev.get("_id", "")
+                    if nid:
+                        online_ids.add(nid)
+            if _presence is not None:
+                _presence.reconcile(online_ids, token)
+                online_ids = set(_presence.online)
+            if online_ids != _online_cache:
+                _online_cache_gen += 1
+            _online_cache = online_ids
+            _online_cache_time = now
             return _online_cache
-        proc = await asyncio.create_subprocess_exec(
-            "node", MESHCTRL, "ListDevices",
-            "--url", MC_WSS,
-            "--loginkey", login_key,
-            "--json",
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-        )
-        stdout, _ = await asyncio.wait_for(proc.communicate(), timeout=20)
-        raw = stdout.decode(errors="replace").strip()
-        # meshctrl may print log lines before JSON — find the JSON array
-        json_start = raw.find("[")
-        if json_start == -1:
+        except Exception as e:
+            log.warning(f"realtime online ids error: {e}")
             return _online_cache
-        data = json.loads(raw[json_start:])
-        online_ids: set = set()
-        for dev in data:
-            # conn flag 1 = agent connected
-            if dev.get("conn", 0) & 1:
-                nid = dev.get("_id", "")
-                if nid:
-                    online_ids.add(nid)
-        _online_cache = online_ids
-        _online_cache_time = now
-        return _online_cache
-    except Exception as e:
-        log.warning(f"realtime online ids error: {e}")
-        return _online_cache
+        finally:
+            _online_inflight = None
+
+    _online_inflight = asyncio.ensure_future(_fetch())
+    return await asyncio.shield(_online_inflight)
 
 
-def _extract_node_id(full_id: str) -> str:
-    for prefix in ("sinode//", "ifnode//", "lcnode//"):
-        if full_id.startswith(prefix):
-            return "node//" + full_id[len(prefix):]
-    return full_id
+async def _device_snapshot() -> DeviceIndex:
+    """Current devices and their lookup index (one per refresh).
 
+    Concurrent callers share one in-flight refresh, and the result is
+    memoized per (DB generation, online set). On a rebuild only nodes whose
+    records changed are re-parsed (DeviceCache); the rest just get the
+    online/offline_hours overlay. Every new refresh is published on
+    _device_bus, so background loops get what changed as events.
+    """
+    global _devices_inflight
+    if _devices_inflight is not None:
+        _devices_stats["waits"] += 1
+        return await asyncio.shield(_devices_inflight)
 
-def _fmt_size(b) -> str:
-    b = int(b) if b else 0
-    if b >= 1024**4:
-        return f"{b / 1024**4:.1f} TB"
-    if b >= 1024**3:
-        return f"{b / 1024**3:.0f} GB"
-    if b >= 1024**2:
-        return f"{b / 1024**2:.0f} MB"
-    return f"{b} B"
+    async def _refresh() -> DeviceIndex:
+        global _devices_inflight, _devices_memo
+        try:
+            rs, realtime_online = await asyncio.gather(
+                _load_db_records(),
+                _get_realtime_online_ids(),
+            )
+            key = (id(rs), rs.generation, _online_cache_gen, bool(realtime_online))
+            memo_key, built_at, index = _devices_memo
+            # offline_hours (and the lastconnect fallback) age with the clock
+            if memo_key == key and time.time() - built_at < DB_CACHE_TTL:
+                _devices_stats["hits"] += 1
+                return index
+            t0 = time.perf_counter()
+            index = DeviceIndex(_device_cache.devices(rs, realtime_online))
+            _devices_stats["builds"] += 1
+            _devices_stats["build_ms"] = (time.perf_counter() - t0) * 1000
+            _devices_memo = (key, time.time(), index)
+            _device_bus.publish(index)
+            return index
+        finally:
+            _devices_inflight = None
+
+    _devices_inflight = asyncio.ensure_future(_refresh())
+    return await asyncio.shield(_devices_inflight)
+
+
+async def get_full_devices() -> list[Device]:
+    """Rich device objects with full hardware info (see _device_snapshot).
+    Devices are read-only Device objects (dict-style access works) shared
+    between callers; the returned list itself is the caller's own.
+    """
+    return list((await _device_snapshot()).devices)
 
 
-async def get_full_devices() -> list[dict]:
-    """Parse DB into rich device objects with full hardware info."""
-    raw, realtime_online = await asyncio.gather(
-        _export_db_async(),
-        _get_realtime_online_ids(),
-    )
-    if not raw:
-        return []
+async def get_device_index() -> DeviceIndex:
+    """O(1) lookups (ID, name, group, IP, MAC, serial) over the current devices."""
+    return await _device_snapshot()
 
-    meshes = {r["_id"]: r.get("name", "?") for r in raw if r.get("type") == "mesh"}
-    nodes = {r["_id"]: r for r in raw if r.get("type") == "node"}
-
-    sysinfos = {}
-    ifinfos = {}
-    lastconns = {}
-    for r in raw:
-        rid = r.get("_id", "")
-        rtype = r.get("type", "")
-        if rtype == "sysinfo":
-            sysinfos[_extract_node_id(rid)] = r
-        elif rtype == "ifinfo":
-            ifinfos[_extract_node_id(rid)] = r
-        elif rtype == "lastconnect":
-            lastconns[_extract_node_id(rid)] = r
-
-    devices = []
-    for nid, n in nodes.items():
-        si = sysinfos.get(nid, {})
-        ii = ifinfos.get(nid, {})
-        lc = lastconns.get(nid, {})
-
-        hw = si.get("hardware", {})
-        win = hw.get("windows", {})
-        ident = hw.get("identifiers", {})
-        tpm = hw.get("tpm", {})
-        net_info = hw.get("network", {})
-
-        # CPU
-        cpus = win.get("cpu", [])
-        cpu_str = ", ".join(c.get("Name", "?").strip() for c in cpus) if cpus else ident.get("cpu_name", "-")
-
-        # RAM
-        ram_modules = win.get("memory", [])
-        ram_total = sum(int(m.get("Capacity", 0)) for m in ram_modules)
-        ram_details = []
-        for m in ram_modules:
-            cap = _fmt_size(m.get("Capacity", 0))
-            pn = m.get("PartNumber", "").strip()
-            spd = m.get("Speed", "")
-            slot = m.get("DeviceLocator", "")
-            ram_details.append(f"{slot}: {cap} {pn} {spd}MHz")
-
-        # GPU
-        gpus = win.get("gpu", [])
-        gpu_str = ", ".join(g.get("Name", "?") for g in gpus) if gpus else ", ".join(ident.get("gpu_name", []))
-
-        # Drives
-        drives = win.get("drives", []) or ident.get("storage_devices", [])
-        drive_details = []
-        for d in drives:
-            model = d.get("Model", d.get("Caption", "?"))
-            size = _fmt_size(d.get("Size", 0))
-            drive_details.append(f"{model} ({size})")
-
-        # Volumes
-        volumes = win.get("volumes", {})
-        vol_details = []
-        vol_alerts = []
-        for letter, v in volumes.items():
-            vname = v.get("name", "")
-            vtype = v.get("type", "")
-            vsize = v.get("size", 0)
-            vfree = v.get("sizeremaining", 0)
-            vsize_s = _fmt_size(vsize)
-            vfree_s = _fmt_size(vfree)
-            label = f" [{vname}]" if vname else ""
-            vol_details.append(f"{letter}:{label} {vtype} {vfree_s}/{vsize_s} free")
-            if vsize and vfree:
-                used_pct = (1 - int(vfree) / int(vsize)) * 100
-                if used_pct >= 90:
-                    vol_alerts.append(f"{letter}: {used_pct:.0f}%")
-
-        # Motherboard & BIOS
-        board = f"{ident.get('board_vendor', '')} {ident.get('board_name', '')}".strip() or "-"
-        board_sn = ident.get("board_serial", "-")
-        bios_date = ident.get("bios_date", "")
-        bios = f"{ident.get('bios_vendor', '')} v{ident.get('bios_version', '')} ({bios_date[:8]})".strip()
-        bios_mode = ident.get("bios_mode", "-")
-
-        # OS details
-        osinfo = win.get("osinfo", {})
-        os_full = osinfo.get("Caption", n.get("osdesc", ""))
-        os_arch = osinfo.get("OSArchitecture", "")
-        os_build = osinfo.get("BuildNumber", "")
-        os_sn = osinfo.get("SerialNumber", "-")
-        os_install = osinfo.get("InstallDate", "")[:8] if osinfo.get("InstallDate") else "-"
-        os_domain = osinfo.get("Domain", "WORKGROUP")
-
-        # Antivirus
-        av_list = n.get("av", [])
-        av_str = ", ".join(
-            f"{a.get('product', '?')} ({'on' if a.get('enabled') else 'off'})"
-            for a in av_list
-        ) if av_list else "-"
-        av_disabled = any(not a.get("enabled", True) for a in av_list) if av_list else False
-        wsc = n.get("wsc", {})
-
-        # TPM
-        tpm_str = f"v{tpm.get('SpecVersion', '?')} {tpm.get('ManufacturerId', '')}" if tpm else "-"
-
-        # Network interfaces
-        netifs = ii.get("netif2", {})
-        nic_details = []
-        for iname, addrs in netifs.items():
-            if "Loopback" in iname:
-                continue
-            ipv4s = [a["address"] for a in addrs if a.get("family") == "IPv4" and not a["address"].startswith("169.254")]
-            mac = addrs[0].get("mac", "") if addrs else ""
-            status = addrs[0].get("status", "") if addrs else ""
-            speed = addrs[0].get("speed", 0) if addrs else 0
-            speed_str = f"{speed // 1_000_000}Mbps" if speed and speed < 9e18 else ""
-            if ipv4s:
-                nic_details.append({"name": iname, "ips": ipv4s, "mac": mac, "status": status, "speed": speed_str})
-
-        # Online status: prefer real-time from meshctrl (conn flag), fallback to lastconnect
-        lc_time = lc.get("time")
-        lc_addr = lc.get("addr", "-")
-        if realtime_online:
-            # meshctrl gave us live data — use it as source of truth
-            online = nid in realtime_online
-            offline_hours = 0 if online else (
-                (time.time() * 1000 - lc_time) / 3_600_000 if lc_time else 0
-            )
-        else:
-            # fallback: use lastconnect timestamp (less accurate for stable connections)
-            online = False
-            offline_hours = 0
-            if lc_time:
-                diff_ms = time.time() * 1000 - lc_time
-                online = diff_ms < 300_000
-                offline_hours = diff_ms / 3_600_000 if not online else 0
-
-        # Users
-        users = n.get("users", [])
-        last_boot = n.get("lastbootuptime")
-        boot_str = datetime.fromtimestamp(last_boot / 1000, tz=timezone.utc).strftime("%d.%m.%Y %H:%M") if last_boot else "-"
-
-        # Resolution
-        res_str = "-"
-        if gpus:
-            g = gpus[0]
-            h = g.get("CurrentHorizontalResolution")
-            v = g.get("CurrentVerticalResolution")
-            if h and v:
-                res_str = f"{h}x{v}"
-
-        # Software
-        software = win.get("software", {})
-        sw_list = []
-        if isinstance(software, dict):
-            for sw_name, sw_info in software.items():
-                ver = sw_info.get("version", "") if isinstance(sw_info, dict) else ""
-                sw_list.append({"name": sw_name, "version": ver})
-        elif isinstance(software, list):
-            for sw in software:
-                sw_list.append({"name": sw.get("name", "?"), "version": sw.get("version", "")})
-
-        nic_str_list = []
-        for nic in nic_details[:5]:
-            nic_str_list.append(f"{nic['name']}: {', '.join(nic['ips'])} ({nic['mac']}) {nic['speed']} [{nic['status']}]")
-
-        devices.append({
-            "id": nid,
-            "name": n.get("name", "?"),
-            "group": meshes.get(n.get("meshid", ""), "?"),
-            "online": online,
-            "ip": n.get("ip", ""),
-            "lc_addr": lc_addr,
-            "offline_hours": offline_hours,
-            # OS
-            "os": os_full,
-            "os_arch": os_arch,
-            "os_build": os_build,
-            "os_sn": os_sn,
-            "os_install": os_install,
-            "os_domain": os_domain,
-            # Hardware
-            "cpu": cpu_str,
-            "ram_total": _fmt_size(ram_total),
-            "ram_details": ram_details,
-            "gpu": gpu_str or "-",
-            "resolution": res_str,
-            "drives": drive_details,
-            "volumes": vol_details,
-            "vol_alerts": vol_alerts,
-            "volumes_raw": {lt: {"total": int(v.get("size", 0)), "free": int(v.get("sizeremaining", 0))} for lt, v in volumes.items() if v.get("size", 0) > 0},
-            "board": board,
-            "board_sn": board_sn,
-            "bios": bios,
-            "bios_mode": bios_mode,
-            "tpm": tpm_str,
-            # Security
-            "antivirus": av_str,
-            "av_disabled": av_disabled,
-            "firewall": wsc.get("firewall", "-"),
-            "auto_update": wsc.get("autoUpdate", "-"),
-            # Network
-            "nics": nic_str_list,
-            "nic_details": nic_details,
-            "dns": net_info.get("dns", []),
-            # Users
-            "users": users,
-            "last_boot": boot_str,
-            # Agent
-            "agent_ver": str(n.get("agent", {}).get("ver", "")),
-            "agent_core": n.get("agent", {}).get("core", ""),
-            # Software
-            "software": sw_list,
-        })
 
-    return devices
+async def get_search_index() -> SearchIndex:
+    """Search index for the current device refresh (built on first use)."""
+    global _search_index
+    index = await _device_snapshot()
+    built_for, search = _search_index
+    if built_for is not index:
+        search = await asyncio.to_thread(SearchIndex, index.devices)
+        _search_index = (index, search)
+    return search
 
 
 # ─── Device card ─────────────────────────────────────────────────────
@@ -1322,7 +1284,7 @@ def build_network_map(devices: list[dict]) -> bytes | None:
     for d in devices:
         ext_ip = d.get("ip", "") or "Unknown"
         group = d.get("group", "?")
-        d["_local_ip"] = _get_local_ip(d)
+        d = {**d, "_local_ip": _get_local_ip(d)}   # devices are shared, annotate a copy
         locations.setdefault(ext_ip, {}).setdefault(group, []).append(d)
 
     # ── Office colors ──
@@ -1554,7 +1516,7 @@ def build_network_map_html(devices: list[dict], web_mode: bool = False) -> str |
     locations: dict[str, list[dict]] = {}
     for d in devices:
         group = d.get("group", "?") or "?"
-        d["_local_ip"] = _get_local_ip(d)
+        d = {**d, "_local_ip": _get_local_ip(d)}   # devices are shared, annotate a copy
         locations.setdefault(group, []).append(d)
 
     n_online = sum(1 for d in devices if d.get("online"))
@@ -1715,7 +1677,7 @@ def build_network_map_html(devices: list[dict], web_mode: bool = False) -> str |
             ram    = str(d.get("ram_total", "-") or "-")
             grp    = d.get("group", "?")
             drives_list = d.get("drives", [])
-            drives_s = "; ".join(drives_list) if isinstance(drives_list, list) else str(drives_list)
+            drives_s = "; ".join(map(str, drives_list)) if isinstance(drives_list, (list, tuple)) else str(drives_list)
 
             if is_on:
                 os_border, _ = _os_node_color(os_s)
@@ -2656,37 +2618,19 @@ def ssl_status_text(results: list[dict]) -> str:
 # ─── Uptime tracking ────────────────────────────────────────────────
 
 def record_uptime(devices: list[dict]):
-    data = _load_json(UPTIME_FILE, {})
-    now = datetime.now(timezone.utc).isoformat()
-    for d in devices:
-        name = d["name"]
-        if name not in data:
-            data[name] = []
-        data[name].append({"t": now, "on": d["online"]})
-        # keep last 7 days = ~13440 entries at 45s interval
-        if len(data[name]) > 14000:
-            data[name] = data[name][-13000:]
-    _save_json(UPTIME_FILE, data)
+    _uptime.record([(d["name"], d["online"]) for d in devices])
 
 
 def build_uptime_graph(device_name: str) -> bytes | None:
-    data = _load_json(UPTIME_FILE, {})
-    records = data.get(device_name, [])
-    if len(records) < 2:
+    runs = _uptime.runs(device_name, since=time.time() - 86400)
+    if not runs:
         return None
 
-    times = []
-    values = []
-    for r in records[-2000:]:
-        try:
-            t = datetime.fromisoformat(r["t"])
-            times.append(t)
-            values.append(1 if r["on"] else 0)
-        except Exception:
-            continue
-
-    if not times:
-        return None
+    times, values = [], []
+    for start, end, on in runs:
+        times += [datetime.fromtimestamp(start, timezone.utc),
+                  datetime.fromtimestamp(end + _uptime.step, timezone.utc)]
+        values += [1 if on else 0] * 2
 
     fig, ax = plt.subplots(figsize=(10, 3))
     ax.fill_between(times, values, alpha=0.4, color="#2ecc71", step="post")
@@ -2707,7 +2651,7 @@ def build_uptime_graph(device_name: str) -> bytes | None:
 # ─── Snapshots / change tracking ────────────────────────────────────
 
 def save_snapshot(devices: list[dict]):
-    snaps = _load_json(SNAPSHOTS_FILE, {})
+    snaps = {}
     for d in devices:
         snap = {
             "os": d["os"],
@@ -2721,11 +2665,11 @@ def save_snapshot(devices: list[dict]):
             "agent_ver": d["agent_ver"],
         }
         snaps[d["name"]] = snap
-    _save_json(SNAPSHOTS_FILE, snaps)
+    _state.doc("snapshots").put_many(snaps)
 
 
 def detect_changes(devices: list[dict]) -> list[str]:
-    snaps = _load_json(SNAPSHOTS_FILE, {})
+    snaps = _state.doc("snapshots")
     changes = []
     for d in devices:
         name = d["name"]
@@ -2770,7 +2714,7 @@ async def _send_weekly_digest(admin_id: int, devs: list[dict]):
         long_offline.sort(key=lambda d: d.get("offline_hours", 0), reverse=True)
 
         # New devices (in known_devices but not in previous snapshot)
-        snaps = _load_json(SNAPSHOTS_FILE, {})
+        snaps = set(_state.doc("snapshots").keys())
         new_devices = [d for d in devs if d["name"] not in snaps]
 
         # Disk warnings
@@ -2846,31 +2790,14 @@ async def _send_weekly_digest(admin_id: int, devs: list[dict]):
 def save_disk_snapshot(devices: list[dict]) -> None:
     """Append today's disk snapshot for each online device (one entry per day)."""
     today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
-    hist = _load_json(DISK_HISTORY_FILE, {})
-    for d in devices:
-        if not d.get("online"):
-            continue
-        vols = d.get("volumes_raw", {})
-        if not vols:
-            continue
-        name = d["name"]
-        entries = hist.setdefault(name, [])
-        # Replace today's entry or append
-        existing = next((e for e in entries if e["date"] == today), None)
-        snap = {"date": today, "volumes": vols}
-        if existing:
-            existing["volumes"] = vols
-        else:
-            entries.append(snap)
-        # Keep last 60 days
-        hist[name] = sorted(entries, key=lambda e: e["date"])[-60:]
-    _save_json(DISK_HISTORY_FILE, hist)
+    # today's row per device is replaced; the last 60 days are kept
+    _state.disk_put(today, {d["name"]: d["volumes_raw"] for d in devices
+                            if d.get("online") and d.get("volumes_raw")}, keep_days=60)
 
 
 def save_snap_history(devices: list[dict]) -> None:
-    """Save daily snapshot of device info to SNAP_HISTORY_FILE. Keeps last 30 days."""
+    """Save daily snapshot of device info (state store). Keeps last 30 days."""
     today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
-    hist = _load_json(SNAP_HISTORY_FILE, {})
     day_snap = {}
     for d in devices:
         day_snap[d["name"]] = {
@@ -2879,28 +2806,25 @@ def save_snap_history(devices: list[dict]) -> None:
             "ip": d.get("ip", ""), "agent_ver": d.get("agent_ver", ""),
             "online": d.get("online", False),
         }
-    hist[today] = day_snap
-    # Keep last 30 days
-    keys = sorted(hist.keys())[-30:]
-    _save_json(SNAP_HISTORY_FILE, {k: hist[k] for k in keys})
+    _state.snap_put(today, day_snap, keep_days=30)
 
 
 def compare_snap_history(devices: list[dict], days: int = 7) -> str:
     """Compare current device state with snapshot from N days ago."""
-    hist = _load_json(SNAP_HISTORY_FILE, {})
-    if not hist:
+    snap_days = _state.snap_days()
+    if not snap_days:
         return "⚠️ История снапшотов пуста. Данные накапливаются постепенно."
     now = datetime.now(timezone.utc)
     target_date = (now - timedelta(days=days)).strftime("%Y-%m-%d")
     # Find closest snapshot on or before target_date
     past_key = None
-    for k in sorted(hist.keys()):
+    for k in snap_days:
         if k <= target_date:
             past_key = k
     if not past_key:
-        oldest = min(hist.keys())
+        oldest = snap_days[0]
         return f"⚠️ Нет снапшота за {days} дней назад. Самый ранний: {oldest}."
-    past = hist[past_key]
+    past = _state.snap_day(past_key)
     curr_map = {d["name"]: d for d in devices}
     lines = [f"📊 <b>Сравнение с {past_key}</b>", ""]
     fields = [("ОС", "os"), ("CPU", "cpu"), ("RAM", "ram_total"), ("IP", "ip"), ("Агент", "agent_ver")]
@@ -2937,77 +2861,9 @@ def get_disk_trends() -> list[dict]:
     Returns list of dicts with fill-rate info per device per volume.
     Only includes volumes where trend is calculable (≥2 data points).
     Result sorted by days_to_full ascending (most critical first).
+    See mc_forecast for the fits; cached until the next disk snapshot.
     """
-    hist = _load_json(DISK_HISTORY_FILE, {})
-    trends = []
-    for device_name, entries in hist.items():
-        if len(entries) < 2:
-            continue
-        # Group by volume letter
-        vol_series: dict[str, list[tuple[float, float]]] = {}  # letter -> [(day_num, used_gb)]
-        dates = [e["date"] for e in entries]
-        # Use day offset from first entry
-        from datetime import datetime as dt
-        d0 = dt.strptime(dates[0], "%Y-%m-%d")
-        for entry in entries:
-            day_num = (dt.strptime(entry["date"], "%Y-%m-%d") - d0).days
-            for letter, v in entry.get("volumes", {}).items():
-                total = v.get("total", 0)
-                free  = v.get("free", 0)
-                if total <= 0:
-                    continue
-                used_gb = (total - free) / 1_073_741_824
-                vol_series.setdefault(letter, []).append((day_num, used_gb))
-
-        for letter, pts in vol_series.items():
-            if len(pts) < 2:
-                continue
-            # Linear regression: used = a*day + b
-            n = len(pts)
-            sx  = sum(p[0] for p in pts)
-            sy  = sum(p[1] for p in pts)
-            sxx = sum(p[0] ** 2 for p in pts)
-            sxy = sum(p[0] * p[1] for p in pts)
-            denom = n * sxx - sx * sx
-            if denom == 0:
-                continue
-            a = (n * sxy - sx * sy) / denom  # GB per day fill rate
-            b = (sy - a * sx) / n
-
-            # Current values from latest entry
-            latest = sorted(pts, key=lambda p: p[0])[-1]
-            day_latest = latest[0]
-            used_latest = latest[1]
-
-            # Get total_gb from last entry
-            last_entry = entries[-1]
-            total_bytes = last_entry.get("volumes", {}).get(letter, {}).get("total", 0)
-            if total_bytes <= 0:
-                continue
-            total_gb = total_bytes / 1_073_741_824
-            free_gb  = total_gb - used_latest
-            used_pct = (used_latest / total_gb * 100) if total_gb > 0 else 0
-
-            if a > 0.001:  # growing
-                days_to_full = (total_gb - used_latest) / a if a > 0 else None
-            else:
-                days_to_full = None  # stable or shrinking
-
-            trends.append({
-                "device": device_name,
-                "letter": letter,
-                "used_gb": round(used_latest, 1),
-                "total_gb": round(total_gb, 1),
-                "free_gb": round(free_gb, 1),
-                "used_pct": round(used_pct, 1),
-                "fill_rate_gb_day": round(a, 3),
-                "days_to_full": round(days_to_full, 0) if days_to_full is not None else None,
-                "points": n,
-            })
-
-    # Sort: disks filling fastest first
-    trends.sort(key=lambda t: (t["days_to_full"] is None, t["days_to_full"] or 99999))
-    return trends
+    return _disk_forecast.get(_state.disk_version, _state.disk_history)
 
 
 # ─── Wake-on-LAN ────────────────────────────────────────────────────
@@ -3033,8 +2889,8 @@ def send_wol(mac_address: str) -> bool:
 
 async def _get_mesh_groups() -> dict[str, str]:
     """Return {group_name: mesh_id} mapping (raw MC IDs)."""
-    raw = await _export_db_async()
-    return {r.get("name", "?"): r["_id"].replace("mesh//", "") for r in raw if r.get("type") == "mesh"}
+    rs = await _load_db_records()
+    return {m.get("name", "?"): mid.replace("mesh//", "") for mid, m in rs.meshes.items()}
 
 
 async def _download_configured_agent(mesh_id: str, agent_type: int = 4) -> bytes | None:
@@ -3183,73 +3039,177 @@ pause
 
 # ─── Remote commands via MeshCentral API ─────────────────────────────
 
-async def _get_login_key() -> str:
-    """Generate a fresh meshctrl login key."""
+_login_key: str = ""
+_login_key_time: float = 0
+_login_key_inflight: asyncio.Future | None = None
+_login_key_stats = {"hits": 0, "misses": 0, "waits": 0, "refreshes": 0, "errors": 0}
+
+
+async def _generate_login_key() -> str:
+    """Run `meshcentral.js --logintokenkey` (one Node process)."""
     proc = await asyncio.create_subprocess_exec(
         "node", f"{MC_DIR}/node_modules/meshcentral/meshcentral.js", "--logintokenkey",
         stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, cwd=MC_DIR,
     )
-    stdout, _ = await proc.communicate()
+    try:
+        stdout, _ = await asyncio.wait_for(proc.communicate(), timeout=30)
+    except asyncio.TimeoutError:
+        proc.kill()
+        raise
     return stdout.decode().strip()
 
 
-async def mc_run_command(device_id: str, command: str, powershell: bool = False,
-                         run_as_user: bool = False, timeout: int = 30) -> str:
-    """Execute a command on a remote device via meshctrl RunCommand."""
+async def _refresh_login_key() -> str:
+    """Single-flight key generation: concurrent callers share one Node process."""
+    global _login_key_inflight
+    if _login_key_inflight is not None:
+        _login_key_stats["waits"] += 1
+        return await asyncio.shield(_login_key_inflight)
+
+    async def _gen() -> str:
+        global _login_key, _login_key_time, _login_key_inflight
+        try:
+            if re.fullmatch(r"[0-9a-fA-F]{160}", MC_TOKEN_KEY):
+                key = MC_TOKEN_KEY
+            else:
+                key = await _generate_login_key()
+            if key:
+                _login_key, _login_key_time = key, time.time()
+                _login_key_stats["refreshes"] += 1
+            else:
+                _login_key_stats["errors"] += 1
+            return key or _login_key
+        except Exception as e:
+            _login_key_stats["errors"] += 1
+            log.error(f"login key: {e}")
+            return _login_key
+        finally:
+            _login_key_inflight = None
+
+    _login_key_inflight = asyncio.ensure_future(_gen())
+    return await asyncio.shield(_login_key_inflight)
+
+
+async def _get_login_key() -> str:
+    """meshctrl login key from the shared broker.
+    Cached for LOGIN_KEY_TTL; refreshed in the background LOGIN_KEY_REFRESH_AHEAD
+    seconds before expiry so callers never wait on a warm cache.
+    """
+    age = time.time() - _login_key_time
+    if _login_key and age < LOGIN_KEY_TTL:
+        _login_key_stats["hits"] += 1
+        if age > LOGIN_KEY_TTL - LOGIN_KEY_REFRESH_AHEAD and _login_key_inflight is None:
+            asyncio.ensure_future(_refresh_login_key())
+        return _login_key
+    _login_key_stats["misses"] += 1
+    return await _refresh_login_key()
+
+
+def _invalidate_login_key():
+    global _login_key_time
+    _login_key_time = 0
+
+
+async def _meshctrl(action: str, *args: str, timeout: float = 30) -> str:
+    """Spawn `node meshctrl.js <action>` — fallback when the control channel is down.
+    Returns stdout (stderr if stdout is empty); raises asyncio.TimeoutError.
+    """
     login_key = await _get_login_key()
     if not login_key:
-        return "Error: failed to generate login key"
-
-    args = [
-        "node", MESHCTRL, "RunCommand",
+        raise RuntimeError("failed to generate login key")
+    proc = await asyncio.create_subprocess_exec(
+        "node", MESHCTRL, action,
         "--url", MC_WSS,
         "--loginkey", login_key,
-        "--id", device_id,
-        "--run", command,
-        "--reply",
-    ]
+        *args,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        cwd=MC_DIR,
+    )
+    try:
+        stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout=timeout)
+    except asyncio.TimeoutError:
+        proc.kill()
+        raise
+    output = stdout.decode(errors="replace").strip()
+    if not output and stderr:
+        output = stderr.decode(errors="replace").strip()
+    return output
+
+
+def _mc_channel_up() -> MCControlChannel | None:
+    if _mc_channel is not None and _mc_channel.connected:
+        return _mc_channel
+    return None
+
+
+async def _mc_list_devices(timeout: float = 20) -> list[dict]:
+    """ListDevices as raw node dicts (with groupname), like `meshctrl ListDevices --json`."""
+    ch = _mc_channel_up()
+    if ch:
+        try:
+            return await ch.list_devices(timeout=timeout)
+        except (MCControlError, asyncio.TimeoutError) as e:
+            log.warning(f"mc_control ListDevices failed, using meshctrl: {e}")
+    raw = await _meshctrl("ListDevices", "--json", timeout=timeout)
+    # meshctrl may print log lines before JSON — find the JSON array
+    idx = raw.find("[")
+    if idx == -1:
+        return []
+    return json.loads(raw[idx:])
+
+
+async def _mc_run_raw(device_id: str, command: str, powershell: bool = False,
+                      run_as_user: bool = False, timeout: float = 30) -> str:
+    """RunCommand --reply, untruncated. Raises asyncio.TimeoutError / Exception.
+    Goes over the control channel; meshctrl is used only if the command was never sent.
+    """
+    ch = _mc_channel_up()
+    if ch:
+        try:
+            return await ch.run_command(device_id, command, powershell=powershell,
+                                        run_as_user=run_as_user, timeout=timeout)
+        except MCNotConnected:
+            pass
+    args = ["--id", device_id, "--run", command, "--reply"]
     if powershell:
         args.append("--powershell")
     if run_as_user:
         args.append("--runasuser")
+    return await _meshctrl("RunCommand", *args, timeout=timeout)
 
+
+async def mc_run_command(device_id: str, command: str, powershell: bool = False,
+                         run_as_user: bool = False, timeout: int = 30) -> str:
+    """Execute a command on a remote device via MeshCentral RunCommand."""
     try:
-        proc = await asyncio.create_subprocess_exec(
-            *args,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-            cwd=MC_DIR,
-        )
-        stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout=timeout)
-        output = stdout.decode(errors="replace").strip()
-        if not output and stderr:
-            output = stderr.decode(errors="replace").strip()
+        output = (await _mc_run_raw(device_id, command, powershell=powershell,
+                                    run_as_user=run_as_user, timeout=timeout)).strip()
         return output[:4000] if output else "(пустой ответ)"
     except asyncio.TimeoutError:
-        return "Error: command timed out (30s)"
+        return f"Error: command timed out ({timeout}s)"
     except Exception as e:
         return f"Error: {e}"
 
 
+def _bulk_command(command: str, powershell: bool = False, run_as_user: bool = False):
+    """Per-device runner for _bulk: RunCommand with the timeout the engine hands out."""
+    async def run(d, timeout: float) -> str:
+        return (await _mc_run_raw(d["id"], command, powershell=powershell,
+                                  run_as_user=run_as_user, timeout=timeout)).strip()
+    return run
+
+
 async def mc_device_power(device_id: str, action: str) -> str:
     """Send power action (wake/sleep/reset/off) to a device."""
-    login_key = await _get_login_key()
-    if not login_key:
-        return "Error: failed to generate login key"
-
-    args = [
-        "node", MESHCTRL, "DevicePower",
-        "--url", MC_WSS,
-        "--loginkey", login_key,
-        "--id", device_id,
-        f"--{action}",
-    ]
     try:
-        proc = await asyncio.create_subprocess_exec(
-            *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, cwd=MC_DIR,
-        )
-        stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout=15)
-        return stdout.decode(errors="replace").strip() or "OK"
+        ch = _mc_channel_up()
+        if ch:
+            try:
+                return await ch.device_power(device_id, action, timeout=15)
+            except MCNotConnected:
+                pass
+        return await _meshctrl("DevicePower", "--id", device_id, f"--{action}", timeout=15) or "OK"
     except asyncio.TimeoutError:
         return "Error: timed out"
     except Exception as e:
@@ -3259,21 +3219,15 @@ async def mc_device_power(device_id: str, action: str) -> str:
 # ─── Keenetic WiFi probe ───────────────────────────────────────────────
 
 def _load_wifi_clients() -> dict:
-    """Load wifi_clients.json into _wifi_clients."""
+    """Load the stored Wi-Fi client lists into _wifi_clients."""
     global _wifi_clients
-    try:
-        if WIFI_FILE.exists():
-            _wifi_clients = json.loads(WIFI_FILE.read_text())
-    except Exception:
-        _wifi_clients = {}
+    _wifi_clients = _state.doc("wifi_clients").all()
     return _wifi_clients
 
 
-def _save_wifi_clients() -> None:
-    try:
-        WIFI_FILE.write_text(json.dumps(_wifi_clients, ensure_ascii=False, indent=2))
-    except Exception as e:
-        log.error(f"wifi save: {e}")
+def _save_wifi_clients(*agents: str) -> None:
+    """Queue the given agents' entries (all if none) for the next state flush."""
+    _writes.mark("wifi_clients", *agents)
 
 
 def _load_keenetic_probes() -> list[dict]:
@@ -3287,86 +3241,47 @@ def _load_keenetic_probes() -> list[dict]:
 
 async def run_keenetic_probe(device_id: str, probe: dict) -> dict | None:
     """Run keenetic_probe.ps1 on the remote device; return parsed JSON or None."""
+    params = {"RouterLogin": probe.get("router_login", "admin"),
+              "RouterPassword": probe.get("router_password", "")}
     try:
-        script = KEENETIC_PROBE_SCRIPT.read_text(encoding="utf-8")
-    except Exception as e:
-        log.error(f"keenetic probe: cannot read script: {e}")
-        return None
-
-    script = script.replace("ROUTER_LOGIN", probe.get("router_login", "admin"))
-    script = script.replace("ROUTER_PASSWORD", probe.get("router_password", ""))
-
-    login_key = await _get_login_key()
-    if not login_key:
-        return None
-
-    args = [
-        "node", MESHCTRL, "RunCommand",
-        "--url", MC_WSS,
-        "--loginkey", login_key,
-        "--id", device_id,
-        "--run", script,
-        "--reply",
-        "--powershell",
-    ]
-    try:
-        proc = await asyncio.create_subprocess_exec(
-            *args,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-            cwd=MC_DIR,
-        )
-        stdout, _ = await asyncio.wait_for(proc.communicate(), timeout=60)
-        raw = stdout.decode(errors="replace").strip()
-        # meshctrl may emit log lines before JSON and after (PS warnings).
-        # Find first '{', then use raw_decode to ignore trailing garbage.
-        brace = raw.find("{")
-        if brace == -1:
-            return None
-        obj, _ = json.JSONDecoder().raw_decode(raw, brace)
-        return obj
+        obj = await _probes.run_json(device_id, _probe_keenetic, params, timeout=60)
+        if isinstance(obj, dict):
+            _health.success(device_id, "wifi")
+            return obj
+        _health.failure(device_id, "wifi", "нет JSON в выводе")
     except asyncio.TimeoutError:
         log.warning(f"keenetic probe timeout for device {device_id}")
+        _health.failure(device_id, "wifi", "нет ответа за 60 с")
     except Exception as e:
         log.error(f"keenetic probe error: {e}")
+        _health.failure(device_id, "wifi", str(e))
     return None
 
 
-async def wifi_poll_loop():
-    """Background loop: poll all keenetic probes every WIFI_POLL_INTERVAL seconds."""
-    global _wifi_clients
-    _load_wifi_clients()
-    await asyncio.sleep(10)  # short delay on startup
-    while not _shutdown_event.is_set():
-        try:
-            probes = _load_keenetic_probes()
-            if probes:
-                devs = await get_full_devices()
-                name_to_id = {d["name"]: d["id"] for d in devs}
-                for probe in probes:
-                    aname = probe.get("agent_name", "")
-                    dev_id = name_to_id.get(aname)
-                    if not dev_id:
-                        log.info(f"wifi_poll: agent '{aname}' not found in devices")
-                        continue
-                    # only poll if device is online
-                    dev = next((d for d in devs if d["id"] == dev_id), None)
-                    if not dev or not dev.get("online"):
-                        log.info(f"wifi_poll: agent '{aname}' is offline, skipping")
-                        continue
-                    log.info(f"wifi_poll: polling keenetic via {aname} ({dev_id})")
-                    result = await run_keenetic_probe(dev_id, probe)
-                    if result:
-                        _wifi_clients[aname] = result
-                        _save_wifi_clients()
-                        log.info(f"wifi_poll: {aname} → {result.get('count', '?')} clients, ok={result.get('ok')}")
-        except Exception as e:
-            log.error(f"wifi_poll_loop: {e}")
-        try:
-            await asyncio.wait_for(_shutdown_event.wait(), timeout=WIFI_POLL_INTERVAL)
-            break
-        except asyncio.TimeoutError:
-            pass
+async def wifi_poll_job():
+    """Poll all keenetic probes (online agents only)."""
+    probes = _load_keenetic_probes()
+    if probes:
+        index = await get_device_index()
+        for probe in probes:
+            aname = probe.get("agent_name", "")
+            dev = index.by_name(aname)
+            if not dev:
+                log.info(f"wifi_poll: agent '{aname}' not found in devices")
+                continue
+            dev_id = dev["id"]
+            # only poll if device is online
+            if not dev.get("online"):
+                log.info(f"wifi_poll: agent '{aname}' is offline, skipping")
+                continue
+            if not _health.allow(dev_id, "wifi"):
+                continue
+            log.info(f"wifi_poll: polling keenetic via {aname} ({dev_id})")
+            result = await run_keenetic_probe(dev_id, probe)
+            if result:
+                _wifi_clients[aname] = result
+                _save_wifi_clients(aname)
+                log.info(f"wifi_poll: {aname} → {result.get('count', '?')} clients, ok={result.get('ok')}")
 
 
 # ─── Status page builder ─────────────────────────────────────────────
@@ -3447,7 +3362,7 @@ body{{font-family:-apple-system,BlinkMacSystemFont,'Segoe UI',sans-serif;
 <body>
 <div class="hdr">
   <h1>🗺 Статус сети</h1>
-  <div class="ts">Обновлено: {now_str} &nbsp;·&nbsp; Обновляется каждые 60 сек</div>
+  <div class="ts">Обновлено: {now_str} &nbsp;·&nbsp; Обновляется при изменениях</div>
 </div>
 <div class="overall {overall}">{overall_label}</div>
 <div class="cards">
@@ -3463,22 +3378,16 @@ body{{font-family:-apple-system,BlinkMacSystemFont,'Segoe UI',sans-serif;
 
 def build_availability_heatmap(device_name: str) -> str:
     """Build a 7-day per-hour text heatmap from uptime data."""
-    data = _load_json(UPTIME_FILE, {})
-    records = data.get(device_name, [])
-    if not records:
+    now = datetime.now(timezone.utc)
+    first_day = (now - timedelta(days=6)).replace(hour=0, minute=0, second=0, microsecond=0)
+    # (seconds online, seconds with data) by (date, hour)
+    buckets = {}
+    for slot, acc in _uptime.online_seconds(device_name, first_day.timestamp(), 3600).items():
+        t = datetime.fromtimestamp(slot, timezone.utc)
+        buckets[(t.date(), t.hour)] = acc
+    if not buckets:
         return f"Нет данных о доступности для «{device_name}»"
 
-    # bucket records by (date, hour)
-    from collections import defaultdict
-    buckets: dict[tuple, list[int]] = defaultdict(list)
-    for r in records:
-        try:
-            t = datetime.fromisoformat(r["t"])
-            buckets[(t.date(), t.hour)].append(1 if r["on"] else 0)
-        except Exception:
-            continue
-
-    now = datetime.now(timezone.utc)
     lines = ["<pre>"]
     lines.append(f"  Доступность: <b>{device_name}</b> (7 дней × 24ч)\n")
     lines.append("  Чч: " + " ".join(f"{h:02d}" for h in range(0, 24, 2)) + "\n")
@@ -3490,13 +3399,13 @@ def build_availability_heatmap(device_name: str) -> str:
         day_str = day.strftime("%d.%m")
         cells = []
         for hour in range(24):
-            vals = buckets.get((day, hour), [])
-            if not vals:
+            on, covered = buckets.get((day, hour), (0, 0))
+            if not covered:
                 cells.append("·")
             else:
-                pct = sum(vals) / len(vals)
-                total_on += sum(vals)
-                total_buckets += len(vals)
+                pct = on / covered
+                total_on += on
+                total_buckets += covered
                 cells.append("█" if pct >= 0.8 else ("▒" if pct >= 0.4 else "░"))
         lines.append(f"  {day_str}: " + " ".join(cells[h] for h in range(0, 24, 2)) + "\n")
 
@@ -3532,145 +3441,288 @@ def _hw_inventory_text(inv: dict, device_name: str) -> str:
                          f"{d.get('size_gb','?')}GB — "
                          f"свободно {d.get('free_gb','?')}GB [{bar}] {d.get('used_pct','?')}%")
     if inv.get('gpu'): lines.append(f"\n🎮 GPU: {inv['gpu']}")
+    usb = inv.get('usb')
+    if usb:
+        lines.append(f"\n🔌 USB: накопителей {len(usb.get('drives', []))}, "
+                     f"принтеров {len(usb.get('printers', []))}, устройств {len(usb.get('devices', []))}")
     if inv.get('updated'): lines.append(f"\n🕐 Обновлено: {inv['updated']}")
     return "\n".join(lines)
 
 
-async def _collect_hw_for_device(device_id: str, device_name: str):
-    """Run hw_inventory.ps1 on one device via meshctrl."""
-    global _hw_inventory
-    if not HW_INVENTORY_PS1.exists():
-        return
-    try:
-        script = HW_INVENTORY_PS1.read_text(encoding="utf-8")
-        raw = await mc_run_command(device_id, script, powershell=True, timeout=60)
-        if not raw:
-            return
-        # extract JSON from output (clean BOM/control chars from PowerShell output)
-        for line in reversed(raw.strip().splitlines()):
-            line = line.strip().lstrip("\ufeff").replace("\r", "").replace("\x00", "")
-            if line.startswith("{"):
-                inv = json.loads(line)
-                inv["updated"] = datetime.now(timezone.utc).strftime("%d.%m.%Y %H:%M")
-                _hw_inventory[device_name] = inv
-                _save_json(HW_INVENTORY_FILE, _hw_inventory)
-                log.info(f"hw_inventory: collected {device_name}")
-                break
-    except Exception as e:
-        log.warning(f"hw_inventory: {device_name}: {e}")
+def _last_json_line(raw: str) -> dict | None:
+    """The JSON object in a probe section's output (None if there is none)."""
+    obj = extract_json(raw)
+    return obj if isinstance(obj, dict) else None
 
 
-async def _collect_temp_for_device(device_id: str, device_name: str) -> dict | None:
-    """Run temp_probe.ps1 on one device."""
-    if not TEMP_PROBE_PS1.exists():
-        return None
-    try:
-        script = TEMP_PROBE_PS1.read_text(encoding="utf-8")
-        raw = await mc_run_command(device_id, script, powershell=True, timeout=30)
-        if not raw:
-            return None
-        for line in reversed(raw.strip().splitlines()):
-            line = line.strip().lstrip("\ufeff").replace("\r", "").replace("\x00", "")
-            if line.startswith("{"):
-                return json.loads(line)
-    except Exception as e:
-        log.warning(f"temp_probe: {device_name}: {e}")
-    return None
+def _store_hw_inventory(device_name: str, raw: str) -> bool:
+    """Parse hw_inventory.ps1 output into _hw_inventory (written behind).
+    An "unchanged" reply (fingerprint matched) only refreshes free space and
+    boot time of the stored record."""
+    inv = _last_json_line(raw)
+    if inv is None:
+        return False
+    now = datetime.now(timezone.utc).strftime("%d.%m.%Y %H:%M")
+    old = _hw_inventory.get(device_name) or {}
+    if inv.get("unchanged"):
+        if old.get("fingerprint") != inv.get("fingerprint"):
+            return False    # stale reply; the next run sends the right fingerprint
+        free = {d.get("letter"): d for d in inv.get("disks") or []}
+        for disk in old.get("disks") or []:
+            cur = free.get(disk.get("letter"))
+            if cur:
+                disk["free_gb"], disk["used_pct"] = cur.get("free_gb"), cur.get("used_pct")
+        old["last_boot"] = inv.get("last_boot", old.get("last_boot", ""))
+        old["updated"] = now
+        _writes.mark("hw_inventory", device_name)
+        return True
+    inv["updated"] = now
+    if old.get("usb"):
+        inv["usb"] = old["usb"]    # collected by its own probe section
+    _hw_inventory[device_name] = inv
+    _writes.mark("hw_inventory", device_name)
+    log.info(f"hw_inventory: collected {device_name}")
+    return True
+
+
+def _store_usb(device_name: str, raw: str) -> bool:
+    """Parse device_probe.ps1 output into _hw_inventory[device]["usb"]."""
+    data = _last_json_line(raw)
+    if data is None:
+        return False
+    _hw_inventory.setdefault(device_name, {})["usb"] = {
+        "printers": data.get("printers") or [],
+        "drives": data.get("usb_drives") or [],
+        "devices": data.get("usb_devices") or [],
+        "updated": datetime.now(timezone.utc).strftime("%d.%m.%Y %H:%M"),
+    }
+    _writes.mark("hw_inventory", device_name)
+    return True
+
 
+async def _store_temp(d, result: dict, alert: bool = True):
+    """Store one device's temp_probe.ps1 result (written behind) and history
+    point (saved by the caller). Alerts when the hottest sensor crosses TEMP_WARN_C and when it
+    is back below TEMP_WARN_C − TEMP_HYSTERESIS_C, see mc_temps.alert_step."""
+    name = d["name"]
+    now = time.time()
+    result["updated"] = datetime.now(timezone.utc).strftime("%d.%m.%Y %H:%M")
+    temps = [t for t in result.get("temps", []) if isinstance(t.get("temp_c"), (int, float))]
+    readings = {str(t.get("zone", "?")): t["temp_c"] for t in temps}
+    if isinstance(result.get("cpu_load_pct"), (int, float)):
+        readings["load"] = result["cpu_load_pct"]
+    if readings:
+        _temp_history.add(name, readings, now)
+    state = (_temp_data.get(name) or {}).get("alert")
+    event = None
+    if temps:
+        hottest = max(temps, key=lambda t: t["temp_c"])
+        state, event = alert_step(state, hottest["temp_c"], now, TEMP_WARN_C,
+                                  TEMP_HYSTERESIS_C, TEMP_ALERT_COOLDOWN)
+    if state:
+        result["alert"] = state
+    _temp_data[name] = result
+    _writes.mark("temp_data", name)
+    aid = get_admin_id()
+    if not (alert and aid and event):
+        return
+    if event == COOL:
+        text = (f"✅ <b>Температура в норме</b>\n💻 {name}\n"
+                f"🌡 {hottest['zone']}: <b>{hottest['temp_c']}°C</b>")
+    else:
+        spark = sparkline(v for _, v in _temp_history.get(name, hottest["zone"], now - 6 * 3600))
+        text = (f"🌡 <b>{'Высокая температура!' if event == HOT else 'Всё ещё горячо'}</b>\n"
+                f"💻 {name}\n"
+                f"🌡 {hottest['zone']}: <b>{hottest['temp_c']}°C</b>\n"
+                f"⚠️ Порог: {TEMP_WARN_C}°C" + (f"\n📈 6ч: <code>{spark}</code>" if spark else ""))
+    await bot.send_message(aid, text, parse_mode="HTML")
 
-# ─── HW Inventory loop ───────────────────────────────────────────────
 
-async def hw_inventory_loop():
-    """Collect hardware inventory from online agents every HW_POLL_INTERVAL seconds."""
-    global _hw_inventory
-    _hw_inventory = _load_json(HW_INVENTORY_FILE, {})
-    await asyncio.sleep(120)  # delay on startup
-    while not _shutdown_event.is_set():
-        try:
-            devs = await get_full_devices()
-            online = [d for d in devs if d.get("online")]
-            log.info(f"hw_inventory_loop: polling {len(online)} online devices")
-            for d in online:
-                if _shutdown_event.is_set():
-                    break
-                await _collect_hw_for_device(d["id"], d["name"])
-                await asyncio.sleep(5)  # throttle
-        except Exception as e:
-            log.error(f"hw_inventory_loop: {e}")
-        try:
-            await asyncio.wait_for(_shutdown_event.wait(), timeout=HW_POLL_INTERVAL)
-            break
-        except asyncio.TimeoutError:
-            pass
+# ─── Probe bundle job ───────────────────────────────────────────────
 
+def _updated_ts(rec: dict | None) -> float:
+    """Unix time of a record's "updated" field (%d.%m.%Y %H:%M UTC), 0 if none."""
+    try:
+        t = datetime.strptime((rec or {}).get("updated", ""), "%d.%m.%Y %H:%M")
+    except ValueError:
+        return 0.0
+    return t.replace(tzinfo=timezone.utc).timestamp()
+
+
+def _hw_inventory_stale(device_name: str) -> bool:
+    """No inventory for the device, or it is older than HW_POLL_INTERVAL."""
+    return time.time() - _updated_ts(_hw_inventory.get(device_name)) >= HW_POLL_INTERVAL
+
+
+def _hw_inventory_events(batch: list[DeviceEvent]):
+    """Bus events → devices whose hardware the next probe_job run should collect."""
+    for ev in batch:
+        d = ev.device
+        if ev.kind == ONLINE and d["online"]:
+            _health.reset(d["id"])    # agent reconnected: give its open circuits a fresh try
+        if d["online"] and (ev.kind != ONLINE or _hw_inventory_stale(d["name"])):
+            _hw_pending[d["id"]] = d
+
+
+def _probe_due(d, now: float) -> list[str]:
+    """Bundle sections due for device d (see PROBE_INTERVALS)."""
+    last = _probe_last.get(d["id"])
+    if last is None:
+        # after a restart: go by what was collected before
+        inv = _hw_inventory.get(d["name"])
+        last = _probe_last[d["id"]] = {
+            "hw": _updated_ts(inv),
+            "usb": _updated_ts((inv or {}).get("usb")),
+            "temp": _updated_ts(_temp_data.get(d["name"])),
+        }
+    # a minute of slack: "updated" has minute precision and the job tick is jittered
+    due = [s for s, every in PROBE_INTERVALS.items() if every and now - last.get(s, 0) >= every - 60]
+    if d["id"] in _hw_pending:
+        due += [s for s in ("hw", "usb") if s not in due]
+    available = _probe_bundle.available
+    return [s for s in due if s in available]
+
+
+async def _apply_probe_section(d, section: str, out: str) -> bool:
+    """Store one section of a bundle reply in memory (_flush_probe_data writes
+    it out). False if it had no usable result."""
+    name = d["name"]
+    if section == "hw":
+        return _store_hw_inventory(name, out)
+    if section == "usb":
+        return _store_usb(name, out)
+    if section == "temp":
+        result = _last_json_line(out)
+        if result is None:
+            return False
+        await _store_temp(d, result)
+        return True
+    if section == "printers":
+        _printers_pending[name] = {
+            "group": d["group"],
+            "scanned_at": datetime.now(timezone.utc).isoformat(),
+            "printers": _parse_printer_scan(out.strip()),
+        }
+        return True
+    return False
 
-# ─── Temperature loop ────────────────────────────────────────────────
 
-async def temp_loop():
-    """Collect CPU temperature from online agents every TEMP_POLL_INTERVAL."""
-    global _temp_data
-    _temp_data = _load_json(TEMP_DATA_FILE, {})
-    await asyncio.sleep(90)
-    while not _shutdown_event.is_set():
-        try:
-            aid = get_admin_id()
-            devs = await get_full_devices()
-            online = [d for d in devs if d.get("online")]
-            for d in online:
-                if _shutdown_event.is_set():
-                    break
-                result = await _collect_temp_for_device(d["id"], d["name"])
-                if not result:
-                    continue
-                result["updated"] = datetime.now(timezone.utc).strftime("%d.%m.%Y %H:%M")
-                _temp_data[d["name"]] = result
-                _save_json(TEMP_DATA_FILE, _temp_data)
-                # Alert if any sensor is critical
-                if aid:
-                    for sensor in result.get("temps", []):
-                        if sensor.get("temp_c", 0) >= TEMP_WARN_C:
-                            await bot.send_message(
-                                aid,
-                                f"🌡 <b>Высокая температура!</b>\n"
-                                f"💻 {d['name']}\n"
-                                f"🌡 {sensor['zone']}: <b>{sensor['temp_c']}°C</b>\n"
-                                f"⚠️ Порог: {TEMP_WARN_C}°C",
-                                parse_mode="HTML",
-                            )
-                            break  # one alert per device per cycle
-                await asyncio.sleep(3)
-        except Exception as e:
-            log.error(f"temp_loop: {e}")
+def _flush_probe_data(sections: set[str]):
+    """Write what the given bundle sections collected, once for the batch.
+    hw_inventory and temp_data go through the write-behind flush, at most
+    once per STATE_FLUSH_SEC."""
+    _writes.flush()
+    if "temp" in sections:
+        _temp_history.flush()
+    if "printers" in sections and _printers_pending:
+        _state.doc("printers").put_many(_printers_pending)
+        _printers_pending.clear()
+
+
+async def _run_probes(devices, sections) -> dict[str, int]:
+    """One bundled probe round trip per device through _bulk, in the given
+    order. sections is a list for every device or a function device → list.
+    Results are stored as they arrive and written to disk every
+    PROBE_FLUSH_EVERY devices / PROBE_FLUSH_SEC and at the end. Returns the
+    number of devices each section was collected from."""
+    want = sections if callable(sections) else (lambda d: sections)
+
+    async def run(d, timeout: float) -> str:
+        asked = want(d)
+        params = {"Sections": ",".join(asked)}
+        fp = (_hw_inventory.get(d["name"]) or {}).get("fingerprint")
+        if fp and "hw" in asked:
+            params["Known"] = f"hw={fp}"    # unchanged hardware answers with free space only
+        return await _probes.run(d["id"], _probe_bundle, params, timeout=timeout)
+
+    collected: dict[str, int] = {}
+    dirty: set[str] = set()
+    batch = {"n": 0, "at": time.monotonic()}
+
+    async def on_result(res: DeviceResult):
+        nid, name = res.device["id"], res.device["name"]
+        asked = want(res.device)
+        if not res.ok:
+            log.warning(f"probe: {name}: {res.state} {res.error}")
+            if res.state in (ERROR, TIMEOUT):
+                for section in asked:
+                    _health.failure(nid, section, res.error)
+            return
         try:
-            await asyncio.wait_for(_shutdown_event.wait(), timeout=TEMP_POLL_INTERVAL)
-            break
-        except asyncio.TimeoutError:
-            pass
+            parts = parse_bundle(res.output)
+        except ValueError as e:
+            log.warning(f"probe: {name}: {e}")
+            for section in asked:
+                _health.failure(nid, section, str(e))
+            return
+        for section in asked:
+            part = parts.get(section) or {"ok": False, "error": "нет в ответе"}
+            if not part.get("ok"):
+                log.warning(f"probe {section}: {name}: {part.get('error', '')}")
+                _health.failure(nid, section, part.get("error", ""))
+                continue
+            try:
+                stored = await _apply_probe_section(res.device, section, part.get("out") or "")
+            except Exception as e:
+                log.warning(f"probe {section}: {name}: {e}")
+                stored, part["error"] = False, str(e)
+            _health.record(nid, section, stored, part.get("error", "нет данных в выводе"))
+            if not stored:
+                continue
+            dirty.add(section)
+            _probe_last.setdefault(nid, {})[section] = time.time()
+            collected[section] = collected.get(section, 0) + 1
+        batch["n"] += 1
+        if dirty and (batch["n"] >= PROBE_FLUSH_EVERY or time.monotonic() - batch["at"] >= PROBE_FLUSH_SEC):
+            _flush_probe_data(dirty)
+            dirty.clear()
+            batch["n"], batch["at"] = 0, time.monotonic()
 
+    try:
+        await _bulk.run(devices, run, timeout=90, on_result=on_result)
+    finally:
+        _flush_probe_data(dirty)
+    return collected
 
-async def netmap_loop():
-    """Background loop: regenerate netmap.html every NETMAP_INTERVAL seconds."""
-    NETMAP_FILE.parent.mkdir(parents=True, exist_ok=True)
-    STATUS_HTML_FILE.parent.mkdir(parents=True, exist_ok=True)
-    await asyncio.sleep(5)  # short delay on startup
-    while not _shutdown_event.is_set():
-        try:
-            devs = await get_full_devices()
-            if devs:
-                html = build_network_map_html(devs, web_mode=True)
-                if html:
-                    NETMAP_FILE.write_text(html, encoding="utf-8")
-                # Status page
-                status_html = build_status_html(devs)
-                STATUS_HTML_FILE.write_text(status_html, encoding="utf-8")
-                log.info(f"netmap: updated ({len(devs)} devices)")
-        except Exception as e:
-            log.error(f"netmap_loop: {e}")
-        try:
-            await asyncio.wait_for(_shutdown_event.wait(), timeout=NETMAP_INTERVAL)
-            break
-        except asyncio.TimeoutError:
-            pass
+
+async def probe_job():
+    """Probe online devices with one bundle round trip each, running only the
+    sections that are due: temperature every TEMP_POLL_INTERVAL, hardware and
+    USB every HW_POLL_INTERVAL and right away for devices queued by bus events
+    (new, hardware changed, back online with a stale inventory).
+    """
+    index = await get_device_index()
+    now = time.time()
+    due: dict[str, list[str]] = {}
+    for d in index.online:
+        sections = [s for s in _probe_due(d, now) if _health.allow(d["id"], s)]
+        if sections:
+            due[d["id"]] = sections
+    _hw_pending.clear()
+    if not due:
+        return
+    combos: dict[str, int] = {}
+    for sections in due.values():
+        key = "+".join(sections)
+        combos[key] = combos.get(key, 0) + 1
+    log.info(f"probe: {len(due)} devices {combos}")
+    # never-probed devices first, then the most overdue
+    order = sorted(due, key=lambda nid: min(_probe_last[nid].get(s, 0) for s in due[nid]))
+    collected = await _run_probes([index.get(nid) for nid in order], lambda d: due[d["id"]])
+    log.info(f"probe: collected {collected}")
+
+
+async def netmap_job():
+    """Regenerate netmap.html and the public status page."""
+    devs = await get_full_devices()
+    if devs:
+        html = build_network_map_html(devs, web_mode=True)
+        if html:
+            NETMAP_FILE.write_text(html, encoding="utf-8")
+        # Status page
+        status_html = build_status_html(devs)
+        STATUS_HTML_FILE.write_text(status_html, encoding="utf-8")
+        log.info(f"netmap: updated ({len(devs)} devices)")
 
 
 # Quick command presets for devices
@@ -3689,7 +3741,10 @@ QUICK_COMMANDS = {
 # ─── Pagination helpers ──────────────────────────────────────────────
 
 def paginated_buttons(items: list[dict], page: int, prefix: str, name_key: str = "name",
-                      icon_fn=None, extra_buttons: list = None) -> InlineKeyboardMarkup:
+                      icon_fn=None, extra_buttons: list = None,
+                      page_prefix: str = None, page_suffix: str = "") -> InlineKeyboardMarkup:
+    """Item buttons call `{prefix}:<name>`; ◀️/▶️ call `page:{page_prefix or prefix}:<n>{page_suffix}`."""
+    page_prefix = page_prefix or prefix
     total_pages = max(1, (len(items) + PAGE_SIZE - 1) // PAGE_SIZE)
     page = max(0, min(page, total_pages - 1))
     start = page * PAGE_SIZE
@@ -3702,10 +3757,10 @@ def paginated_buttons(items: list[dict], page: int, prefix: str, name_key: str =
 
     nav = []
     if page > 0:
-        nav.append(InlineKeyboardButton(text="◀️", callback_data=f"page:{prefix}:{page - 1}"))
+        nav.append(InlineKeyboardButton(text="◀️", callback_data=f"page:{page_prefix}:{page - 1}{page_suffix}"))
     nav.append(InlineKeyboardButton(text=f"{page + 1}/{total_pages}", callback_data="noop"))
     if page < total_pages - 1:
-        nav.append(InlineKeyboardButton(text="▶️", callback_data=f"page:{prefix}:{page + 1}"))
+        nav.append(InlineKeyboardButton(text="▶️", callback_data=f"page:{page_prefix}:{page + 1}{page_suffix}"))
     if nav:
         buttons.append(nav)
 
@@ -3777,7 +3832,7 @@ async def msg_status(msg: Message):
             ssl_summary = f"\n🔐 SSL: 🟡 {len(warn)} предупр  🟢 {ok_n} ок"
         else:
             ssl_summary = f"\n🔐 SSL: 🟢 все {ok_n} ок"
-    # HTTP services status from cache (updated by health_loop every 60s)
+    # HTTP services status from cache (updated by health_job every HEALTH_CHECK_INTERVAL)
     http_lines = ""
     if HTTP_SERVICES:
         svc_parts = []
@@ -3816,14 +3871,13 @@ async def msg_status(msg: Message):
 async def msg_devices(msg: Message):
     if not is_admin(msg.from_user.id):
         return
-    devs = await get_full_devices()
+    index = await get_device_index()
+    devs = index.devices
     if not devs:
         await msg.answer("📭 Нет устройств.", reply_markup=MAIN_KB)
         return
 
-    by_group: dict[str, list] = {}
-    for d in devs:
-        by_group.setdefault(d["group"], []).append(d)
+    by_group = index.groups
 
     t = "━━━━━━━━━━━━━━━━━━━━━━\n📋  <b>Устройства</b>\n━━━━━━━━━━━━━━━━━━━━━━\n\n"
     for group, gdevs in sorted(by_group.items()):
@@ -3860,13 +3914,10 @@ async def cb_page(cb: CallbackQuery):
     page = int(parts[2])
 
     if prefix == "dev":
-        devs = await get_full_devices()
-        sorted_devs = sorted(devs, key=lambda x: x["name"])
-        by_group = {}
-        for d in devs:
-            by_group.setdefault(d["group"], [])
+        index = await get_device_index()
+        sorted_devs = sorted(index.devices, key=lambda x: x["name"])
         extra = []
-        groups = sorted(by_group.keys())
+        groups = sorted(index.groups)
         if groups:
             grp_btns = [InlineKeyboardButton(text=f"📁 {g}", callback_data=f"grp:{g[:40]}") for g in groups]
             extra.append(grp_btns)
@@ -3880,10 +3931,9 @@ async def cb_page(cb: CallbackQuery):
     elif prefix == "sw":
         # software pagination - data in callback
         dev_name = parts[3] if len(parts) > 3 else ""
-        devs = await get_full_devices()
-        d = next((x for x in devs if x["name"] == dev_name), None)
+        d = (await get_device_index()).by_name(dev_name)
         if d and d.get("software"):
-            sw = d["software"]
+            sw = sorted(d["software"], key=lambda s: s["name"].lower())
             total_pages = max(1, (len(sw) + 20 - 1) // 20)
             page = max(0, min(page, total_pages - 1))
             start = page * 20
@@ -3903,14 +3953,13 @@ async def cb_page(cb: CallbackQuery):
             except Exception:
                 pass
     elif prefix == "search":
-        query = parts[3] if len(parts) > 3 else ""
-        devs = await get_full_devices()
-        q = query.lower()
-        results = [d for d in devs if q in d["name"].lower() or q in d["ip"].lower()
-                   or q in d["os"].lower() or q in d["cpu"].lower()
-                   or q in d["board_sn"].lower() or q in d["os_sn"].lower()]
-        results.sort(key=lambda x: x["name"])
-        kb = paginated_buttons(results, page, "dev",
+        qid = parts[3] if len(parts) > 3 else ""
+        query = _search_queries.get(qid)
+        if query is None:
+            await cb.answer("Поиск устарел, повторите /search", show_alert=True)
+            return
+        results = (await get_search_index()).search(query)   # memoized: no rescan per page
+        kb = paginated_buttons(results, page, "dev", page_prefix="search", page_suffix=f":{qid}",
                                icon_fn=lambda d: "🟢" if d["online"] else "⚪")
         try:
             await cb.message.edit_reply_markup(reply_markup=kb)
@@ -3933,8 +3982,7 @@ async def cb_device(cb: CallbackQuery):
         await cb.answer("🔒", show_alert=True)
         return
     name = cb.data.split(":", 1)[1]
-    devs = await get_full_devices()
-    d = next((x for x in devs if x["name"] == name), None)
+    d = (await get_device_index()).by_name(name)
     if not d:
         await cb.answer("Устройство не найдено", show_alert=True)
         return
@@ -3970,7 +4018,7 @@ async def cb_group(cb: CallbackQuery):
         await cb.answer("🔒", show_alert=True)
         return
     group = cb.data.split(":", 1)[1]
-    devs = [d for d in await get_full_devices() if d["group"] == group]
+    devs = (await get_device_index()).group(group)
     if not devs:
         await cb.answer("Группа пуста", show_alert=True)
         return
@@ -4021,8 +4069,7 @@ async def cb_csv_single(cb: CallbackQuery):
         await cb.answer("🔒", show_alert=True)
         return
     name = cb.data.split(":", 1)[1]
-    devs = await get_full_devices()
-    d = next((x for x in devs if x["name"] == name), None)
+    d = (await get_device_index()).by_name(name)
     if not d:
         await cb.answer("Не найдено", show_alert=True)
         return
@@ -4042,8 +4089,7 @@ async def cb_pdf_single(cb: CallbackQuery):
         await cb.answer("🔒", show_alert=True)
         return
     name = cb.data.split(":", 1)[1]
-    devs = await get_full_devices()
-    d = next((x for x in devs if x["name"] == name), None)
+    d = (await get_device_index()).by_name(name)
     if not d:
         await cb.answer("Не найдено", show_alert=True)
         return
@@ -4082,8 +4128,7 @@ async def cb_software(cb: CallbackQuery):
         await cb.answer("🔒", show_alert=True)
         return
     name = cb.data.split(":", 1)[1]
-    devs = await get_full_devices()
-    d = next((x for x in devs if x["name"] == name), None)
+    d = (await get_device_index()).by_name(name)
     if not d:
         await cb.answer("Не найдено", show_alert=True)
         return
@@ -4093,7 +4138,7 @@ async def cb_software(cb: CallbackQuery):
         await cb.answer("Список ПО недоступен для этого устройства", show_alert=True)
         return
 
-    sw.sort(key=lambda s: s["name"].lower())
+    sw = sorted(sw, key=lambda s: s["name"].lower())
     total_pages = max(1, (len(sw) + 20 - 1) // 20)
     lines = [f"📦 <b>ПО: {name}</b> ({len(sw)} программ, стр 1/{total_pages})\n"]
     for s in sw[:20]:
@@ -4117,8 +4162,7 @@ async def cb_wol(cb: CallbackQuery):
         await cb.answer("🔒", show_alert=True)
         return
     name = cb.data.split(":", 1)[1]
-    devs = await get_full_devices()
-    d = next((x for x in devs if x["name"] == name), None)
+    d = (await get_device_index()).by_name(name)
     if not d:
         await cb.answer("Не найдено", show_alert=True)
         return
@@ -4155,8 +4199,7 @@ async def cb_remote_cmd_menu(cb: CallbackQuery):
         await cb.answer("🔒", show_alert=True)
         return
     name = cb.data.split(":", 1)[1]
-    devs = await get_full_devices()
-    d = next((x for x in devs if x["name"] == name), None)
+    d = (await get_device_index()).by_name(name)
     if not d:
         await cb.answer("Не найдено", show_alert=True)
         return
@@ -4213,8 +4256,7 @@ async def cb_quick_cmd(cb: CallbackQuery):
         return
 
     command, is_ps = QUICK_COMMANDS[cmd_key]
-    devs = await get_full_devices()
-    d = next((x for x in devs if x["name"] == dev_name), None)
+    d = (await get_device_index()).by_name(dev_name)
     if not d:
         await cb.answer("Не найдено", show_alert=True)
         return
@@ -4283,8 +4325,7 @@ async def cb_power_action(cb: CallbackQuery):
         await cb.answer("Неизвестное действие", show_alert=True)
         return
 
-    devs = await get_full_devices()
-    d = next((x for x in devs if x["name"] == dev_name), None)
+    d = (await get_device_index()).by_name(dev_name)
     if not d:
         await cb.answer("Не найдено", show_alert=True)
         return
@@ -4313,8 +4354,7 @@ async def cb_power_confirm(cb: CallbackQuery):
     action = parts[1]
     dev_name = parts[2]
 
-    devs = await get_full_devices()
-    d = next((x for x in devs if x["name"] == dev_name), None)
+    d = (await get_device_index()).by_name(dev_name)
     if not d:
         await cb.answer("Не найдено", show_alert=True)
         return
@@ -4369,8 +4409,7 @@ async def cmd_run(msg: Message):
         await msg.answer("❌ Не указана команда.", reply_markup=MAIN_KB)
         return
 
-    devs = await get_full_devices()
-    d = next((x for x in devs if x["name"].lower() == dev_name.lower()), None)
+    d = (await get_device_index()).by_name(dev_name, ignore_case=True)
     if not d:
         await msg.answer(f"❌ Устройство «{dev_name}» не найдено.", reply_markup=MAIN_KB)
         return
@@ -4526,24 +4565,27 @@ async def cmd_search(msg: Message):
         return
     parts = msg.text.split(maxsplit=1)
     if len(parts) < 2:
-        await msg.answer("Использование: /search <запрос>\nПоиск по имени, IP, ОС, CPU, серийникам", reply_markup=MAIN_KB)
-        return
+        await msg.answer(
+            "Использование: /search <запрос>\n"
+            "Поиск по имени, IP, ОС, CPU, серийникам, группе, сетевым адаптерам, пользователям.\n"
+            "Префиксы полей: name: ip: os: cpu: sn: group: nic: mac: user: sw:\n"
+            "Пример: <code>/search sw:chrome ip:192.168.1.</code>",
+            parse_mode="HTML", reply_markup=MAIN_KB,
+        )
+        return
     query = parts[1].strip()
-    q = query.lower()
-    devs = await get_full_devices()
-    results = [d for d in devs if q in d["name"].lower() or q in d["ip"].lower()
-               or q in d["os"].lower() or q in d["cpu"].lower()
-               or q in d["board_sn"].lower() or q in d["os_sn"].lower()
-               or q in d["group"].lower()
-               or any(q in nic.lower() for nic in d["nics"])]
+    results = (await get_search_index()).search(query)
 
     if not results:
         await msg.answer(f"🔍 По запросу «{query}» ничего не найдено.", reply_markup=MAIN_KB)
         return
 
-    results.sort(key=lambda x: x["name"])
+    qid = f"{hash(query.lower()) & 0xffffffff:08x}"
+    _search_queries[qid] = query
+    if len(_search_queries) > 200:
+        _search_queries.pop(next(iter(_search_queries)))
     t = f"🔍 <b>Результаты: «{query}»</b> — {len(results)} устройств\n\n"
-    kb = paginated_buttons(results, 0, "dev",
+    kb = paginated_buttons(results, 0, "dev", page_prefix="search", page_suffix=f":{qid}",
                            icon_fn=lambda d: "🟢" if d["online"] else "⚪")
     await msg.answer(t, parse_mode="HTML", reply_markup=kb)
 
@@ -4561,9 +4603,8 @@ async def cmd_compare(msg: Message):
 
     name1 = parts[1].strip()
     name2 = parts[2].strip()
-    devs = await get_full_devices()
-    d1 = next((d for d in devs if d["name"].lower() == name1.lower()), None)
-    d2 = next((d for d in devs if d["name"].lower() == name2.lower()), None)
+    d1 = (await get_device_index()).by_name(name1, ignore_case=True)
+    d2 = (await get_device_index()).by_name(name2, ignore_case=True)
 
     if not d1:
         await msg.answer(f"❌ Устройство «{name1}» не найдено.", reply_markup=MAIN_KB)
@@ -4672,8 +4713,7 @@ async def cmd_script(msg: Message):
         await msg.answer(f"❌ Скрипт «{script_name}» не найден.\n/scripts — список", reply_markup=MAIN_KB)
         return
 
-    devs = await get_full_devices()
-    d = next((x for x in devs if x["name"].lower() == dev_name.lower()), None)
+    d = (await get_device_index()).by_name(dev_name, ignore_case=True)
     if not d:
         await msg.answer(f"❌ Устройство «{dev_name}» не найдено.", reply_markup=MAIN_KB)
         return
@@ -4770,8 +4810,7 @@ async def cb_script_execute(cb: CallbackQuery):
         await cb.answer("Скрипт не найден", show_alert=True)
         return
 
-    devs = await get_full_devices()
-    d = next((x for x in devs if x["name"] == dev_name), None)
+    d = (await get_device_index()).by_name(dev_name)
     if not d or not d["online"]:
         await cb.answer("Устройство недоступно", show_alert=True)
         return
@@ -4930,24 +4969,23 @@ async def cmd_wifi_poll(msg: Message):
         await msg.answer("⚙️ keenetic_probes.json пуст.", reply_markup=MAIN_KB)
         return
     wait = await msg.answer("🔄 Запускаю зонд на агенте...", reply_markup=MAIN_KB)
-    devs = await get_full_devices()
-    name_to_id = {d["name"]: d["id"] for d in devs}
+    index = await get_device_index()
     results = []
     for probe in probes:
         aname  = probe.get("agent_name", "")
-        dev_id = name_to_id.get(aname)
-        if not dev_id:
+        dev = index.by_name(aname)
+        if not dev:
             results.append(f"❌ Агент <b>{aname}</b> не найден")
             continue
-        dev = next((d for d in devs if d["id"] == dev_id), None)
-        if not dev or not dev.get("online"):
+        dev_id = dev["id"]
+        if not dev.get("online"):
             results.append(f"⏸ Агент <b>{aname}</b> офлайн")
             continue
         result = await run_keenetic_probe(dev_id, probe)
         global _wifi_clients
         if result:
             _wifi_clients[aname] = result
-            _save_wifi_clients()
+            _save_wifi_clients(aname)
             ok = result.get("ok", False)
             if ok:
                 cnt = result.get("count", 0)
@@ -5084,12 +5122,12 @@ def _wifi_office_text(location: str, probe: dict) -> str:
     return "\n".join(lines)
 
 
-async def _run_probe_for(probe: dict, devs: list[dict]) -> str:
+async def _run_probe_for(probe: dict, index: DeviceIndex) -> str:
     """Run probe and update cache. Returns status string."""
     global _wifi_clients
     aname  = probe.get("agent_name", "")
     loc    = probe.get("location", aname)
-    dev    = next((d for d in devs if d["name"] == aname), None)
+    dev    = index.by_name(aname)
     if not dev:
         return f"❌ <b>{loc}</b>: агент не найден"
     if not dev.get("online"):
@@ -5097,7 +5135,7 @@ async def _run_probe_for(probe: dict, devs: list[dict]) -> str:
     result = await run_keenetic_probe(dev["id"], probe)
     if result:
         _wifi_clients[aname] = result
-        _save_wifi_clients()
+        _save_wifi_clients(aname)
         return f"✅ <b>{loc}</b>: {result.get('count', 0)} устр."
     return f"❌ <b>{loc}</b>: нет ответа"
 
@@ -5175,9 +5213,9 @@ async def cb_wifi_refresh_all(cb: CallbackQuery):
         return
     await cb.answer("🔄 Обновляю все офисы...", show_alert=False)
     probes = _load_keenetic_probes()
-    devs   = await get_full_devices()
+    index  = await get_device_index()
     for probe in probes:
-        await _run_probe_for(probe, devs)
+        await _run_probe_for(probe, index)
     probes = _load_keenetic_probes()
     await cb.message.edit_text(
         "📡 <b>WiFi сети по офисам</b>\n\nВыбери офис:",
@@ -5199,8 +5237,7 @@ async def cb_wifi_refresh_one(cb: CallbackQuery):
         await cb.answer("Офис не найден", show_alert=True)
         return
     await cb.answer("🔄 Обновляю...")
-    devs = await get_full_devices()
-    await _run_probe_for(probe, devs)
+    await _run_probe_for(probe, await get_device_index())
     text = _wifi_office_text(location, probe)
     kb   = InlineKeyboardMarkup(inline_keyboard=[[
         InlineKeyboardButton(text="🔄 Обновить", callback_data=f"wifi:refresh_one:{location[:40]}"),
@@ -5590,7 +5627,7 @@ async def cb_wifi_del(cb: CallbackQuery):
         KEENETIC_PROBES_FILE.write_text(json.dumps(probes, ensure_ascii=False, indent=2))
         global _wifi_clients
         _wifi_clients.pop(aname, None)
-        _save_wifi_clients()
+        _save_wifi_clients(aname)
         await cb.answer(f"Удалён: {location}")
     else:
         await cb.answer("Не найден", show_alert=True)
@@ -5674,6 +5711,147 @@ async def cmd_top(msg: Message):
 
 # ─── Group Commands ─────────────────────────────────────────────────
 
+_BULK_SKIP_PREFIXES = ("Microsoft Windows", "(c) ", "C:\\Program Files\\Mesh Agent>")
+_BULK_STATE_ICONS = {ERROR: "❌", TIMEOUT: "⏱", CANCELLED: "⛔", SKIPPED: "⏭"}
+
+
+def _bulk_first_line(res: DeviceResult, command: str) -> str:
+    """One-line summary of a device's result for the group report."""
+    if res.state == CANCELLED:
+        return "остановлено"
+    if res.state == SKIPPED:
+        return "не успели (дедлайн)"
+    if res.state != OK:
+        return res.error[:60]
+    for line in res.output.split("\n"):
+        stripped = line.strip()
+        if stripped and not any(stripped.startswith(p) for p in _BULK_SKIP_PREFIXES):
+            if stripped != command and stripped != "exit":
+                return stripped[:60]
+    return "(пустой ответ)" if not res.output else ""
+
+
+def _bulk_line(res: DeviceResult, command: str) -> tuple[bool, str]:
+    """(succeeded, report line) for one device of a group command."""
+    ok = res.state == OK and "Error" not in res.output
+    icon = "✅" if ok else _BULK_STATE_ICONS.get(res.state, "❌")
+    return ok, f"{icon} <b>{res.device['name']}</b>: {_bulk_first_line(res, command)}"
+
+
+def _bulk_fit(head: str, lines: list[str], tail: str = "", limit: int = 4000) -> str:
+    """head + as many of lines as fit into one message + tail; a cut is marked."""
+    budget = limit - len(head) - len(tail) - 40
+    out: list[str] = []
+    for line in lines:
+        budget -= len(line) + 1
+        if budget < 0:
+            out.append(f"… ещё {len(lines) - len(out)}")
+            break
+        out.append(line)
+    return "\n".join([head, *out, tail] if tail else [head, *out])
+
+
+def _bulk_output_file(results: list[DeviceResult], title: str, filename: str) -> BufferedInputFile:
+    """Full per-device output of a bulk run as a text attachment."""
+    parts = [title, ""]
+    for res in sorted(results, key=lambda r: r.device["name"]):
+        parts.append(f"=== {res.device['name']}  [{res.state}, {res.duration:.1f} с, {res.bytes} Б] ===")
+        parts.append(res.output if res.state == OK else res.error or res.state)
+        parts.append("")
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%d_%H%M")
+    return BufferedInputFile("\n".join(parts).encode("utf-8"), filename=f"{filename}_{stamp}.txt")
+
+
+def _bulk_stop_kb(run: BulkRun) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="⛔ Остановить", callback_data=f"bulk:stop:{run.id}")],
+    ])
+
+
+async def _bulk_stream(wait_msg: Message, run: BulkRun, render: Callable[[], str]) -> list[DeviceResult]:
+    """Wait for run while editing wait_msg with render() as results come in:
+    first after 1 s, then at most every BULK_EDIT_INTERVAL s, only when the
+    text changed, and never inside a flood-control pause."""
+    kb = _bulk_stop_kb(run)
+    try:
+        await wait_msg.edit_reply_markup(reply_markup=kb)
+    except Exception:
+        pass
+    shown, shown_at, seen = "", 0.0, 0
+    not_before = 0.0
+    while True:
+        try:
+            return await asyncio.wait_for(run.wait(), timeout=BULK_EDIT_INTERVAL if shown else 1)
+        except asyncio.TimeoutError:
+            pass
+        now = time.monotonic()
+        if now < not_before:
+            continue
+        # nothing new: only tick the elapsed time now and then
+        if shown and len(run.results) == seen and now - shown_at < 5 * BULK_EDIT_INTERVAL:
+            continue
+        text = render()
+        if text == shown:
+            continue
+        try:
+            await wait_msg.edit_text(text, parse_mode="HTML", reply_markup=kb)
+            shown, shown_at, seen = text, now, len(run.results)
+        except TelegramRetryAfter as e:
+            not_before = time.monotonic() + e.retry_after
+        except Exception as e:
+            log.debug(f"bulk {run.id}: progress edit: {e}")
+
+
+def _bulk_status(run: BulkRun, ok: int) -> str:
+    done = len(run.results)
+    return f"✅ {ok}  ❌ {done - ok}  ⏳ {run.total - done}  ·  {run.elapsed:.0f} с"
+
+
+async def _run_on_group(wait_msg: Message, devs: list, command: str, powershell: bool,
+                        header: str, group_name: str) -> None:
+    """Run command on devs through _bulk, streaming results into wait_msg.
+    When the final report doesn't fit one message, failures go first and the
+    full output of every device is attached as a file."""
+    run = _bulk.start(devs, _bulk_command(command, powershell), timeout=30, deadline=BULK_DEADLINE_SEC)
+
+    def live() -> str:
+        done = [_bulk_line(r, command) for r in run.results]
+        ok = sum(o for o, _ in done)
+        return _bulk_fit(f"{header}\n{_bulk_status(run, ok)}\n", [line for _, line in reversed(done)])
+
+    results = await _bulk_stream(wait_msg, run, live)
+
+    done = [_bulk_line(r, command) for r in sorted(results, key=lambda r: r.device["name"])]
+    success = sum(o for o, _ in done)
+    c = run.counts()
+    extra = "".join(f"  {_BULK_STATE_ICONS[k]} {c[k]}" for k in (TIMEOUT, CANCELLED, SKIPPED) if c[k])
+    summary = f"\n✅ {success}  ❌ {len(done) - success}{extra}  ·  {run.elapsed:.0f} с"
+    text = "\n".join([header, *(line for _, line in done), summary])
+    if len(text) <= 4000:
+        await wait_msg.edit_text(text, parse_mode="HTML")
+        return
+    lines = [line for o, line in done if not o] + [line for o, line in done if o]
+    await wait_msg.edit_text(_bulk_fit(header, lines, summary + "\n📎 Полный вывод — в файле"),
+                             parse_mode="HTML")
+    await wait_msg.answer_document(
+        _bulk_output_file(results, f"$ {command}", f"group_{group_name}"),
+        caption=f"📁 {group_name}: вывод {len(results)} устройств",
+    )
+
+
+@router.callback_query(F.data.startswith("bulk:stop:"))
+async def cb_bulk_stop(cb: CallbackQuery):
+    if not is_admin(cb.from_user.id):
+        await cb.answer("🔒", show_alert=True)
+        return
+    run = _bulk.runs.get(cb.data[len("bulk:stop:"):])
+    if run is None:
+        await cb.answer("Уже завершено")
+        return
+    run.cancel()
+    await cb.answer("⛔ Останавливаю...")
+
+
 @router.message(Command("run_group"))
 async def cmd_run_group(msg: Message):
     """Run command on all online devices in a group: /run_group <group> [-ps] <cmd>"""
@@ -5700,8 +5878,7 @@ async def cmd_run_group(msg: Message):
         await msg.answer("❌ Не указана команда.", reply_markup=MAIN_KB)
         return
 
-    devs = await get_full_devices()
-    group_devs = [d for d in devs if d["group"].lower() == group_name.lower() and d["online"]]
+    group_devs = [d for d in (await get_device_index()).group(group_name, ignore_case=True) if d["online"]]
     if not group_devs:
         await msg.answer(f"❌ Нет онлайн устройств в группе «{group_name}».", reply_markup=MAIN_KB)
         return
@@ -5711,48 +5888,14 @@ async def cmd_run_group(msg: Message):
         parse_mode="HTML",
     )
 
-    sem = asyncio.Semaphore(5)
-    results = {}
-
-    async def run_one(d):
-        async with sem:
-            result = await mc_run_command(d["id"], rest, powershell=ps)
-            results[d["name"]] = result
-
-    await asyncio.gather(*[run_one(d) for d in group_devs])
-
-    lines = [
+    await _run_on_group(
+        wait_msg, group_devs, rest, ps,
         f"━━━━━━━━━━━━━━━━━━━━━━\n"
-        f"📁 <b>Группа: {group_name}</b> ({len(results)} устройств)\n"
+        f"📁 <b>Группа: {group_name}</b> ({len(group_devs)} устройств)\n"
         f"━━━━━━━━━━━━━━━━━━━━━━\n"
-        f"<code>$ {rest}</code>\n"
-    ]
-
-    success = 0
-    fail = 0
-    for name, output in sorted(results.items()):
-        first_line = ""
-        for line in output.split("\n"):
-            stripped = line.strip()
-            skip_prefixes = ("Microsoft Windows", "(c) ", "C:\\Program Files\\Mesh Agent>")
-            if stripped and not any(stripped.startswith(p) for p in skip_prefixes):
-                if stripped != rest and stripped != "exit":
-                    first_line = stripped[:60]
-                    break
-        if "Error" in output:
-            fail += 1
-            lines.append(f"❌ <b>{name}</b>: {first_line}")
-        else:
-            success += 1
-            lines.append(f"✅ <b>{name}</b>: {first_line}")
-
-    lines.insert(4, f"\n✅ {success} успешно, ❌ {fail} ошибок\n")
-
-    text = "\n".join(lines)
-    if len(text) > 4000:
-        text = text[:4000] + "\n..."
-
-    await wait_msg.edit_text(text, parse_mode="HTML")
+        f"<code>$ {rest}</code>\n",
+        group_name,
+    )
 
 
 # ─── Full inventory ─────────────────────────────────────────────────
@@ -5773,7 +5916,7 @@ async def msg_inventory(msg: Message):
         caption=f"📦 <b>Полный инвентарь</b> — {len(devs)} устройств\n27 колонок • CSV (;) UTF-8 BOM для Excel",
         parse_mode="HTML",
     )
-    json_data = json.dumps(devs, indent=2, ensure_ascii=False, default=str).encode()
+    json_data = json.dumps([d.as_dict() for d in devs], indent=2, ensure_ascii=False, default=str).encode()
     await msg.answer_document(
         BufferedInputFile(json_data, filename=f"inventory_all_{ts}.json"),
         caption="📋 JSON (полные данные)",
@@ -5815,6 +5958,207 @@ async def msg_health(msg: Message):
     await msg.answer(t, parse_mode="HTML", reply_markup=MAIN_KB)
 
 
+# ─── Perf counters ───────────────────────────────────────────────────
+
+def _perf_text() -> str:
+    """Internal counters: MC control channel, DB ingest, device cache, login-key broker, probes, bulk runs, jobs."""
+    lines = ["━━━━━━━━━━━━━━━━━━━━━━\n⚙️ <b>Производительность</b>\n━━━━━━━━━━━━━━━━━━━━━━\n"]
+
+    if _mc_channel is not None:
+        st = _mc_channel.stats
+        state = "🟢 подключён" if _mc_channel.connected else "🔴 нет связи (fallback: meshctrl)"
+        lines.append(f"<b>🔌 MC control channel:</b> {state}")
+        lines.append(f"   подключений: {st['connects']}  запросов: {st['requests']}  "
+                     f"ошибок: {st['errors']}  таймаутов: {st['timeouts']}")
+        lines.append("")
+
+    if _presence is not None:
+        ps = _presence.stats
+        mode = "🟢 события MC" if _presence.live else "🟡 опрос ListDevices"
+        age = f"{_presence.age:.0f} с назад" if ps["reconciles"] else "ещё не было"
+        lines.append(f"<b>📡 Онлайн-статус:</b> {mode}  (онлайн {len(_presence.online)})")
+        lines.append(f"   событий: {ps['events']}  изменений: {ps['changes']}  "
+                     f"сверок: {ps['reconciles']} (последняя {age}, расхождений {ps['drift']})")
+        lines.append("")
+
+    if _db_tail is not None:
+        ts = _db_tail.stats
+        lines.append(f"<b>🗄 DB ingest:</b> tail {Path(_db_tail.path).name}  (поколение {_db_tail.records.generation})")
+        lines.append(f"   полных чтений: {ts['full_reads']}  инкрементальных: {ts['incremental_reads']}  "
+                     f"прочитано: {fmt_bytes(ts['bytes_read'])}  записей: {len(_db_tail.records)}")
+    else:
+        lines.append(f"<b>🗄 DB ingest:</b> --dbexport раз в {DB_CACHE_TTL} с")
+    lines.append("")
+
+    ds = _devices_stats
+    lines.append("<b>📋 get_full_devices:</b>")
+    lines.append(f"   сборок: {ds['builds']} (последняя {ds['build_ms']:.0f} мс)  "
+                 f"из памяти: {ds['hits']}  ожиданий in-flight: {ds['waits']}  "
+                 f"устройств: {len(_devices_memo[2])}")
+    cs = _device_cache.stats
+    lines.append(f"   узлов пересобрано: {cs['rebuilt']}  переиспользовано: {cs['reused']}  "
+                 f"удалено: {cs['dropped']}")
+    if _search_index[1] is not None:
+        ss = _search_index[1].stats
+        lines.append(f"   /search: запросов {ss['queries']}  из кэша {ss['cache_hits']}")
+    bs = _device_bus.stats
+    lines.append(f"   события: новых {bs['added']}  удалено {bs['removed']}  онлайн/офлайн {bs['online']}  "
+                 f"железо {bs['hardware']}  тома {bs['volumes']}  (обновлений {bs['refreshes']})")
+    lines.append("")
+
+    ks = _login_key_stats
+    total = ks["hits"] + ks["misses"]
+    hit_pct = ks["hits"] / total * 100 if total else 0
+    age = f"{(time.time() - _login_key_time) / 60:.0f} мин" if _login_key_time else "—"
+    lines.append("<b>🔑 Login key:</b>")
+    lines.append(f"   hit: {ks['hits']}  miss: {ks['misses']}  ({hit_pct:.0f}% hit)")
+    lines.append(f"   генераций: {ks['refreshes']}  ожиданий in-flight: {ks['waits']}  "
+                 f"ошибок: {ks['errors']}  возраст: {age}")
+    lines.append("")
+
+    prs = _probes.stats
+    if prs["calls"]:
+        saved = (1 - prs["bytes_sent"] / prs["bytes_full"]) * 100 if prs["bytes_full"] else 0
+        lines.append(f"<b>📜 Скрипты-зонды на агентах:</b> вызовов {prs['calls']}  "
+                     f"установок {prs['deploys']}  (промахов {prs['misses']})")
+        lines.append(f"   отправлено {fmt_bytes(prs['bytes_sent'])} вместо {fmt_bytes(prs['bytes_full'])} "
+                     f"(−{saved:.0f}%)")
+        if prs["bytes_received"]:
+            lines.append(f"   получено {fmt_bytes(prs['bytes_received'])} вместо {fmt_bytes(prs['bytes_output'])}  "
+                         f"сжатых ответов {prs['framed']}, без сжатия {prs['plain']}")
+        if prs["bad_frames"] or prs["no_json"]:
+            lines.append(f"   ⚠️ битых ответов {prs['bad_frames']}, без JSON {prs['no_json']}")
+        hs = _health.stats
+        lines.append(f"   🩺 отключено пар агент/зонд: {len(_health.broken())}  "
+                     f"пропущено опросов {hs['skipped']}  восстановились {hs['recovered']}  (/health)")
+        lines.append("")
+
+    us = _bulk.stats
+    lines.append(f"<b>📁 Групповые команды:</b> прогонов {us['runs']}  активных {len(_bulk.runs)}  "
+                 f"устройств {us['devices']}  (✅ {us['ok']}  ❌ {us['failed']})")
+    if us["last"]:
+        last = us["last"]
+        lines.append(f"   последний: {last['devices']} уст. за {last['seconds']:.0f} с, "
+                     f"параллельно до {last['peak']} (сейчас {last['limit']}), "
+                     f"таймаутов {last[TIMEOUT]}, ошибок {last[ERROR]}")
+    lines.append("")
+
+    ss = _state.stats
+    db_size = sum(p.stat().st_size for p in STATE_DB_FILE.parent.glob(STATE_DB_FILE.name + "*") if p.is_file())
+    lines.append(f"<b>🗄 Хранилище состояния</b> ({fmt_bytes(db_size)}): транзакций {ss['transactions']}  "
+                 f"записано строк {ss['rows']}  удалено {ss['deletes']}")
+    lines.append(f"   конфиги (admin, алерты): из памяти {_json_cache_stats['hits']}  "
+                 f"прочитано с диска {_json_cache_stats['loads']}")
+    fs = _disk_forecast.stats
+    if fs["runs"]:
+        lines.append(f"   прогноз дисков: расчётов {fs['runs']} (последний {fs['last_ms']:.0f} мс)  из кэша {fs['hits']}")
+    ws = _writes.stats
+    lines.append(f"   отложенная запись (раз в {STATE_FLUSH_SEC} с): отметок {ws['marks']}  "
+                 f"сбросов {ws['flushes']}  строк {ws['rows']}  ждут {_writes.pending()} табл.")
+    ups = _uptime.stats
+    lines.append(f"   аптайм: отрезков {sum(len(r) for r in _uptime.devices.values())}  "
+                 f"отметок {ups['samples']} (продлили отрезок {ups['extended']}, новых {ups['appended']})")
+    lines.append("")
+
+    now = time.time()
+    lines.append(f"<b>⏱ Планировщик</b> (слотов для агентов: {_scheduler.budget}):")
+    for job in _scheduler.jobs:
+        st = job.stats
+        if job.running:
+            when = "▶ выполняется"
+        elif job.next_run == float("inf"):
+            when = "по событию"
+        else:
+            left = max(0, job.next_run - now)
+            when = f"через {fmt_uptime(left)}" if left >= 60 else f"через {left:.0f} с"
+        last = f"{st['last_ms'] / 1000:.1f} с" if st["runs"] else "—"
+        extra = f"  ошибок {st['errors']}" if st["errors"] else ""
+        if st["skipped"]:
+            extra += f"  пропусков {st['skipped']}"
+        lines.append(f"   {'🧱' if job.heavy else '•'} <code>{job.name}</code>: {when}, "
+                     f"последний {last}, запусков {st['runs']}{extra}")
+    return "\n".join(lines)
+
+
+@router.message(Command("perf"))
+async def cmd_perf(msg: Message):
+    if not is_admin(msg.from_user.id):
+        return
+    await msg.answer(_perf_text(), parse_mode="HTML", reply_markup=MAIN_KB)
+
+
+# ─── Probe health ────────────────────────────────────────────────────
+
+_HEALTH_PROBES = {"hw": "💻 Инвентарь", "usb": "🔌 USB", "temp": "🌡 Температура",
+                  "printers": "🖨 Принтеры", "wifi": "📶 Wi-Fi", "snmp": "📡 SNMP"}
+
+
+async def _health_view() -> tuple[str, InlineKeyboardMarkup | None]:
+    broken = _health.broken()
+    hs = _health.stats
+    lines = ["━━━━━━━━━━━━━━━━━━━━━━", "🩺 <b>Здоровье зондов</b>", "━━━━━━━━━━━━━━━━━━━━━━", ""]
+    if not broken:
+        lines.append("✅ Все агенты отвечают, зонды опрашиваются по расписанию.")
+    else:
+        lines.append(f"Агенты, которые перестали отвечать, пропускаются до следующей попытки "
+                     f"(интервал удваивается, после {_health.threshold} сбоев подряд).\n")
+        index = await get_device_index()
+        now = time.time()
+        by_probe: dict[str, list] = {}
+        for h in broken:
+            by_probe.setdefault(h.probe, []).append(h)
+        for probe, items in by_probe.items():
+            lines.append(f"<b>{_HEALTH_PROBES.get(probe, probe)}</b> ({len(items)})")
+            for h in items[:15]:
+                d = index.get(h.node)
+                name = d["name"] if d else h.node
+                when = ("⏳ пробный опрос" if h.state == HALF_OPEN
+                        else f"повтор через {fmt_uptime(max(0, h.retry_at - now))}")
+                err = h.last_error.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+                lines.append(f"  🔴 {name} — сбоев {h.failures}, {when}\n     <i>{err[:80]}</i>")
+            if len(items) > 15:
+                lines.append(f"  … ещё {len(items) - 15}")
+            lines.append("")
+    lines.append(f"Пропущено опросов: {hs['skipped']}  открытий: {hs['opened']}  "
+                 f"восстановились: {hs['recovered']}")
+    if not broken:
+        return "\n".join(lines), None
+    rows = [[InlineKeyboardButton(text="🔄 Опросить всех заново", callback_data="health:reset")]]
+    return "\n".join(lines), InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+@router.message(Command("health"))
+async def cmd_health(msg: Message):
+    if not is_admin(msg.from_user.id):
+        return
+    text, kb = await _health_view()
+    await msg.answer(text, parse_mode="HTML", reply_markup=kb)
+
+
+@router.callback_query(F.data == "tool:health")
+async def cb_tool_health(cb: CallbackQuery):
+    if not is_admin(cb.from_user.id):
+        await cb.answer("🔒", show_alert=True)
+        return
+    await cb.answer()
+    text, kb = await _health_view()
+    await cb.message.answer(text, parse_mode="HTML", reply_markup=kb)
+
+
+@router.callback_query(F.data == "health:reset")
+async def cb_health_reset(cb: CallbackQuery):
+    if not is_admin(cb.from_user.id):
+        await cb.answer("🔒", show_alert=True)
+        return
+    n = _health.reset()
+    await cb.answer(f"Сброшено: {n}. Опрос — в следующем цикле.")
+    text, kb = await _health_view()
+    try:
+        await cb.message.edit_text(text, parse_mode="HTML", reply_markup=kb)
+    except Exception:
+        pass
+
+
 # ─── Tools menu ──────────────────────────────────────────────────────
 
 @router.message(F.text == BTN_TOOLS)
@@ -5852,7 +6196,8 @@ async def msg_tools(msg: Message):
         [InlineKeyboardButton(text="🗄 Полный бэкап сервера", callback_data="tool:fullbackup")],
         [InlineKeyboardButton(text="🆕 Обновления MC", callback_data="tool:update_check"),
          InlineKeyboardButton(text="🔐 SSL сертификаты", callback_data="tool:certs")],
-        [InlineKeyboardButton(text="🚀 Развернуть копию", callback_data="tool:deploy")],
+        [InlineKeyboardButton(text="🚀 Развернуть копию", callback_data="tool:deploy"),
+         InlineKeyboardButton(text="🩺 Здоровье зондов", callback_data="tool:health")],
     ]
     await msg.answer(
         "━━━━━━━━━━━━━━━━━━━━━━\n🔧 <b>Инструменты</b>\n━━━━━━━━━━━━━━━━━━━━━━\n\n"
@@ -5865,6 +6210,8 @@ async def msg_tools(msg: Message):
         "🔔 Алерты — настройка уведомлений\n"
         "🛡 Безопасность — сводка безопасности\n"
         "📈 /top — топ ресурсов\n"
+        "⚙️ /perf — внутренние счётчики бота\n"
+        "🩺 /health — агенты, которые не отвечают зондам\n"
         "📊 Excel — полный отчёт XLSX\n"
         "🗺 Карта сети — устройства по подсетям\n"
         "🔇 /mute &lt;цель&gt; &lt;время&gt; — тех. обслуживание\n"
@@ -6521,8 +6868,7 @@ async def cb_rcmd_ps(cb: CallbackQuery, state: FSMContext):
         await cb.answer("Скрипт не найден", show_alert=True)
         return
     await cb.answer()
-    devs = await get_full_devices()
-    d = next((x for x in devs if x["name"] == dev_name), None)
+    d = (await get_device_index()).by_name(dev_name)
     if not d or not d["online"]:
         await cb.message.answer(f"⚪ <b>{dev_name}</b> офлайн.", parse_mode="HTML")
         return
@@ -6569,8 +6915,7 @@ async def cb_rgrp_ps(cb: CallbackQuery, state: FSMContext):
         await cb.answer("Скрипт не найден", show_alert=True)
         return
     await cb.answer()
-    devs = await get_full_devices()
-    group_devs = [d for d in devs if d.get("group", "").lower() == group_name.lower() and d["online"]]
+    group_devs = [d for d in (await get_device_index()).group(group_name, ignore_case=True) if d["online"]]
     if not group_devs:
         await cb.message.answer(f"❌ Нет онлайн устройств в группе «{group_name}».")
         return
@@ -6579,40 +6924,14 @@ async def cb_rgrp_ps(cb: CallbackQuery, state: FSMContext):
         f"⏳ <b>{script_name}</b> на <b>{len(group_devs)}</b> уст. в <b>{group_name}</b>...",
         parse_mode="HTML",
     )
-    sem = asyncio.Semaphore(5)
-    results = {}
-    async def run_one(d):
-        async with sem:
-            results[d["name"]] = await mc_run_command(d["id"], s["cmd"], powershell=s.get("ps", False))
-    await asyncio.gather(*[run_one(d) for d in group_devs])
-
-    skip_prefixes = ("Microsoft Windows", "(c) ", "C:\\Program Files\\Mesh Agent>")
     lang = "PS" if s.get("ps") else "CMD"
-    lines = [
+    await _run_on_group(
+        wait_msg, group_devs, s["cmd"], s.get("ps", False),
         f"━━━━━━━━━━━━━━━━━━━━━━\n"
-        f"📁 <b>{group_name}</b>  📝 <b>{script_name}</b> [{lang}]  ({len(results)} уст.)\n"
-        f"━━━━━━━━━━━━━━━━━━━━━━\n"
-    ]
-    success = fail = 0
-    for name, output in sorted(results.items()):
-        first_line = ""
-        for line in output.split("\n"):
-            stripped = line.strip()
-            if stripped and not any(stripped.startswith(p) for p in skip_prefixes):
-                if stripped != s["cmd"] and stripped != "exit":
-                    first_line = stripped[:60]
-                    break
-        if "Error" in output:
-            fail += 1
-            lines.append(f"❌ <b>{name}</b>: {first_line}")
-        else:
-            success += 1
-            lines.append(f"✅ <b>{name}</b>: {first_line}")
-    lines.append(f"\n✅ {success}  ❌ {fail}")
-    text = "\n".join(lines)
-    if len(text) > 4000:
-        text = text[:4000] + "\n..."
-    await wait_msg.edit_text(text, parse_mode="HTML")
+        f"📁 <b>{group_name}</b>  📝 <b>{script_name}</b> [{lang}]  ({len(group_devs)} уст.)\n"
+        f"━━━━━━━━━━━━━━━━━━━━━━\n",
+        group_name,
+    )
 
 
 @router.callback_query(F.data == "rcmd_custom")
@@ -6684,8 +7003,7 @@ async def fsm_rcmd_entering_cmd(msg: Message, state: FSMContext):
         await msg.answer("❌ Пустая команда.", reply_markup=MAIN_KB)
         return
 
-    devs = await get_full_devices()
-    d = next((x for x in devs if x["name"] == dev_name), None)
+    d = (await get_device_index()).by_name(dev_name)
     if not d:
         await msg.answer(f"❌ Устройство «{dev_name}» не найдено.", reply_markup=MAIN_KB)
         return
@@ -6740,8 +7058,7 @@ async def fsm_rcmd_entering_gcmd(msg: Message, state: FSMContext):
         await msg.answer("❌ Пустая команда.", reply_markup=MAIN_KB)
         return
 
-    devs = await get_full_devices()
-    group_devs = [d for d in devs if d.get("group", "").lower() == group_name.lower() and d["online"]]
+    group_devs = [d for d in (await get_device_index()).group(group_name, ignore_case=True) if d["online"]]
     if not group_devs:
         await msg.answer(f"❌ Нет онлайн устройств в группе «{group_name}».", reply_markup=MAIN_KB)
         return
@@ -6751,47 +7068,15 @@ async def fsm_rcmd_entering_gcmd(msg: Message, state: FSMContext):
         parse_mode="HTML",
     )
 
-    sem = asyncio.Semaphore(5)
-    results = {}
-
-    async def run_one(d):
-        async with sem:
-            result = await mc_run_command(d["id"], command, powershell=powershell)
-            results[d["name"]] = result
-
-    await asyncio.gather(*[run_one(d) for d in group_devs])
-
     lang = "PS" if powershell else "CMD"
-    lines = [
+    await _run_on_group(
+        wait_msg, group_devs, command, powershell,
         f"━━━━━━━━━━━━━━━━━━━━━━\n"
-        f"📁 <b>Группа: {group_name}</b> ({len(results)} уст.) [{lang}]\n"
+        f"📁 <b>Группа: {group_name}</b> ({len(group_devs)} уст.) [{lang}]\n"
         f"━━━━━━━━━━━━━━━━━━━━━━\n"
-        f"<code>$ {command}</code>\n"
-    ]
-
-    skip_prefixes = ("Microsoft Windows", "(c) ", "C:\\Program Files\\Mesh Agent>")
-    success = 0
-    fail = 0
-    for name, output in sorted(results.items()):
-        first_line = ""
-        for line in output.split("\n"):
-            stripped = line.strip()
-            if stripped and not any(stripped.startswith(p) for p in skip_prefixes):
-                if stripped != command and stripped != "exit":
-                    first_line = stripped[:60]
-                    break
-        if "Error" in output:
-            fail += 1
-            lines.append(f"❌ <b>{name}</b>: {first_line}")
-        else:
-            success += 1
-            lines.append(f"✅ <b>{name}</b>: {first_line}")
-
-    lines.append(f"\n✅ {success}  ❌ {fail}")
-    text = "\n".join(lines)
-    if len(text) > 4000:
-        text = text[:4000] + "\n..."
-    await wait_msg.edit_text(text, parse_mode="HTML")
+        f"<code>$ {command}</code>\n",
+        group_name,
+    )
 
 
 @router.callback_query(F.data == "tool:xlsx")
@@ -7020,11 +7305,11 @@ _PRINTER_SCAN_CMD = (
 
 
 def _load_printers() -> dict:
-    return _load_json(PRINTERS_FILE, {})
+    return _state.doc("printers").all()
 
 
 def _save_printers(data: dict):
-    _save_json(PRINTERS_FILE, data)
+    _state.doc("printers").replace(data)
 
 
 def _printer_status_str(status) -> str:
@@ -7071,20 +7356,27 @@ def _ink_bar(pct: int) -> str:
 
 
 def _load_ink_alerts() -> dict:
-    return _load_json(INK_ALERTS_FILE, {})
+    return _state.doc("ink_alerts").all()
 
 
 def _save_ink_alerts(data: dict):
-    _save_json(INK_ALERTS_FILE, data)
+    _state.doc("ink_alerts").replace(data)
 
 
-def _get_printer_scan_cmd() -> str:
-    """Return PowerShell command: use printer_ink.ps1 if available, else basic fallback."""
+def _printer_scan_runner():
+    """Per-device runner for the printer scan: printer_ink.ps1 if available, else basic fallback."""
     if PRINTER_INK_PS1.exists():
-        return PRINTER_INK_PS1.read_text(encoding="utf-8")
-    return (
+        async def run(d, timeout: float) -> str:
+            out = await _probes.run(d["id"], _probe_bundle, {"Sections": "printers"}, timeout=timeout)
+            part = parse_bundle(out).get("printers") or {}
+            if not part.get("ok"):
+                raise RuntimeError(part.get("error") or "нет результата printer_ink.ps1")
+            return part["out"].strip()
+        return run
+    return _bulk_command(
         "Get-Printer | Select-Object Name, DriverName, PortName, PrinterStatus, Shared, "
-        "@{N='Default';E={$_.Attributes -band 4 -gt 0}} | ConvertTo-Json -Compress"
+        "@{N='Default';E={$_.Attributes -band 4 -gt 0}} | ConvertTo-Json -Compress",
+        powershell=True,
     )
 
 
@@ -7196,6 +7488,64 @@ async def cb_tool_printers(cb: CallbackQuery):
     )
 
 
+def _parse_printer_scan(raw: str) -> list[dict]:
+    """Printers from the JSON the printer scan command prints on one device."""
+    printers = []
+    try:
+        data = extract_json(raw)
+        if isinstance(data, dict):
+            # PS5 wraps arrays as {"value": [...], "Count": N} — unwrap it
+            if "value" in data and isinstance(data.get("value"), list):
+                data = data["value"]
+            else:
+                data = [data]
+        if not isinstance(data, list):
+            data = []
+        for p in data:
+            pname = (p.get("Name") or "").strip()
+            # Skip empty names and garbled names (OEM CP437 artifacts U+0080–U+00FF)
+            if not pname or any('\u0080' <= c <= '\u00FF' for c in pname):
+                continue
+
+            # Python-side virtual detection (fallback when PS1 couldn't detect)
+            _VIRT_KW = ("anydesk", "pdf", "xps", "microsoft", "onenote",
+                        "fax", "cutepdf", "adobe", "bullzip", "nitro",
+                        "biztalk", "generic / text only", "send to onenote",
+                        "pdfcreator", "doro", "docuworks")
+            drv_low = p.get("DriverName", "").lower()
+            is_virtual = bool(p.get("IsVirtual", False)) or any(kw in drv_low for kw in _VIRT_KW)
+
+            # Parse supplies from SNMP result
+            raw_supplies = p.get("Supplies") or []
+            supplies = []
+            for s in raw_supplies:
+                if not isinstance(s, dict):
+                    continue
+                pct = s.get("pct", -1)
+                if pct is None:
+                    pct = -1
+                supplies.append({
+                    "desc": str(s.get("desc", "")),
+                    "cur":  int(s.get("cur", 0)),
+                    "max":  int(s.get("max", 0)),
+                    "pct":  int(pct),
+                })
+            printers.append({
+                "name":       pname,
+                "driver":     p.get("DriverName", ""),
+                "port":       p.get("PortName", ""),
+                "status":     p.get("PrinterStatus", 0),
+                "shared":     bool(p.get("Shared")),
+                "default":    bool(p.get("Default")),
+                "is_virtual": is_virtual,
+                "printer_ip": p.get("PrinterIP", ""),
+                "supplies":   supplies,
+            })
+    except Exception:
+        pass  # device returned garbage / no printers
+    return printers
+
+
 @router.callback_query(F.data.startswith("prn:scan:"))
 async def cb_prn_scan(cb: CallbackQuery):
     if not is_admin(cb.from_user.id):
@@ -7204,8 +7554,7 @@ async def cb_prn_scan(cb: CallbackQuery):
     await cb.answer()
     group_name = cb.data[len("prn:scan:"):]
 
-    devs = await get_full_devices()
-    group_devs = [d for d in devs if d.get("group", "").lower() == group_name.lower() and d["online"]]
+    group_devs = [d for d in (await get_device_index()).group(group_name, ignore_case=True) if d["online"]]
     if not group_devs:
         await cb.message.answer(f"❌ Нет онлайн устройств в группе «{group_name}».")
         return
@@ -7216,68 +7565,32 @@ async def cb_prn_scan(cb: CallbackQuery):
         parse_mode="HTML",
     )
 
-    sem = asyncio.Semaphore(5)
-    results: dict[str, list] = {}
+    run = _bulk.start(group_devs, _printer_scan_runner(), timeout=30, deadline=BULK_DEADLINE_SEC)
+    parsed: dict[int, list] = {}   # id(result) → printers, parsed once as results arrive
 
-    async def scan_one(d):
-        async with sem:
-            raw = await mc_run_command(d["id"], _get_printer_scan_cmd(), powershell=True)
-            printers = []
-            try:
-                data = json.loads(raw)
-                if isinstance(data, dict):
-                    # PS5 wraps arrays as {"value": [...], "Count": N} — unwrap it
-                    if "value" in data and isinstance(data.get("value"), list):
-                        data = data["value"]
-                    else:
-                        data = [data]
-                if not isinstance(data, list):
-                    data = []
-                for p in data:
-                    pname = (p.get("Name") or "").strip()
-                    # Skip empty names and garbled names (OEM CP437 artifacts U+0080–U+00FF)
-                    if not pname or any('\u0080' <= c <= '\u00FF' for c in pname):
-                        continue
-
-                    # Python-side virtual detection (fallback when PS1 couldn't detect)
-                    _VIRT_KW = ("anydesk", "pdf", "xps", "microsoft", "onenote",
-                                "fax", "cutepdf", "adobe", "bullzip", "nitro",
-                                "biztalk", "generic / text only", "send to onenote",
-                                "pdfcreator", "doro", "docuworks")
-                    drv_low = p.get("DriverName", "").lower()
-                    is_virtual = bool(p.get("IsVirtual", False)) or any(kw in drv_low for kw in _VIRT_KW)
-
-                    # Parse supplies from SNMP result
-                    raw_supplies = p.get("Supplies") or []
-                    supplies = []
-                    for s in raw_supplies:
-                        if not isinstance(s, dict):
-                            continue
-                        pct = s.get("pct", -1)
-                        if pct is None:
-                            pct = -1
-                        supplies.append({
-                            "desc": str(s.get("desc", "")),
-                            "cur":  int(s.get("cur", 0)),
-                            "max":  int(s.get("max", 0)),
-                            "pct":  int(pct),
-                        })
-                    printers.append({
-                        "name":       pname,
-                        "driver":     p.get("DriverName", ""),
-                        "port":       p.get("PortName", ""),
-                        "status":     p.get("PrinterStatus", 0),
-                        "shared":     bool(p.get("Shared")),
-                        "default":    bool(p.get("Default")),
-                        "is_virtual": is_virtual,
-                        "printer_ip": p.get("PrinterIP", ""),
-                        "supplies":   supplies,
-                    })
-            except Exception:
-                pass  # device returned error / no printers
-            results[d["name"]] = printers
-
-    await asyncio.gather(*[scan_one(d) for d in group_devs])
+    def live() -> str:
+        lines = []
+        for res in reversed(run.results):
+            if not res.ok:
+                lines.append(f"{_BULK_STATE_ICONS[res.state]} <b>{res.device['name']}</b>: {_bulk_first_line(res, '')}")
+                continue
+            prlist = parsed.get(id(res))
+            if prlist is None:
+                prlist = parsed[id(res)] = _parse_printer_scan(res.output)
+            real = sum(1 for p in prlist if not p.get("is_virtual"))
+            lines.append(f"🖥 <b>{res.device['name']}</b>: принтеров {real}")
+        head = (f"🖨 <b>Принтеры — {group_name}</b>\n"
+                f"{_bulk_status(run, sum(r.ok for r in run.results))}\n")
+        return _bulk_fit(head, lines)
+
+    all_results = await _bulk_stream(wait_msg, run, live)
+    results: dict[str, list] = {}
+    failed: dict[str, str] = {}   # device → why it has no result (its saved printers are kept)
+    for res in all_results:
+        if res.ok:
+            results[res.device["name"]] = parsed.get(id(res)) or _parse_printer_scan(res.output)
+        else:
+            failed[res.device["name"]] = f"{_BULK_STATE_ICONS[res.state]} {_bulk_first_line(res, '')}"
 
     # Save to db
     printers_db = _load_printers()
@@ -7319,11 +7632,18 @@ async def cb_prn_scan(cb: CallbackQuery):
                 vnames = ", ".join(p.get("name", "?")[:22] for p in virtual[:3])
                 more   = f" +{len(virtual)-3}" if len(virtual) > 3 else ""
                 lines.append(f"     <i>⚪ скрыто: {vnames}{more}</i>")
+    for dev_name, why in sorted(failed.items()):
+        lines.append(f"\n🖥 <b>{dev_name}</b>  {why}")
 
     text = "\n".join(lines)
-    if len(text) > 4000:
-        text = text[:4000] + "\n..."
-    await wait_msg.edit_text(text, parse_mode="HTML")
+    if len(text) <= 4000:
+        await wait_msg.edit_text(text, parse_mode="HTML")
+        return
+    await wait_msg.edit_text(_bulk_fit(lines[0], lines[1:], "\n📎 Полный вывод — в файле"), parse_mode="HTML")
+    await wait_msg.answer_document(
+        _bulk_output_file(all_results, f"Принтеры — {group_name}", f"printers_{group_name}"),
+        caption=f"🖨 {group_name}: вывод {len(all_results)} устройств",
+    )
 
 
 @router.callback_query(F.data == "prn:clear")
@@ -7525,377 +7845,429 @@ async def cb_mc_update_go(cb: CallbackQuery):
 
 # ─── Background tasks ───────────────────────────────────────────────
 
-async def health_loop():
+async def health_job():
+    """MeshCentral liveness (restart on failure) and HTTP service checks."""
     global _mc_was_down, _http_down
-    await asyncio.sleep(15)
-    while not _shutdown_event.is_set():
-        try:
-            aid = get_admin_id()
-            alive = await mc_is_alive()
-            if not alive and not _mc_was_down:
-                _mc_was_down = True
-                await mc_restart()
-                if aid:
-                    try:
-                        await bot.send_message(aid, "🔴 <b>MeshCentral упал!</b> Перезапуск...", parse_mode="HTML")
-                    except Exception:
-                        pass
-                await asyncio.sleep(20)
-                if await mc_is_alive():
-                    _mc_was_down = False
-                    if aid:
-                        try:
-                            await bot.send_message(aid, "🟢 MeshCentral восстановлен.", parse_mode="HTML")
-                        except Exception:
-                            pass
-            elif alive and _mc_was_down:
-                _mc_was_down = False
-                if aid:
-                    try:
-                        await bot.send_message(aid, "🟢 MeshCentral работает.", parse_mode="HTML")
-                    except Exception:
-                        pass
-
-            # ── HTTP services healthcheck ──
+    aid = get_admin_id()
+    alive = await mc_is_alive()
+    if not alive and not _mc_was_down:
+        _mc_was_down = True
+        await mc_restart()
+        if aid:
+            try:
+                await bot.send_message(aid, "🔴 <b>MeshCentral упал!</b> Перезапуск...", parse_mode="HTML")
+            except Exception:
+                pass
+        await asyncio.sleep(20)
+        if await mc_is_alive():
+            _mc_was_down = False
             if aid:
-                http_results = await check_all_http_services()
-                for r in http_results:
-                    name = r["name"]
-                    ok   = r["ok"]
-                    was_down = _http_down.get(name, False)
-                    if not ok and not was_down:
-                        _http_down[name] = True
-                        status_str = f" (HTTP {r['status']})" if r["status"] else " (недоступен)"
-                        try:
-                            await bot.send_message(
-                                aid,
-                                f"🔴 <b>{name}</b> недоступен!{status_str}\n"
-                                f"<code>{r['url']}</code>",
-                                parse_mode="HTML",
-                            )
-                        except Exception:
-                            pass
-                    elif ok and was_down:
-                        _http_down[name] = False
-                        try:
-                            await bot.send_message(
-                                aid,
-                                f"🟢 <b>{name}</b> восстановлен.",
-                                parse_mode="HTML",
-                            )
-                        except Exception:
-                            pass
-                    else:
-                        _http_down[name] = not ok
-        except Exception as e:
-            log.error(f"Health: {e}")
-        try:
-            await asyncio.wait_for(_shutdown_event.wait(), timeout=HEALTH_CHECK_INTERVAL)
-            break
-        except asyncio.TimeoutError:
-            pass
+                try:
+                    await bot.send_message(aid, "🟢 MeshCentral восстановлен.", parse_mode="HTML")
+                except Exception:
+                    pass
+    elif alive and _mc_was_down:
+        _mc_was_down = False
+        if aid:
+            try:
+                await bot.send_message(aid, "🟢 MeshCentral работает.", parse_mode="HTML")
+            except Exception:
+                pass
 
+    # ── HTTP services healthcheck ──
+    if aid:
+        http_results = await check_all_http_services()
+        for r in http_results:
+            name = r["name"]
+            ok   = r["ok"]
+            was_down = _http_down.get(name, False)
+            if not ok and not was_down:
+                _http_down[name] = True
+                status_str = f" (HTTP {r['status']})" if r["status"] else " (недоступен)"
+                try:
+                    await bot.send_message(
+                        aid,
+                        f"🔴 <b>{name}</b> недоступен!{status_str}\n"
+                        f"<code>{r['url']}</code>",
+                        parse_mode="HTML",
+                    )
+                except Exception:
+                    pass
+            elif ok and was_down:
+                _http_down[name] = False
+                try:
+                    await bot.send_message(
+                        aid,
+                        f"🟢 <b>{name}</b> восстановлен.",
+                        parse_mode="HTML",
+                    )
+                except Exception:
+                    pass
+            else:
+                _http_down[name] = not ok
 
-async def device_loop():
-    global _known_devices
-    await asyncio.sleep(25)
-    try:
-        for d in await get_full_devices():
-            _known_devices[d["id"]] = {"name": d["name"], "online": d["online"]}
-    except Exception:
-        pass
 
-    while not _shutdown_event.is_set():
-        try:
-            aid = get_admin_id()
-            if not aid:
-                await asyncio.sleep(DEVICE_CHECK_INTERVAL)
-                continue
+def _on_presence_change(node_id: str, online: bool):
+    """PresenceTracker listener: invalidate the device snapshot, refresh soon.
+    A quick reconnect within PRESENCE_DEBOUNCE_SEC nets out to no event."""
+    global _online_cache_gen
+    _online_cache_gen += 1
+    _scheduler.wake("devices", PRESENCE_DEBOUNCE_SEC)
 
-            devs = await get_full_devices()
-            cfg = load_alerts_cfg()
-            cur = {d["id"]: d for d in devs}
 
-            for did, d in cur.items():
-                prev = _known_devices.get(did)
-                if is_muted(d["name"], d.get("group", "")):
-                    continue
-                if prev is None:
-                    if cfg.get("new_device", True):
-                        try:
-                            await bot.send_message(
-                                aid,
-                                f"🆕 <b>Новое устройство:</b> {d['name']}\n💻 {d['os']}\n🌐 {d['ip']}",
-                                parse_mode="HTML",
-                                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                                    [InlineKeyboardButton(text="❓ Что делать?", callback_data="help:new_device")],
-                                ]),
-                            )
-                        except Exception:
-                            pass
-                elif d["online"] and not prev["online"]:
-                    try:
-                        await bot.send_message(
-                            aid,
-                            f"🟢 <b>{d['name']}</b> подключился\n   <code>{d['ip']}</code>",
-                            parse_mode="HTML",
-                        )
-                    except Exception:
-                        pass
-                elif not d["online"] and prev["online"]:
-                    try:
-                        await bot.send_message(
-                            aid, f"⚪ <b>{d['name']}</b> отключился", parse_mode="HTML",
-                        )
-                    except Exception:
-                        pass
+async def device_refresh_job():
+    """The device refresh producer: every new refresh is published on
+    _device_bus (see _device_snapshot)."""
+    await _device_snapshot()
 
-            # ─ Condition alerts ─
-            alerts_sent = _load_json(DATA_DIR / "alerts_sent.json", {})
-            today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
 
-            for d in devs:
-                if is_muted(d["name"], d.get("group", "")):
-                    continue
-                alert_key = f"{d['name']}_{today}"
-
-                # Disk alert
-                if d.get("vol_alerts") and cfg.get("disk_pct"):
-                    dk = f"disk_{alert_key}"
-                    if dk not in alerts_sent:
-                        alerts_sent[dk] = True
-                        try:
-                            await bot.send_message(
-                                aid,
-                                f"💿 <b>Диск заполнен:</b> {d['name']}\n{', '.join(d['vol_alerts'])}",
-                                parse_mode="HTML",
-                                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                                    [InlineKeyboardButton(text="❓ Что делать?", callback_data="help:disk")],
-                                ]),
-                            )
-                        except Exception:
-                            pass
-
-                # AV disabled alert
-                if d.get("av_disabled") and cfg.get("av_off"):
-                    ak = f"av_{alert_key}"
-                    if ak not in alerts_sent:
-                        alerts_sent[ak] = True
-                        try:
-                            await bot.send_message(
-                                aid,
-                                f"🛡 <b>Антивирус выключен:</b> {d['name']}\n{d['antivirus']}",
-                                parse_mode="HTML",
-                                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                                    [InlineKeyboardButton(text="❓ Что делать?", callback_data="help:av")],
-                                ]),
-                            )
-                        except Exception:
-                            pass
-
-                # Long offline alert
-                if d.get("offline_hours", 0) >= cfg.get("offline_hours", 24):
-                    ok = f"offline_{alert_key}"
-                    if ok not in alerts_sent:
-                        alerts_sent[ok] = True
-                        try:
-                            await bot.send_message(
-                                aid,
-                                f"⏰ <b>Долго офлайн:</b> {d['name']} ({fmt_offline(d['offline_hours'])})",
-                                parse_mode="HTML",
-                                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                                    [InlineKeyboardButton(text="❓ Что делать?", callback_data="help:offline")],
-                                ]),
-                            )
-                        except Exception:
-                            pass
-
-            # cleanup old alerts (keep only today)
-            alerts_sent = {k: v for k, v in alerts_sent.items() if today in k}
-            _save_json(DATA_DIR / "alerts_sent.json", alerts_sent)
-
-            # record uptime
-            record_uptime(devs)
-
-            _known_devices = {did: {"name": d["name"], "online": d["online"]} for did, d in cur.items()}
-        except Exception as e:
-            log.error(f"DevMon: {e}")
-        try:
-            await asyncio.wait_for(_shutdown_event.wait(), timeout=DEVICE_CHECK_INTERVAL)
-            break
-        except asyncio.TimeoutError:
-            pass
+async def device_alerts_job():
+    """New-device and connect/disconnect alerts for the events queued by the bus."""
+    batch = _device_alerts[:]
+    _device_alerts.clear()
+    aid = get_admin_id()
+    if not aid:
+        return
+    cfg = load_alerts_cfg()
+    for ev in batch:
+        await _device_event_alert(aid, ev, cfg)
 
 
-async def scheduled_loop():
-    global _last_inventory_date, _last_daily_report, _last_weekly_digest, _last_update_check
-    await asyncio.sleep(30)
-    while not _shutdown_event.is_set():
-        try:
-            aid = get_admin_id()
-            now = datetime.now(timezone.utc)
-            today = now.strftime("%Y-%m-%d")
-
-            if now.hour == INVENTORY_HOUR and _last_inventory_date != today and aid:
-                _last_inventory_date = today
-                devs = await get_full_devices()
-                if devs:
-                    # save snapshot for change tracking
-                    save_snapshot(devs)
-                    save_snap_history(devs)
-                    save_disk_snapshot(devs)
-                    try:
-                        await bot.send_document(
-                            aid,
-                            BufferedInputFile(build_inventory_csv(devs), filename=f"inventory_{today}.csv"),
-                            caption=f"📦 <b>Авто-инвентарь</b> {today} • {len(devs)} устройств",
-                            parse_mode="HTML",
-                        )
-                    except Exception:
-                        pass
+async def _device_event_alert(aid: int, ev: DeviceEvent, cfg: dict):
+    """New-device and connect/disconnect alerts."""
+    d = ev.device
+    if is_muted(d["name"], d.get("group", "")):
+        return
+    try:
+        if ev.kind == ADDED:
+            if cfg.get("new_device", True):
+                await bot.send_message(
+                    aid,
+                    f"🆕 <b>Новое устройство:</b> {d['name']}\n💻 {d['os']}\n🌐 {d['ip']}",
+                    parse_mode="HTML",
+                    reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                        [InlineKeyboardButton(text="❓ Что делать?", callback_data="help:new_device")],
+                    ]),
+                )
+        elif d["online"]:
+            await bot.send_message(
+                aid,
+                f"🟢 <b>{d['name']}</b> подключился\n   <code>{d['ip']}</code>",
+                parse_mode="HTML",
+            )
+        else:
+            await bot.send_message(
+                aid, f"⚪ <b>{d['name']}</b> отключился", parse_mode="HTML",
+            )
+    except Exception:
+        pass
+
+
+async def device_conditions_job():
+    """Disk / AV / long-offline alerts (once a day each) and the uptime sample."""
+    aid = get_admin_id()
+    if not aid:
+        return
+    devs = await get_full_devices()
+    cfg = load_alerts_cfg()
+    alerts_sent = _alerts_sent
+    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
 
-            if now.hour == DAILY_REPORT_HOUR and _last_daily_report != today and aid:
-                _last_daily_report = today
-                devs = await get_full_devices()
-                online = sum(1 for d in devs if d["online"])
-                cpu = psutil.cpu_percent(interval=0.5)
-                mem = psutil.virtual_memory()
-
-                # detect changes
-                changes = detect_changes(devs)
-                changes_str = ""
-                if changes:
-                    changes_str = "\n\n📜 <b>Изменения:</b>\n" + "\n".join(changes[:10])
-
-                # device alerts summary
-                alert_lines = []
-                cfg = load_alerts_cfg()
-                for d in devs:
-                    if d.get("vol_alerts"):
-                        alert_lines.append(f"  💿 {d['name']}: {', '.join(d['vol_alerts'])}")
-                    if d.get("av_disabled"):
-                        alert_lines.append(f"  🛡 {d['name']}: AV выключен")
-                    if d.get("offline_hours", 0) >= cfg.get("offline_hours", 24):
-                        alert_lines.append(f"  ⏰ {d['name']}: офлайн {fmt_offline(d['offline_hours'])}")
-                alerts_str = ""
-                if alert_lines:
-                    alerts_str = "\n\n⚠️ <b>Проблемы:</b>\n" + "\n".join(alert_lines[:10])
-
-                # SSL cert status in daily report
-                ssl_str = ""
-                if _ssl_cache:
-                    ssl_warn = [r for r in _ssl_cache if not r["ok"] or r["days_left"] <= SSL_WARN_DAYS]
-                    if ssl_warn:
-                        ssl_str = "\n\n🔐 <b>SSL:</b>\n" + ssl_status_text(ssl_warn)
+    for d in devs:
+        if is_muted(d["name"], d.get("group", "")):
+            continue
+        alert_key = f"{d['name']}_{today}"
+
+        # Disk alert
+        if d.get("vol_alerts") and cfg.get("disk_pct"):
+            dk = f"disk_{alert_key}"
+            if dk not in alerts_sent:
+                alerts_sent[dk] = True
+                _writes.mark("alerts_sent", dk)
+                try:
+                    await bot.send_message(
+                        aid,
+                        f"💿 <b>Диск заполнен:</b> {d['name']}\n{', '.join(d['vol_alerts'])}",
+                        parse_mode="HTML",
+                        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                            [InlineKeyboardButton(text="❓ Что делать?", callback_data="help:disk")],
+                        ]),
+                    )
+                except Exception:
+                    pass
 
+        # AV disabled alert
+        if d.get("av_disabled") and cfg.get("av_off"):
+            ak = f"av_{alert_key}"
+            if ak not in alerts_sent:
+                alerts_sent[ak] = True
+                _writes.mark("alerts_sent", ak)
                 try:
                     await bot.send_message(
                         aid,
-                        f"━━━━━━━━━━━━━━━━━━━━━━\n📋 <b>Отчёт {today}</b>\n━━━━━━━━━━━━━━━━━━━━━━\n\n"
-                        f"📱 Устройств: {len(devs)} (🟢 {online})\n"
-                        f"🧠 CPU: {cpu:.0f}% 💾 RAM: {mem.percent:.0f}%\n"
-                        f"🛡 MC: {'🟢' if await mc_is_alive() else '🔴'}"
-                        f"{changes_str}{alerts_str}{ssl_str}",
+                        f"🛡 <b>Антивирус выключен:</b> {d['name']}\n{d['antivirus']}",
                         parse_mode="HTML",
+                        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                            [InlineKeyboardButton(text="❓ Что делать?", callback_data="help:av")],
+                        ]),
                     )
                 except Exception:
                     pass
-                # save snapshot after report
-                save_snapshot(devs)
-                save_snap_history(devs)
-
-            # ── Weekly digest (Sunday) ──
-            if now.weekday() == 6 and now.hour == WEEKLY_DIGEST_HOUR and _last_weekly_digest != today and aid:
-                _last_weekly_digest = today
-                devs = await get_full_devices()
-                if devs:
-                    await _send_weekly_digest(aid, devs)
-
-            # ── Daily update check ──
-            if now.hour == UPDATE_CHECK_HOUR and _last_update_check != today and aid:
-                _last_update_check = today
-                info = await check_mc_update()
-                if info["has_update"]:
-                    try:
-                        await bot.send_message(
-                            aid,
-                            f"\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\n"
-                            f"\U0001f195 <b>Обновление MeshCentral!</b>\n"
-                            f"\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\n\n"
-                            f"\U0001f4e6 Текущая: <b>{info['current']}</b>\n"
-                            f"\U0001f680 Новая: <b>{info['latest']}</b>",
-                            parse_mode="HTML",
-                            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                                [InlineKeyboardButton(text="🔄 Обновить сейчас", callback_data="mc:update")],
-                            ]),
-                        )
-                    except Exception:
-                        pass
-        except Exception as e:
-            log.error(f"Sched: {e}")
+
+        # Long offline alert
+        if d.get("offline_hours", 0) >= cfg.get("offline_hours", 24):
+            ok = f"offline_{alert_key}"
+            if ok not in alerts_sent:
+                alerts_sent[ok] = True
+                _writes.mark("alerts_sent", ok)
+                try:
+                    await bot.send_message(
+                        aid,
+                        f"⏰ <b>Долго офлайн:</b> {d['name']} ({fmt_offline(d['offline_hours'])})",
+                        parse_mode="HTML",
+                        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                            [InlineKeyboardButton(text="❓ Что делать?", callback_data="help:offline")],
+                        ]),
+                    )
+                except Exception:
+                    pass
+
+    # cleanup old alerts (keep only today)
+    old = [k for k in alerts_sent if today not in k]
+    for k in old:
+        del alerts_sent[k]
+    if old:
+        _writes.mark("alerts_sent", *old)
+
+    # record uptime
+    record_uptime(devs)
+
+
+async def state_flush_job():
+    """Write the in-memory data the polls marked changed (see WriteBehind)."""
+    rows = _writes.flush()
+    if rows:
+        log.debug(f"state flush: {rows} rows")
+
+
+async def inventory_job():
+    """Daily inventory: snapshots for change tracking + CSV to the admin."""
+    aid = get_admin_id()
+    if not aid:
+        return
+    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    devs = await get_full_devices()
+    if devs:
+        # save snapshot for change tracking
+        save_snapshot(devs)
+        save_snap_history(devs)
+        save_disk_snapshot(devs)
         try:
-            await asyncio.wait_for(_shutdown_event.wait(), timeout=60)
-            break
-        except asyncio.TimeoutError:
+            await bot.send_document(
+                aid,
+                BufferedInputFile(build_inventory_csv(devs), filename=f"inventory_{today}.csv"),
+                caption=f"📦 <b>Авто-инвентарь</b> {today} • {len(devs)} устройств",
+                parse_mode="HTML",
+            )
+        except Exception:
             pass
 
 
-async def ssl_check_loop():
-    global _last_ssl_check, _ssl_cache
-    await asyncio.sleep(60)  # дать боту запустится
-    while not _shutdown_event.is_set():
+async def daily_report_job():
+    """Daily report: devices, server load, changes, problems, SSL."""
+    aid = get_admin_id()
+    if not aid:
+        return
+    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    devs = await get_full_devices()
+    online = sum(1 for d in devs if d["online"])
+    cpu = psutil.cpu_percent(interval=0.5)
+    mem = psutil.virtual_memory()
+
+    # detect changes
+    changes = detect_changes(devs)
+    changes_str = ""
+    if changes:
+        changes_str = "\n\n📜 <b>Изменения:</b>\n" + "\n".join(changes[:10])
+
+    # device alerts summary
+    alert_lines = []
+    cfg = load_alerts_cfg()
+    for d in devs:
+        if d.get("vol_alerts"):
+            alert_lines.append(f"  💿 {d['name']}: {', '.join(d['vol_alerts'])}")
+        if d.get("av_disabled"):
+            alert_lines.append(f"  🛡 {d['name']}: AV выключен")
+        if d.get("offline_hours", 0) >= cfg.get("offline_hours", 24):
+            alert_lines.append(f"  ⏰ {d['name']}: офлайн {fmt_offline(d['offline_hours'])}")
+    alerts_str = ""
+    if alert_lines:
+        alerts_str = "\n\n⚠️ <b>Проблемы:</b>\n" + "\n".join(alert_lines[:10])
+
+    # SSL cert status in daily report
+    ssl_str = ""
+    if _ssl_cache:
+        ssl_warn = [r for r in _ssl_cache if not r["ok"] or r["days_left"] <= SSL_WARN_DAYS]
+        if ssl_warn:
+            ssl_str = "\n\n🔐 <b>SSL:</b>\n" + ssl_status_text(ssl_warn)
+
+    try:
+        await bot.send_message(
+            aid,
+            f"━━━━━━━━━━━━━━━━━━━━━━\n📋 <b>Отчёт {today}</b>\n━━━━━━━━━━━━━━━━━━━━━━\n\n"
+            f"📱 Устройств: {len(devs)} (🟢 {online})\n"
+            f"🧠 CPU: {cpu:.0f}% 💾 RAM: {mem.percent:.0f}%\n"
+            f"🛡 MC: {'🟢' if await mc_is_alive() else '🔴'}"
+            f"{changes_str}{alerts_str}{ssl_str}",
+            parse_mode="HTML",
+        )
+    except Exception:
+        pass
+    # save snapshot after report
+    save_snapshot(devs)
+    save_snap_history(devs)
+
+
+async def weekly_digest_job():
+    """Sunday digest (see _send_weekly_digest)."""
+    aid = get_admin_id()
+    if not aid:
+        return
+    devs = await get_full_devices()
+    if devs:
+        await _send_weekly_digest(aid, devs)
+
+
+async def update_check_job():
+    """Daily check for a new MeshCentral release."""
+    aid = get_admin_id()
+    if not aid:
+        return
+    info = await check_mc_update()
+    if info["has_update"]:
         try:
-            aid = get_admin_id()
-            now = datetime.now(timezone.utc)
-            today = now.strftime("%Y-%m-%d")
-            if (now.hour == SSL_CHECK_HOUR and _last_ssl_check != today) or not _ssl_cache:
-                _last_ssl_check = today
-                results = await check_all_ssl()
-                _ssl_cache = results
-                # отправить алерт только если есть проблемы
-                problems = [r for r in results if not r["ok"] or r["days_left"] <= SSL_WARN_DAYS]
-                if problems and aid:
-                    lines = ssl_status_text(problems)
-                    crit = any(not r["ok"] or r["days_left"] <= SSL_CRIT_DAYS for r in problems)
-                    header = "🔴 <b>SSL КРИТИЧНО</b>" if crit else "🟡 <b>SSL предупреждение</b>"
-                    try:
-                        await bot.send_message(
-                            aid,
-                            f"━━━━━━━━━━━━━━━━━━━━━━\n{header}\n━━━━━━━━━━━━━━━━━━━━━━\n\n{lines}\n\n"
-                            f"🔐 /certs — проверить все сертификаты",
-                            parse_mode="HTML",
-                        )
-                    except Exception:
-                        pass
-        except Exception as e:
-            log.error(f"ssl_check_loop: {e}")
+            await bot.send_message(
+                aid,
+                f"\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\n"
+                f"\U0001f195 <b>Обновление MeshCentral!</b>\n"
+                f"\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\u2500\n\n"
+                f"\U0001f4e6 Текущая: <b>{info['current']}</b>\n"
+                f"\U0001f680 Новая: <b>{info['latest']}</b>",
+                parse_mode="HTML",
+                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                    [InlineKeyboardButton(text="🔄 Обновить сейчас", callback_data="mc:update")],
+                ]),
+            )
+        except Exception:
+            pass
+
+
+async def ssl_check_job():
+    """Check SSL certificates; alert only when something is close to expiry."""
+    global _ssl_cache
+    aid = get_admin_id()
+    results = await check_all_ssl()
+    _ssl_cache = results
+    # отправить алерт только если есть проблемы
+    problems = [r for r in results if not r["ok"] or r["days_left"] <= SSL_WARN_DAYS]
+    if problems and aid:
+        lines = ssl_status_text(problems)
+        crit = any(not r["ok"] or r["days_left"] <= SSL_CRIT_DAYS for r in problems)
+        header = "🔴 <b>SSL КРИТИЧНО</b>" if crit else "🟡 <b>SSL предупреждение</b>"
         try:
-            await asyncio.wait_for(_shutdown_event.wait(), timeout=3600)
-            break
-        except asyncio.TimeoutError:
+            await bot.send_message(
+                aid,
+                f"━━━━━━━━━━━━━━━━━━━━━━\n{header}\n━━━━━━━━━━━━━━━━━━━━━━\n\n{lines}\n\n"
+                f"🔐 /certs — проверить все сертификаты",
+                parse_mode="HTML",
+            )
+        except Exception:
             pass
 
 
+def _load_background_state():
+    """Persisted data of the background jobs."""
+    global _hw_inventory, _temp_data, _snmp_data
+    _state.migrate_json({
+        "uptime": UPTIME_FILE, "snapshots": SNAPSHOTS_FILE, "snap_history": SNAP_HISTORY_FILE,
+        "disk_history": DISK_HISTORY_FILE, "alerts_sent": DATA_DIR / "alerts_sent.json",
+        "mutes": MUTE_FILE, "notes": NOTES_FILE, "scheduler": SCHEDULER_FILE,
+        "printers": PRINTERS_FILE, "ink_alerts": INK_ALERTS_FILE, "hw_inventory": HW_INVENTORY_FILE,
+        "temp_data": TEMP_DATA_FILE, "snmp_data": SNMP_DATA_FILE, "wifi_clients": WIFI_FILE,
+    })
+    _uptime.load()
+    legacy = _state.take_uptime()
+    if legacy:
+        _uptime.import_samples(legacy)
+        log.info(f"uptime: moved {len(legacy)} samples from the state store")
+    _load_wifi_clients()
+    _hw_inventory = _state.doc("hw_inventory").all()
+    _temp_data = _state.doc("temp_data").all()
+    _alerts_sent.update(_state.doc("alerts_sent").all())
+    _temp_history.load()
+    _snmp_data = _state.doc("snmp_data").all()
+    NETMAP_FILE.parent.mkdir(parents=True, exist_ok=True)
+    STATUS_HTML_FILE.parent.mkdir(parents=True, exist_ok=True)
+
+
+def _daily(name: str, hour: int, weekday: int | None = None) -> Daily:
+    """Daily trigger for job `name` whose last run day is kept in the state
+    store, so a restart inside the hour runs a missed job but never repeats one."""
+    key = f"daily:{name}"
+    return Daily(hour, weekday=weekday, last=_state.meta_get(key),
+                 on_fire=lambda day: _state.meta_set(key, day))
+
+
 async def on_startup():
-    _background_tasks.append(asyncio.create_task(health_loop()))
-    _background_tasks.append(asyncio.create_task(device_loop()))
-    _background_tasks.append(asyncio.create_task(scheduled_loop()))
-    _background_tasks.append(asyncio.create_task(wifi_poll_loop()))
-    _background_tasks.append(asyncio.create_task(netmap_loop()))
-    _background_tasks.append(asyncio.create_task(ssl_check_loop()))
-    _background_tasks.append(asyncio.create_task(cmd_scheduler_loop()))
-    _background_tasks.append(asyncio.create_task(snmp_poll_loop()))
-    _background_tasks.append(asyncio.create_task(hw_inventory_loop()))
-    _background_tasks.append(asyncio.create_task(temp_loop()))
+    global _mc_channel, _presence
+    _mc_channel = MCControlChannel(MC_WSS, user=MC_LOGIN, password=MC_PASS,
+                                   login_key_fn=_get_login_key,
+                                   on_auth_failed=_invalidate_login_key)
+    _mc_channel.start()
+    _presence = PresenceTracker(_mc_channel, reconcile_interval=PRESENCE_RECONCILE_SEC)
+    _presence.add_listener(_on_presence_change)
+    asyncio.ensure_future(_get_login_key())   # warm the key cache
+    _load_background_state()
+
+    sch = _scheduler
+    sch.add("devices", device_refresh_job, Every(DEVICE_CHECK_INTERVAL), delay=5)
+    sch.add("device_alerts", device_alerts_job)
+    sch.wake_on(_device_bus.subscribe((ADDED, ONLINE)), "device_alerts", collect=_device_alerts.extend)
+    sch.add("conditions", device_conditions_job, Every(DEVICE_CHECK_INTERVAL), delay=25)
+    sch.add("state_flush", state_flush_job, Every(STATE_FLUSH_SEC), delay=STATE_FLUSH_SEC)
+    sch.add("health", health_job, Every(HEALTH_CHECK_INTERVAL), delay=15)
+    sch.add("netmap", netmap_job, Every(NETMAP_INTERVAL), delay=5)
+    sch.wake_on(_device_bus.subscribe((ADDED, REMOVED, ONLINE, HARDWARE)), "netmap", NETMAP_DEBOUNCE_SEC)
+    sch.add("inventory", inventory_job, _daily("inventory", INVENTORY_HOUR))
+    sch.add("daily_report", daily_report_job, _daily("daily_report", DAILY_REPORT_HOUR))
+    sch.add("weekly_digest", weekly_digest_job, _daily("weekly_digest", WEEKLY_DIGEST_HOUR, weekday=6))
+    sch.add("update_check", update_check_job, _daily("update_check", UPDATE_CHECK_HOUR))
+    sch.add("ssl_check", ssl_check_job, _daily("ssl_check", SSL_CHECK_HOUR), delay=60)
+    # agent-heavy jobs: jittered so they don't fire together, limited by SCHED_MC_BUDGET
+    sch.add("cmd_scheduler", cmd_scheduler_job, Every(30), delay=0, heavy=True)
+    sch.add("wifi_poll", wifi_poll_job, Every(WIFI_POLL_INTERVAL, jitter=30), delay=10, heavy=True)
+    sch.add("snmp_poll", snmp_poll_job, Every(SNMP_POLL_INTERVAL, jitter=30), delay=20, heavy=True)
+    # hardware/USB/temperature: one bundled probe per device with whatever is due
+    tick = min(v for v in PROBE_INTERVALS.values() if v)
+    sch.add("probes", probe_job, Every(tick, jitter=60), delay=90, heavy=True)
+    sch.wake_on(_device_bus.subscribe((ADDED, ONLINE, HARDWARE)), "probes", collect=_hw_inventory_events)
+    sch.start()
     log.info("Background tasks started")
 
 
 async def shutdown():
     log.info("Shutting down gracefully...")
     _shutdown_event.set()
-    for t in _background_tasks:
-        t.cancel()
-    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    await _scheduler.stop()
+    await _bulk.stop()
+    if _mc_channel is not None:
+        await _mc_channel.close()
+    _uptime.close()
+    try:
+        _writes.flush(force=True)
+    except Exception as e:
+        log.error(f"state flush on shutdown: {e}")
+    _state.close()
     await bot.session.close()
     log.info("Shutdown complete.")
 
@@ -8203,16 +8575,11 @@ async def cb_ping_back(cb: CallbackQuery):
 # ─── Notes ───────────────────────────────────────────────────────────────────
 
 def _load_notes() -> dict:
-    try:
-        if NOTES_FILE.exists():
-            return json.loads(NOTES_FILE.read_text())
-    except Exception:
-        pass
-    return {}
+    return _state.doc("notes").all()
 
 
 def _save_notes(notes: dict) -> None:
-    NOTES_FILE.write_text(json.dumps(notes, ensure_ascii=False, indent=2))
+    _state.doc("notes").replace(notes)
 
 
 def _notes_device_kb(device_name: str, has_note: bool) -> InlineKeyboardMarkup:
@@ -8323,9 +8690,8 @@ async def cb_tool_disk_trend(cb: CallbackQuery):
     await cb.answer()
 
     trends = get_disk_trends()
-    hist   = _load_json(DISK_HISTORY_FILE, {})
-    n_devices = len(hist)
-    n_points  = sum(len(v) for v in hist.values())
+    n_devices = _disk_forecast.devices
+    n_points  = _disk_forecast.points
 
     header = (
         "━━━━━━━━━━━━━━━━━━━━━━\n"
@@ -8360,10 +8726,16 @@ async def cb_tool_disk_trend(cb: CallbackQuery):
         if d2f is not None:
             urgency = "🔴" if d2f <= 30 else "🟡"
             eta = f"⚠️ заполнится через ~{int(d2f)} д."
+            lo, hi = t.get("days_to_full_min"), t.get("days_to_full_max")
+            if lo is not None and lo != hi:
+                eta += f" ({lo}–{hi if hi is not None else '∞'})"
         else:
             urgency = "🟢"
             eta = "стабильно"
-        rate = f"+{t['fill_rate_gb_day']:.2f}" if t['fill_rate_gb_day'] >= 0 else f"{t['fill_rate_gb_day']:.2f}"
+        rate = f"{t['fill_rate_gb_day']:+.2f}"
+        recent = t.get("fill_rate_recent")
+        if recent is not None and abs(recent - t["fill_rate_gb_day"]) >= max(0.1, abs(t["fill_rate_gb_day"]) / 2):
+            rate += f" (2 нед.: {recent:+.2f})"
         return (
             f"{urgency} <b>{t['device']}</b>  {t['letter']}:\n"
             f"   {t['used_gb']:.1f}/{t['total_gb']:.1f} ГБ ({t['used_pct']:.0f}%)  "
@@ -8446,7 +8818,7 @@ async def cb_wol_group(cb: CallbackQuery):
         await cb.answer("🔒", show_alert=True)
         return
     group = cb.data.split(":", 1)[1]
-    devs = [d for d in await get_full_devices() if d["group"] == group and not d["online"]]
+    devs = [d for d in (await get_device_index()).group(group) if not d["online"]]
     sent, skipped = [], []
     for d in devs:
         macs = [nic["mac"] for nic in d.get("nic_details", [])
@@ -8470,10 +8842,10 @@ async def cb_wol_group(cb: CallbackQuery):
 # ─── Command Scheduler ───────────────────────────────────────────────
 
 def _sched_load() -> list[dict]:
-    return _load_json(SCHEDULER_FILE, [])
+    return list(_state.doc("scheduler").all().values())
 
 def _sched_save(tasks: list[dict]) -> None:
-    _save_json(SCHEDULER_FILE, tasks)
+    _state.doc("scheduler").replace({t["id"]: t for t in tasks})
 
 def _sched_add(devices: list[str], command: str, run_at: datetime) -> dict:
     tasks = _sched_load()
@@ -8506,56 +8878,48 @@ def _parse_run_time(text: str) -> datetime | None:
     return None
 
 
-async def cmd_scheduler_loop():
-    """Background task: run scheduled commands when their time comes."""
-    while not _shutdown_event.is_set():
-        try:
-            tasks = _sched_load()
-            now = datetime.now(timezone.utc)
-            changed = False
-            for t in tasks:
-                if t["status"] != "pending":
-                    continue
-                run_at = datetime.fromisoformat(t["run_at"])
-                if run_at.tzinfo is None:
-                    run_at = run_at.replace(tzinfo=timezone.utc)
-                if now < run_at:
-                    continue
-                devs = await get_full_devices()
-                name_to_id = {d["name"]: d["id"] for d in devs}
-                results = []
-                for dev_name in t["devices"]:
-                    dev_id = name_to_id.get(dev_name)
-                    if not dev_id:
-                        results.append(f"<b>{dev_name}</b>: ⚠️ не найдено")
-                        continue
-                    try:
-                        out = await mc_run_command(dev_id, t["command"])
-                        out_short = (out or "(нет вывода)")[:200]
-                        results.append(f"<b>{dev_name}</b>:\n<code>{out_short}</code>")
-                    except Exception as ex:
-                        results.append(f"<b>{dev_name}</b>: ❌ {ex}")
-                t["status"] = "done"
-                t["result"] = results
-                t["done_at"] = now.isoformat()
-                changed = True
-                admin_id = _load_json(ADMIN_FILE, {}).get("admin_id") or _load_json(ADMIN_FILE, {}).get("id")
-                if admin_id:
-                    msg_lines = [f"⏰ <b>Планировщик</b> — задача #{t['id']} выполнена",
-                                 f"Команда: <code>{t['command'][:100]}</code>", ""] + results[:10]
-                    try:
-                        await bot.send_message(admin_id, "\n".join(msg_lines), parse_mode="HTML")
-                    except Exception:
-                        pass
-            if changed:
-                _sched_save(tasks)
-        except Exception as e:
-            log.error(f"cmd_scheduler_loop: {e}")
-        try:
-            await asyncio.wait_for(_shutdown_event.wait(), timeout=30)
-            break
-        except asyncio.TimeoutError:
-            pass
+async def cmd_scheduler_job():
+    """Run scheduled commands whose time has come."""
+    tasks = _sched_load()
+    now = datetime.now(timezone.utc)
+    changed = False
+    for t in tasks:
+        if t["status"] != "pending":
+            continue
+        run_at = datetime.fromisoformat(t["run_at"])
+        if run_at.tzinfo is None:
+            run_at = run_at.replace(tzinfo=timezone.utc)
+        if now < run_at:
+            continue
+        index = await get_device_index()
+        found = [d for d in map(index.by_name, t["devices"]) if d]
+        by_name = {res.device["name"]: res for res in await _bulk.run(
+            found, _bulk_command(t["command"]), timeout=30, deadline=BULK_DEADLINE_SEC)}
+        results = []
+        for dev_name in t["devices"]:
+            res = by_name.get(dev_name)
+            if res is None:
+                results.append(f"<b>{dev_name}</b>: ⚠️ не найдено")
+            elif res.ok:
+                out_short = (res.output or "(нет вывода)")[:200]
+                results.append(f"<b>{dev_name}</b>:\n<code>{out_short}</code>")
+            else:
+                results.append(f"<b>{dev_name}</b>: {_BULK_STATE_ICONS[res.state]} {_bulk_first_line(res, '')}")
+        t["status"] = "done"
+        t["result"] = results
+        t["done_at"] = now.isoformat()
+        changed = True
+        admin = _load_json_cached(Path(ADMIN_FILE))
+        admin_id = admin.get("admin_id") or admin.get("id")
+        if admin_id:
+            msg_lines = [f"⏰ <b>Планировщик</b> — задача #{t['id']} выполнена",
+                         f"Команда: <code>{t['command'][:100]}</code>", ""] + results[:10]
+            try:
+                await bot.send_message(admin_id, "\n".join(msg_lines), parse_mode="HTML")
+            except Exception:
+                pass
+    if changed:
+        _sched_save(tasks)
 
 
 @router.callback_query(F.data == "tool:scheduler")
@@ -8611,8 +8975,7 @@ async def cb_sched_new(cb: CallbackQuery, state: FSMContext):
 @router.callback_query(F.data.startswith("sched:grp:"), SchedulerFSM.picking_group)
 async def cb_sched_pick_group(cb: CallbackQuery, state: FSMContext):
     group = cb.data[len("sched:grp:"):]
-    devs = await get_full_devices()
-    group_devs = [d for d in devs if d["group"] == group]
+    group_devs = (await get_device_index()).group(group)
     await state.update_data(group=group, selected=[], group_devs=[d["name"] for d in group_devs])
     await state.set_state(SchedulerFSM.picking_devices)
     rows = []
@@ -8734,42 +9097,19 @@ async def cb_sched_clear(cb: CallbackQuery):
 
 async def run_snmp_probe(device_id: str, probe: dict) -> dict | None:
     """Run snmp_probe.ps1 on the remote PC; return parsed JSON or None."""
-    try:
-        script = SNMP_PROBE_SCRIPT.read_text(encoding="utf-8")
-    except Exception as e:
-        log.error(f"snmp_probe: cannot read script: {e}")
-        return None
     community = probe.get("snmp_community", "public") or "public"
-    script = script.replace("SNMP_COMMUNITY_PLACEHOLDER", community)
-    login_key = await _get_login_key()
-    if not login_key:
-        return None
-    args = [
-        "node", MESHCTRL, "RunCommand",
-        "--url", MC_WSS,
-        "--loginkey", login_key,
-        "--id", device_id,
-        "--run", script,
-        "--reply", "--powershell",
-    ]
     try:
-        proc = await asyncio.create_subprocess_exec(
-            *args,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-            cwd=MC_DIR,
-        )
-        stdout, _ = await asyncio.wait_for(proc.communicate(), timeout=60)
-        raw = stdout.decode(errors="replace").strip()
-        brace = raw.find("{")
-        if brace == -1:
-            return None
-        obj, _ = json.JSONDecoder().raw_decode(raw, brace)
-        return obj
+        obj = await _probes.run_json(device_id, _probe_snmp, {"Community": community}, timeout=60)
+        if isinstance(obj, dict):
+            _health.success(device_id, "snmp")
+            return obj
+        _health.failure(device_id, "snmp", "нет JSON в выводе")
     except asyncio.TimeoutError:
         log.warning(f"snmp_probe timeout for device {device_id}")
+        _health.failure(device_id, "snmp", "нет ответа за 60 с")
     except Exception as e:
         log.error(f"snmp_probe error: {e}")
+        _health.failure(device_id, "snmp", str(e))
     return None
 
 
@@ -8784,79 +9124,62 @@ def _snmp_fmt_rate(bps: float) -> str:
     return f"{bps/1024/1024:.2f} MB/s"
 
 
-async def snmp_poll_loop():
-    """Background task: poll SNMP on router via MeshCentral agent every 5 min."""
-    global _snmp_data
-    # Load cached data
-    try:
-        _snmp_data = json.loads(SNMP_DATA_FILE.read_text())
-    except Exception:
-        _snmp_data = {}
+async def snmp_poll_job():
+    """Poll SNMP on routers via their MeshCentral agent."""
+    probes = _load_json(KEENETIC_PROBES_FILE, [])
+    index = await get_device_index()
 
-    while not _shutdown_event.is_set():
-        try:
-            probes = _load_json(KEENETIC_PROBES_FILE, [])
-            devs = await get_full_devices()
-            name_to_id = {d["name"]: d["id"] for d in devs}
+    for probe in probes:
+        if not probe.get("snmp_community"):
+            continue
+        agent_name = probe.get("agent_name", "")
+        dev = index.by_name(agent_name)
+        # Check if agent is online
+        if not dev or not dev.get("online"):
+            continue
+        dev_id = dev["id"]
+        if not _health.allow(dev_id, "snmp"):
+            continue
 
-            for probe in probes:
-                if not probe.get("snmp_community"):
-                    continue
-                agent_name = probe.get("agent_name", "")
-                dev_id = name_to_id.get(agent_name)
-                if not dev_id:
-                    continue
-                # Check if agent is online
-                dev = next((d for d in devs if d["name"] == agent_name), None)
-                if not dev or not dev.get("online"):
-                    continue
+        result = await run_snmp_probe(dev_id, probe)
+        location = probe.get("location", agent_name)
+        now_ts = time.time()
 
-                result = await run_snmp_probe(dev_id, probe)
-                location = probe.get("location", agent_name)
-                now_ts = time.time()
-
-                if not result or result.get("error"):
-                    err = result.get("error", "timeout") if result else "timeout"
-                    _snmp_data[agent_name] = {
-                        "ok": False, "location": location,
-                        "error": err, "updated": now_ts,
-                    }
-                    log.warning(f"snmp_poll: {agent_name}: {err}")
-                    continue
+        if not result or result.get("error"):
+            err = result.get("error", "timeout") if result else "timeout"
+            _snmp_data[agent_name] = {
+                "ok": False, "location": location,
+                "error": err, "updated": now_ts,
+            }
+            log.warning(f"snmp_poll: {agent_name}: {err}")
+            continue
 
-                # Calculate traffic rates from previous sample
-                prev = _snmp_data.get(agent_name, {}).get("data")
-                prev_ts = _snmp_data.get(agent_name, {}).get("updated", 0)
-                rates = {}
-                if prev and prev_ts and (now_ts - prev_ts) > 5:
-                    dt = now_ts - prev_ts
-                    for iface in ("if1", "if2", "if3"):
-                        old_in  = prev.get(f"{iface}_in", -1)
-                        old_out = prev.get(f"{iface}_out", -1)
-                        new_in  = result.get(f"{iface}_in", -1)
-                        new_out = result.get(f"{iface}_out", -1)
-                        if old_in >= 0 and new_in >= 0 and new_in >= old_in:
-                            rates[f"{iface}_rate_in"]  = (new_in  - old_in)  / dt
-                            rates[f"{iface}_rate_out"] = (new_out - old_out) / dt
-
-                _snmp_data[agent_name] = {
-                    "ok": True, "location": location,
-                    "router": result.get("router", ""),
-                    "updated": now_ts,
-                    "data": result,
-                    "rates": rates,
-                }
-                log.info(f"snmp_poll: {agent_name} ({location}) CPU={result.get('cpu_pct',-1)}%"
-                         f" uptime={result.get('uptime','?')}")
-
-            _save_json(SNMP_DATA_FILE, _snmp_data)
-        except Exception as e:
-            log.error(f"snmp_poll_loop: {e}")
-        try:
-            await asyncio.wait_for(_shutdown_event.wait(), timeout=SNMP_POLL_INTERVAL)
-            break
-        except asyncio.TimeoutError:
-            pass
+        # Calculate traffic rates from previous sample
+        prev = _snmp_data.get(agent_name, {}).get("data")
+        prev_ts = _snmp_data.get(agent_name, {}).get("updated", 0)
+        rates = {}
+        if prev and prev_ts and (now_ts - prev_ts) > 5:
+            dt = now_ts - prev_ts
+            for iface in ("if1", "if2", "if3"):
+                old_in  = prev.get(f"{iface}_in", -1)
+                old_out = prev.get(f"{iface}_out", -1)
+                new_in  = result.get(f"{iface}_in", -1)
+                new_out = result.get(f"{iface}_out", -1)
+                if old_in >= 0 and new_in >= 0 and new_in >= old_in:
+                    rates[f"{iface}_rate_in"]  = (new_in  - old_in)  / dt
+                    rates[f"{iface}_rate_out"] = (new_out - old_out) / dt
+
+        _snmp_data[agent_name] = {
+            "ok": True, "location": location,
+            "router": result.get("router", ""),
+            "updated": now_ts,
+            "data": result,
+            "rates": rates,
+        }
+        log.info(f"snmp_poll: {agent_name} ({location}) CPU={result.get('cpu_pct',-1)}%"
+                 f" uptime={result.get('uptime','?')}")
+
+    _writes.mark("snmp_data")
 
 
 def _snmp_status_text() -> str:
@@ -8947,7 +9270,7 @@ async def cb_tool_hw_inventory(cb: CallbackQuery):
     await cb.answer()
     global _hw_inventory
     if not _hw_inventory:
-        _hw_inventory = _load_json(HW_INVENTORY_FILE, {})
+        _hw_inventory = _state.doc("hw_inventory").all()
 
     if not _hw_inventory:
         await cb.message.answer(
@@ -9012,14 +9335,11 @@ async def cb_hw_collect_now(cb: CallbackQuery):
 
 async def _hw_collect_now_task(aid: int):
     try:
-        devs = await get_full_devices()
-        online = [d for d in devs if d.get("online")]
-        for d in online:
-            await _collect_hw_for_device(d["id"], d["name"])
-            await asyncio.sleep(3)
+        online = (await get_device_index()).online
+        collected = await _run_probes(online, ["hw", "usb"])
         await bot.send_message(
             aid,
-            f"✅ HW инвентарь обновлён: {len(online)} устройств\n"
+            f"✅ HW инвентарь обновлён: {collected.get('hw', 0)} из {len(online)} устройств\n"
             f"Используйте 💻 Инвентарь HW чтобы посмотреть результаты.",
             parse_mode="HTML",
         )
@@ -9037,7 +9357,7 @@ async def cb_tool_temperature(cb: CallbackQuery):
     await cb.answer()
     global _temp_data
     if not _temp_data:
-        _temp_data = _load_json(TEMP_DATA_FILE, {})
+        _temp_data = _state.doc("temp_data").all()
 
     if not _temp_data:
         await cb.message.answer(
@@ -9048,30 +9368,46 @@ async def cb_tool_temperature(cb: CallbackQuery):
         )
         return
 
-    lines = ["🌡 <b>Температуры и нагрузка CPU</b>\n"]
-    for name, data in sorted(_temp_data.items()):
+    lines = ["🌡 <b>Температуры и нагрузка CPU</b>", "<i>график — 24 ч, самый горячий датчик</i>\n"]
+    since = time.time() - 86400
+    no_sensor = []
+
+    def hottest(item):
+        temps = item[1].get("temps") or []
+        return -max((t.get("temp_c", 0) for t in temps), default=-1000), item[0]
+
+    for name, data in sorted(_temp_data.items(), key=hottest):
         load = data.get("cpu_load_pct", 0)
         temps = data.get("temps", [])
         updated = data.get("updated", "")
-        if data.get("no_sensor"):
-            lines.append(f"<b>{name}</b>: датчики недоступны, CPU {load}%")
-        elif not temps:
-            lines.append(f"<b>{name}</b>: нет данных, CPU {load}%")
-        else:
-            # Show max temp
-            max_t = max(t.get("temp_c", 0) for t in temps)
-            warn = "🔴" if max_t >= TEMP_WARN_C else ("🟡" if max_t >= 60 else "🟢")
-            lines.append(f"{warn} <b>{name}</b>: {max_t}°C  CPU {load}%")
-            for sensor in temps[:3]:
-                lines.append(f"   · {sensor.get('zone','?')[:40]}: {sensor.get('temp_c','?')}°C")
+        if not temps:
+            no_sensor.append(name)
+            continue
+        top = max(temps, key=lambda t: t.get("temp_c", 0))
+        max_t = top.get("temp_c", 0)
+        warn = "🔴" if max_t >= TEMP_WARN_C else ("🟡" if max_t >= 60 else "🟢")
+        lines.append(f"{warn} <b>{name}</b>: {max_t}°C  CPU {load}%")
+        series = [v for _, v in _temp_history.get(name, str(top.get("zone", "?")), since)]
+        if len(series) >= 2:
+            recent = series[-4:]    # about the last hour
+            delta = recent[-1] - recent[0]
+            arrow = "↗" if delta >= 2 else ("↘" if delta <= -2 else "→")
+            lines.append(f"   <code>{sparkline(series)}</code> {min(series):.0f}–{max(series):.0f}°C {arrow}")
+        for sensor in [t for t in temps if t is not top][:2]:
+            lines.append(f"   · {sensor.get('zone','?')[:40]}: {sensor.get('temp_c','?')}°C")
         if updated:
             lines.append(f"   <i>обновлено {updated}</i>")
         lines.append("")
 
+    if no_sensor:
+        lines.append(f"⚪ Без датчиков ({len(no_sensor)}): {', '.join(sorted(no_sensor))}\n")
     lines.append(f"🔴 ≥{TEMP_WARN_C}°C критично  🟡 ≥60°C повышено  🟢 норма")
+    text = "\n".join(lines)
+    if len(text) > 4000:
+        text = text[:text.rfind("\n\n", 0, 3950)] + "\n\n…"
 
     await cb.message.answer(
-        "\n".join(lines)[:4000],
+        text,
         parse_mode="HTML",
         reply_markup=InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="🔄 Обновить сейчас", callback_data="temp_refresh_now")],
@@ -9089,18 +9425,11 @@ async def cb_temp_refresh_now(cb: CallbackQuery):
 
 
 async def _temp_collect_now_task(aid: int):
-    global _temp_data
     try:
-        devs = await get_full_devices()
-        online = [d for d in devs if d.get("online")]
-        for d in online:
-            result = await _collect_temp_for_device(d["id"], d["name"])
-            if result:
-                result["updated"] = datetime.now(timezone.utc).strftime("%d.%m.%Y %H:%M")
-                _temp_data[d["name"]] = result
-                _save_json(TEMP_DATA_FILE, _temp_data)
-            await asyncio.sleep(2)
-        await bot.send_message(aid, f"✅ Температуры собраны: {len(online)} устройств. Нажмите 🌡 Температуры снова.")
+        online = (await get_device_index()).online
+        collected = await _run_probes(online, ["temp"])
+        await bot.send_message(aid, f"✅ Температуры собраны: {collected.get('temp', 0)} из {len(online)} устройств. "
+                                    f"Нажмите 🌡 Температуры снова.")
     except Exception as e:
         await bot.send_message(aid, f"❌ Ошибка: {e}")
 
@@ -9153,7 +9482,7 @@ async def cb_tool_status_page(cb: CallbackQuery):
     status_url = f"{MC_URL}/status"
     if not STATUS_HTML_FILE.exists():
         await cb.message.answer(
-            "🌐 Страница статуса ещё не сгенерирована. Подождите 60 секунд.",
+            "🌐 Страница статуса ещё не сгенерирована. Подождите минуту.",
             parse_mode="HTML",
         )
         return
@@ -9161,7 +9490,7 @@ async def cb_tool_status_page(cb: CallbackQuery):
         f"🌐 <b>Страница статуса сети</b>\n\n"
         f"Публичная страница (без авторизации):\n"
         f"<a href='{status_url}'>{status_url}</a>\n\n"
-        f"Обновляется каждые 60 секунд автоматически.\n"
+        f"Обновляется автоматически при изменениях в сети.\n"
         f"Показывает онлайн/офлайн по каждой локации.",
         parse_mode="HTML",
         disable_web_page_preview=True,
@@ -1,5 +1,8 @@
 # Hardware Inventory Probe for MeshCentral Bot
-# Returns JSON: cpu, ram, disks, system, network
+# Returns JSON: cpu, ram, disks, system, network, fingerprint
+# Run from the probe bundle with $ProbeKnown['hw'] = the fingerprint the bot
+# has: if the hardware still matches, only {unchanged, fingerprint, last_boot,
+# disk free space} is returned and the slow storage queries are skipped.
 [Console]::OutputEncoding = [System.Text.Encoding]::UTF8
 $OutputEncoding = [System.Text.Encoding]::UTF8
 
@@ -36,8 +39,7 @@ try {
 
 # RAM
 try {
-    $cs2 = Get-CimInstance Win32_ComputerSystem -ErrorAction Stop
-    $result.ram_total_gb = [math]::Round($cs2.TotalPhysicalMemory / 1GB, 1)
+    $result.ram_total_gb = [math]::Round($cs.TotalPhysicalMemory / 1GB, 1)
     $dimms = @(Get-CimInstance Win32_PhysicalMemory -ErrorAction SilentlyContinue)
     $result.ram_slots = $dimms.Count
     $result.ram_modules = @($dimms | ForEach-Object {
@@ -57,27 +59,12 @@ try {
         $size_gb = if ($d.Size)      { [math]::Round($d.Size / 1GB, 1) }      else { 0.0 }
         $pct     = if ($d.Size -gt 0) { [math]::Round((($d.Size - $d.FreeSpace) / $d.Size) * 100) } else { 0 }
 
-        # Detect SSD vs HDD (best-effort)
-        $dtype = "HDD"
-        try {
-            $msft = Get-PhysicalDisk -ErrorAction SilentlyContinue | Where-Object { $_.FriendlyName -ne $null } | Select-Object -First 1
-            if ($msft -and $msft.MediaType -eq "SSD") { $dtype = "SSD" }
-        } catch {}
-        try {
-            $perf = Get-Disk -ErrorAction SilentlyContinue | Select-Object -First 1
-            if ($perf -and ($perf.BusType -eq "NVMe" -or $perf.BusType -eq "SATA")) {
-                $model = [string]$perf.FriendlyName
-                if ($model -match "SSD|NVMe|M\.2|Kingston|Samsung\s*\d{3}[Ee]|WD\s+Green|WD\s+Blue") { $dtype = "SSD" }
-            }
-        } catch {}
-
         $disks += @{
             letter   = [string]$d.DeviceID
             label    = [string]$d.VolumeName
             size_gb  = $size_gb
             free_gb  = $free_gb
             used_pct = $pct
-            dtype    = $dtype
         }
     }
 } catch {}
@@ -97,4 +84,40 @@ try {
     $result.network = $nics
 } catch { $result.network = @() }
 
+# Fingerprint of everything except free space and boot time.
+# Bump the leading version when the output format changes.
+$fpSrc = @('v2', $result.manufacturer, $result.model, $result.serial, $result.os_name, $result.os_version,
+           $result.os_install, $result.cpu_name, $result.cpu_threads, $result.ram_total_gb,
+           ($result.ram_modules -join ','), $result.gpu, ($result.network -join ';'),
+           (($disks | ForEach-Object { "$($_.letter)$($_.size_gb)$($_.label)" }) -join ';')) -join '|'
+$sha = [Security.Cryptography.SHA256]::Create()
+$result.fingerprint = (($sha.ComputeHash([Text.Encoding]::UTF8.GetBytes($fpSrc)) |
+                        Select-Object -First 8 | ForEach-Object { $_.ToString('x2') }) -join '')
+
+$known = if ($ProbeKnown -is [hashtable]) { [string]$ProbeKnown['hw'] } else { '' }
+if ($known -and $known -eq $result.fingerprint) {
+    @{
+        unchanged   = $true
+        fingerprint = $result.fingerprint
+        last_boot   = $result.last_boot
+        disks       = @($disks | ForEach-Object { @{ letter = $_.letter; free_gb = $_.free_gb; used_pct = $_.used_pct } })
+    } | ConvertTo-Json -Depth 3 -Compress
+    return
+}
+
+# Detect SSD vs HDD (best-effort; the same answer for every volume, so asked once)
+$dtype = "HDD"
+try {
+    $msft = Get-PhysicalDisk -ErrorAction SilentlyContinue | Where-Object { $_.FriendlyName -ne $null } | Select-Object -First 1
+    if ($msft -and $msft.MediaType -eq "SSD") { $dtype = "SSD" }
+} catch {}
+try {
+    $perf = Get-Disk -ErrorAction SilentlyContinue | Select-Object -First 1
+    if ($perf -and ($perf.BusType -eq "NVMe" -or $perf.BusType -eq "SATA")) {
+        $model = [string]$perf.FriendlyName
+        if ($model -match "SSD|NVMe|M\.2|Kingston|Samsung\s*\d{3}[Ee]|WD\s+Green|WD\s+Blue") { $dtype = "SSD" }
+    }
+} catch {}
+foreach ($d in $disks) { $d.dtype = $dtype }
+
 $result | ConvertTo-Json -Depth 3 -Compress
@@ -1,8 +1,13 @@
 # Network client probe — Keenetic API (primary) + Get-NetNeighbor (fallback)
-# Placeholders replaced by bot at runtime: ROUTER_LOGIN, ROUTER_PASSWORD
+# The bot passes the router credentials as parameters.
 
-$login = 'ROUTER_LOGIN'
-$pass  = 'ROUTER_PASSWORD'
+param(
+    [string]$RouterLogin    = 'admin',
+    [string]$RouterPassword = ''
+)
+
+$login = $RouterLogin
+$pass  = $RouterPassword
 
 $debug = @()
 
@@ -22,7 +27,7 @@ if (-not $gw) {
     }
 }
 if (-not $gw) {
-    [ordered]@{ ok=$false; error='no gateway'; debug=@() } | ConvertTo-Json -Compress; exit
+    [ordered]@{ ok=$false; error='no gateway'; debug=@() } | ConvertTo-Json -Compress; return
 }
 $debug += "gw=$gw"
 $subnet = $gw -replace '\.\d+$', ''
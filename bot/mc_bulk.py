@@ -0,0 +1,262 @@
+"""
+Bulk remote execution: run one command (or any per-device coroutine) on N
+devices at once.
+
+BulkRunner fans the work out with an adaptive concurrency limit instead of
+a fixed Semaphore(5): the limit grows while devices answer at about the
+run's baseline latency and is cut back (multiplicatively) on timeouts,
+transport errors or replies much slower than the baseline — the signs of
+MeshCentral or the network being saturated. The limit a run ends with is
+where the next run starts.
+
+Every device gets its own timeout, the whole run an optional deadline
+(devices not started by then are skipped, in-flight ones get only the time
+left), and a run can be cancelled. Results are structured per device
+(state, output, error, duration, bytes) and can be consumed as they arrive
+via on_result.
+"""
+
+import asyncio
+import itertools
+import logging
+import time
+from typing import Awaitable, Callable
+
+log = logging.getLogger("mc-bot")
+
+OK = "ok"
+ERROR = "error"            # transport / MeshCentral error (command may not have run)
+TIMEOUT = "timeout"        # no reply within the device timeout
+CANCELLED = "cancelled"    # run cancelled while waiting or running
+SKIPPED = "skipped"        # run deadline passed before the device got a slot
+
+
+class DeviceResult:
+    __slots__ = ("device", "state", "output", "error", "duration", "bytes")
+
+    def __init__(self, device, state: str, output: str = "", error: str = "", duration: float = 0.0):
+        self.device = device
+        self.state = state
+        self.output = output
+        self.error = error
+        self.duration = duration
+        self.bytes = len(output.encode("utf-8", "replace")) if output else 0
+
+    @property
+    def ok(self) -> bool:
+        return self.state == OK
+
+    def __repr__(self) -> str:
+        return f"DeviceResult({self.device['name']!r}, {self.state}, {self.duration:.1f}s, {self.bytes}B)"
+
+
+class _AdaptiveLimit:
+    """AIMD concurrency limit. Slow start (+1 per fast reply) until the first
+    congestion signal, then +1/limit per fast reply; ×0.7 on congestion, at
+    most once per cooldown so one burst of timeouts counts once."""
+
+    def __init__(self, initial: float, lo: int, hi: int):
+        self.lo, self.hi = lo, hi
+        self.limit = float(min(max(initial, lo), hi))
+        self.peak = self.limit
+        self.inflight = 0
+        self._slow_start = True
+        self._cut_at = 0.0
+        self._cond = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._cond:
+            while self.inflight >= int(self.limit):
+                await self._cond.wait()
+            self.inflight += 1
+
+    async def release(self):
+        async with self._cond:
+            self.inflight -= 1
+            self._cond.notify_all()
+
+    def grow(self):
+        self.limit = min(self.hi, self.limit + (1 if self._slow_start else 1 / self.limit))
+        self.peak = max(self.peak, self.limit)
+
+    def cut(self, cooldown: float):
+        now = time.monotonic()
+        if now - self._cut_at < cooldown:
+            return
+        self._cut_at = now
+        self._slow_start = False
+        self.limit = max(self.lo, self.limit * 0.7)
+
+
+class BulkRun:
+    """One fan-out started by BulkRunner.start(): await wait(), or cancel()."""
+
+    def __init__(self, run_id: str, devices: list, total: int):
+        self.id = run_id
+        self.devices = devices
+        self.total = total
+        self.results: list[DeviceResult] = []
+        self.started = time.monotonic()
+        self.finished: float | None = None
+        self._task: asyncio.Task | None = None
+        self._limit: _AdaptiveLimit | None = None
+        self.cancelled = False
+
+    @property
+    def done(self) -> bool:
+        return self.finished is not None
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def concurrency(self) -> int:
+        return int(self._limit.limit) if self._limit else 0
+
+    def counts(self) -> dict[str, int]:
+        c = {OK: 0, ERROR: 0, TIMEOUT: 0, CANCELLED: 0, SKIPPED: 0}
+        for r in self.results:
+            c[r.state] += 1
+        return c
+
+    def cancel(self):
+        if not self.done:
+            self.cancelled = True
+            self._task.cancel()
+
+    async def wait(self) -> list[DeviceResult]:
+        try:
+            await asyncio.shield(self._task)
+        except asyncio.CancelledError:
+            if not self.cancelled:
+                raise
+        return self.results
+
+
+class BulkRunner:
+    """Adaptive fan-out engine shared by every "run X on N devices" caller."""
+
+    def __init__(self, min_concurrency: int = 2, max_concurrency: int = 32, initial: int = 8):
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self._next_limit = float(initial)    # where the next run starts
+        self._ids = itertools.count(1)
+        self.runs: dict[str, BulkRun] = {}   # active runs by id
+        self.stats = {"runs": 0, "devices": 0, "ok": 0, "failed": 0, "last": None}
+
+    def start(self, devices, fn: Callable[[object, float], Awaitable[str]], *,
+              timeout: float = 30, deadline: float | None = None,
+              on_result: Callable[[DeviceResult], Awaitable | None] | None = None) -> BulkRun:
+        """Start fn(device, timeout) -> output on every device.
+
+        timeout is per device; deadline (seconds from now) bounds the whole
+        run. fn raising asyncio.TimeoutError counts as TIMEOUT, any other
+        exception as ERROR; both slow the run down. on_result is called (and
+        awaited, if it returns an awaitable) for every result as it arrives.
+        """
+        devices = list(devices)
+        run = BulkRun(f"{next(self._ids):x}", devices, len(devices))
+        run._limit = _AdaptiveLimit(self._next_limit, self.min_concurrency, self.max_concurrency)
+        run._task = asyncio.ensure_future(self._run(run, fn, timeout, deadline, on_result))
+        self.runs[run.id] = run
+        return run
+
+    async def run(self, devices, fn, **kwargs) -> list[DeviceResult]:
+        return await self.start(devices, fn, **kwargs).wait()
+
+    async def stop(self):
+        """Cancel every active run (shutdown)."""
+        runs = list(self.runs.values())
+        for run in runs:
+            run.cancel()
+        await asyncio.gather(*(run.wait() for run in runs), return_exceptions=True)
+
+    async def _run(self, run: BulkRun, fn, timeout: float, deadline: float | None, on_result):
+        limit = run._limit
+        end = run.started + deadline if deadline else None
+        latency = {"base": None, "avg": None}
+        pending: set[asyncio.Task] = set()
+        finished: set[int] = set()
+
+        async def report(i: int, res: DeviceResult):
+            finished.add(i)
+            run.results.append(res)
+            if on_result is not None:
+                try:
+                    r = on_result(res)
+                    if asyncio.iscoroutine(r) or isinstance(r, asyncio.Future):
+                        await r
+                except Exception as e:
+                    log.error(f"bulk {run.id}: on_result: {e}")
+
+        async def one(i: int, d):
+            t0 = time.monotonic()
+            budget = timeout if end is None else max(0.1, min(timeout, end - t0))
+            try:
+                out = await asyncio.wait_for(fn(d, budget), timeout=budget + 5)
+                dt = time.monotonic() - t0
+                base, avg = latency["base"], latency["avg"]
+                latency["avg"] = dt if avg is None else avg * 0.8 + dt * 0.2
+                latency["base"] = dt if base is None else min(base * 1.05, max(dt, 0.05))
+                if dt > 2 * latency["base"] + 1:
+                    limit.cut(cooldown=latency["avg"])
+                else:
+                    limit.grow()
+                res = DeviceResult(d, OK, out or "", duration=dt)
+            except asyncio.TimeoutError:
+                limit.cut(cooldown=latency["avg"] or 1)
+                res = DeviceResult(d, TIMEOUT, error=f"нет ответа за {budget:.0f} с",
+                                   duration=time.monotonic() - t0)
+            except asyncio.CancelledError:
+                res = DeviceResult(d, CANCELLED, duration=time.monotonic() - t0)
+                await report(i, res)
+                raise
+            except Exception as e:
+                limit.cut(cooldown=latency["avg"] or 1)
+                res = DeviceResult(d, ERROR, error=str(e), duration=time.monotonic() - t0)
+            finally:
+                await limit.release()
+            await report(i, res)
+
+        try:
+            for i, d in enumerate(run.devices):
+                await limit.acquire()
+                if end is not None and time.monotonic() >= end:
+                    await limit.release()
+                    break
+                task = asyncio.ensure_future(one(i, d))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+            if pending:
+                if end is None:
+                    await asyncio.gather(*pending, return_exceptions=True)
+                else:
+                    # hard stop at the deadline (+ grace for the agent replies in flight)
+                    _, late = await asyncio.wait(pending, timeout=max(0, end - time.monotonic()) + 5)
+                    for task in late:
+                        task.cancel()
+                    await asyncio.gather(*late, return_exceptions=True)
+        except asyncio.CancelledError:
+            for task in list(pending):
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            if not run.cancelled:
+                raise
+        finally:
+            state = CANCELLED if run.cancelled else SKIPPED
+            for i, d in enumerate(run.devices):
+                if i not in finished:
+                    run.results.append(DeviceResult(d, state))
+            run.finished = time.monotonic()
+            self.runs.pop(run.id, None)
+            self._next_limit = limit.limit
+            c = run.counts()
+            self.stats["runs"] += 1
+            self.stats["devices"] += run.total
+            self.stats["ok"] += c[OK]
+            self.stats["failed"] += run.total - c[OK]
+            self.stats["last"] = {"devices": run.total, "seconds": run.elapsed, "peak": int(limit.peak),
+                                  "limit": int(limit.limit), **c}
+            log.info(f"bulk {run.id}: {run.total} devices in {run.elapsed:.1f}s, "
+                     f"concurrency peak {int(limit.peak)}, {c}")
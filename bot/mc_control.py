@@ -0,0 +1,274 @@
+"""
+Persistent MeshCentral control channel (control.ashx) for the bot.
+
+One authenticated WebSocket, owned by the bot and shared by all callers,
+instead of spawning `node meshctrl.js` (process start + WSS login) per call.
+Requests are matched to replies by `responseid`, so many can be in flight
+at once. The connection is re-established automatically with backoff.
+"""
+
+import asyncio
+import base64
+import itertools
+import json
+import logging
+import os
+import time
+from typing import Awaitable, Callable
+
+import aiohttp
+
+try:
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    HAS_AESGCM = True
+except ImportError:
+    HAS_AESGCM = False
+
+log = logging.getLogger("mc-bot")
+
+# MeshCentral power action codes (same as meshctrl DevicePower)
+POWER_ACTIONS = {"off": 2, "reset": 3, "sleep": 4}
+
+
+class MCControlError(Exception):
+    """Request failed: connection lost or rejected by the server."""
+
+
+class MCNotConnected(MCControlError):
+    """The request was never sent — safe to retry through meshctrl."""
+
+
+def encode_login_cookie(login_key_hex: str, user: str = "admin", domain: str = "") -> str:
+    """Build the `auth=` cookie meshctrl derives from --loginkey (AES-256-GCM)."""
+    key = bytes.fromhex(login_key_hex)[:32]
+    iv = os.urandom(12)
+    payload = json.dumps(
+        {"u": f"user/{domain}/{user.lower()}", "a": 3, "time": int(time.time())},
+        separators=(",", ":"),
+    ).encode()
+    sealed = AESGCM(key).encrypt(iv, payload, None)
+    ct, tag = sealed[:-16], sealed[-16:]
+    return base64.b64encode(iv + tag + ct).decode().replace("+", "@").replace("/", "$")
+
+
+class MCControlChannel:
+    """Long-lived, auto-reconnecting client for MeshCentral's control.ashx."""
+
+    def __init__(self, url: str, *, user: str = "admin", password: str = "",
+                 login_key_fn: Callable[[], Awaitable[str]] | None = None,
+                 on_auth_failed: Callable[[], None] | None = None,
+                 verify_ssl: bool = False):
+        self.url = url.rstrip("/")
+        self.user = user
+        self.password = password
+        self.login_key_fn = login_key_fn
+        self.on_auth_failed = on_auth_failed
+        self.verify_ssl = verify_ssl
+        self._ws: aiohttp.ClientWebSocketResponse | None = None
+        self._session: aiohttp.ClientSession | None = None
+        self._task: asyncio.Task | None = None
+        self._ready = asyncio.Event()
+        self._closed = False
+        self._ids = itertools.count(1)
+        # responseid → (future, accept(msg) -> bool: True when msg is the final reply)
+        self._pending: dict[str, tuple[asyncio.Future, Callable[[dict], bool]]] = {}
+        self._listeners: list[Callable[[dict], None]] = []
+        self.stats = {"connects": 0, "requests": 0, "errors": 0, "timeouts": 0}
+
+    # ── lifecycle ──
+
+    @property
+    def connected(self) -> bool:
+        return self._ready.is_set() and self._ws is not None and not self._ws.closed
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        self._closed = True
+        self._ready.clear()
+        if self._ws is not None:
+            await self._ws.close()
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        if self._session is not None:
+            await self._session.close()
+        self._fail_pending(MCControlError("channel closed"))
+
+    async def wait_ready(self, timeout: float = 5) -> bool:
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout=timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def add_listener(self, fn: Callable[[dict], None]):
+        """Register a callback for unsolicited server messages (events)."""
+        self._listeners.append(fn)
+
+    async def _connect_params(self) -> tuple[str, dict]:
+        url = f"{self.url}/control.ashx"
+        headers = {}
+        key = ""
+        if self.login_key_fn is not None and HAS_AESGCM:
+            try:
+                key = (await self.login_key_fn()).strip()
+            except Exception as e:
+                log.warning(f"mc_control: login key unavailable: {e}")
+        if key and len(key) == 160:
+            url += "?auth=" + encode_login_cookie(key, self.user)
+        elif self.password:
+            headers["x-meshauth"] = (
+                base64.b64encode(self.user.encode()).decode() + "," +
+                base64.b64encode(self.password.encode()).decode()
+            )
+        return url, headers
+
+    async def _run(self):
+        backoff = 1
+        while not self._closed:
+            try:
+                if self._session is None or self._session.closed:
+                    self._session = aiohttp.ClientSession()
+                url, headers = await self._connect_params()
+                self._ws = await self._session.ws_connect(
+                    url, headers=headers, ssl=None if self.verify_ssl else False,
+                    heartbeat=30, max_msg_size=0,
+                )
+                self.stats["connects"] += 1
+                log.info(f"mc_control: connected to {self.url}")
+                backoff = 1
+                async for msg in self._ws:
+                    if msg.type == aiohttp.WSMsgType.TEXT:
+                        self._dispatch(msg.data)
+                    elif msg.type in (aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+                        break
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.warning(f"mc_control: connection error: {e}")
+            self._ready.clear()
+            self._fail_pending(MCControlError("connection lost"))
+            if self._closed:
+                break
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 30)
+
+    def _fail_pending(self, exc: Exception):
+        pending, self._pending = self._pending, {}
+        for fut, _ in pending.values():
+            if not fut.done():
+                fut.set_exception(exc)
+
+    def _dispatch(self, raw: str):
+        try:
+            msg = json.loads(raw)
+        except ValueError:
+            return
+        if not isinstance(msg, dict):
+            return
+        action = msg.get("action")
+        if action in ("serverinfo", "userinfo"):
+            self._ready.set()
+        if action == "close":
+            log.warning(f"mc_control: server closed session: {msg.get('cause', '')} {msg.get('msg', '')}")
+            if msg.get("cause") == "noauth" and self.on_auth_failed is not None:
+                self.on_auth_failed()
+        rid = msg.get("responseid")
+        entry = self._pending.get(rid) if rid else None
+        if entry is not None:
+            fut, accept = entry
+            try:
+                final = accept(msg)
+            except Exception as e:
+                final = True
+                msg = {"action": action, "result": f"Error: {e}"}
+            if final:
+                self._pending.pop(rid, None)
+                if not fut.done():
+                    fut.set_result(msg)
+            return
+        for fn in self._listeners:
+            try:
+                fn(msg)
+            except Exception as e:
+                log.error(f"mc_control listener: {e}")
+
+    # ── requests ──
+
+    async def request(self, msg: dict, timeout: float = 30,
+                      accept: Callable[[dict], bool] | None = None) -> dict:
+        """Send one command and await its reply (matched by responseid).
+
+        Raises asyncio.TimeoutError on timeout, MCControlError otherwise.
+        """
+        if not self.connected and not await self.wait_ready(timeout=min(timeout, 5)):
+            raise MCNotConnected("not connected")
+        rid = f"bot{next(self._ids)}"
+        fut = asyncio.get_running_loop().create_future()
+        self._pending[rid] = (fut, accept or (lambda m: True))
+        self.stats["requests"] += 1
+        try:
+            await self._ws.send_str(json.dumps({**msg, "responseid": rid}))
+            return await asyncio.wait_for(fut, timeout=timeout)
+        except asyncio.TimeoutError:
+            self.stats["timeouts"] += 1
+            raise
+        except MCControlError:
+            self.stats["errors"] += 1
+            raise
+        except Exception as e:
+            self.stats["errors"] += 1
+            raise MCControlError(str(e))
+        finally:
+            self._pending.pop(rid, None)
+
+    async def list_devices(self, timeout: float = 20) -> list[dict]:
+        """Same shape as `meshctrl ListDevices --json`: node dicts + groupname."""
+        meshes, nodes = await asyncio.gather(
+            self.request({"action": "meshes"}, timeout=timeout),
+            self.request({"action": "nodes"}, timeout=timeout),
+        )
+        mesh_names = {m.get("_id"): m.get("name", "") for m in meshes.get("meshes") or []}
+        result = []
+        for mesh_id, mesh_nodes in (nodes.get("nodes") or {}).items():
+            for n in mesh_nodes:
+                n = dict(n)
+                n.setdefault("meshid", mesh_id)
+                n["groupname"] = mesh_names.get(mesh_id, "")
+                result.append(n)
+        return result
+
+    async def run_command(self, node_id: str, command: str, powershell: bool = False,
+                          run_as_user: bool = False, timeout: float = 30) -> str:
+        """RunCommand with --reply: returns the agent console output."""
+        def accept(m: dict) -> bool:
+            # The server first acks with result "OK", the agent output follows.
+            if m.get("action") == "runcommands" and m.get("result") == "OK" and "nodeid" not in m:
+                return False
+            return True
+
+        reply = await self.request({
+            "action": "runcommands",
+            "nodeids": [node_id],
+            "type": 2 if powershell else 0,
+            "cmds": command,
+            "runAsUser": 1 if run_as_user else 0,
+            "reply": True,
+        }, timeout=timeout, accept=accept)
+        result = reply.get("result")
+        if result is None:
+            raise MCControlError(reply.get("error") or "empty reply")
+        return str(result)
+
+    async def device_power(self, node_id: str, action: str, timeout: float = 15) -> str:
+        if action == "wake":
+            msg = {"action": "wakedevices", "nodeids": [node_id]}
+        elif action in POWER_ACTIONS:
+            msg = {"action": "poweraction", "nodeids": [node_id], "actiontype": POWER_ACTIONS[action]}
+        else:
+            raise MCControlError(f"unknown power action: {action}")
+        reply = await self.request(msg, timeout=timeout)
+        return str(reply.get("result") or "OK")
@@ -0,0 +1,327 @@
+"""
+MeshCentral DB ingestion for the bot.
+
+MCRecordSet holds the only record types the bot uses (mesh, node, sysinfo,
+ifinfo, lastconnect) indexed by mesh/node ID. It can be filled from a full
+`--dbexport` (streamed record by record, see load_export) or kept current by
+NeDBTail, which follows MeshCentral's append-only NeDB file (meshcentral.db)
+and reads only the bytes written since the previous pass.
+"""
+
+import json
+import logging
+import os
+import re
+import sys
+
+log = logging.getLogger("mc-bot")
+
+# record type → ID prefix MeshCentral uses for it
+_PREFIXES = {
+    "mesh": "mesh//",
+    "node": "node//",
+    "sysinfo": "sinode//",
+    "ifinfo": "ifnode//",
+    "lastconnect": "lcnode//",
+}
+_KIND_BY_PREFIX = {v: k for k, v in _PREFIXES.items()}
+# cheap pre-filter: skip lines that can't be a wanted record before json.loads
+_WANTED_LINE = re.compile(r'"_id":"(?:mesh|node|sinode|ifnode|lcnode)//')
+# export streaming: leading _id of an object, and tokens for skipping one unparsed
+_OBJ_ID = re.compile(r'\{\s*"_id"\s*:\s*"([^"\\]*)"')
+_SKIP_TOKEN = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"|[{}]|"')
+_decoder = json.JSONDecoder()
+# sysinfo fields get_full_devices reads; the rest (hashes, SMBIOS dumps, software
+# publishers/install dates, ...) is dropped when the record is stored
+_SYSINFO_WINDOWS_KEYS = ("cpu", "memory", "gpu", "drives", "volumes", "osinfo", "software")
+_SYSINFO_HW_KEYS = ("identifiers", "tpm", "network")
+
+
+def node_id_of(record_id: str) -> str:
+    """sinode//X, ifnode//X, lcnode//X → node//X (mesh and node IDs unchanged)."""
+    for prefix in ("sinode//", "ifnode//", "lcnode//"):
+        if record_id.startswith(prefix):
+            return "node//" + record_id[len(prefix):]
+    return record_id
+
+
+def kind_of(record_id: str) -> str | None:
+    head, sep, _ = record_id.partition("//")
+    return _KIND_BY_PREFIX.get(head + sep) if sep else None
+
+
+def _slim_software(software):
+    """Keep only name/version per package; names are interned (shared across nodes)."""
+    if isinstance(software, dict):
+        return {sys.intern(str(k)): {"version": v.get("version", "")} if isinstance(v, dict) else {}
+                for k, v in software.items()}
+    if isinstance(software, list):
+        return [{"name": sys.intern(str(sw.get("name", "?"))), "version": sw.get("version", "")}
+                for sw in software if isinstance(sw, dict)]
+    return software
+
+
+def slim_sysinfo(doc: dict) -> dict:
+    """Copy of a sysinfo record reduced to the hardware fields the bot reads."""
+    hw = doc.get("hardware")
+    if not isinstance(hw, dict):
+        return doc
+    slim_hw = {k: hw[k] for k in _SYSINFO_HW_KEYS if k in hw}
+    win = hw.get("windows")
+    if isinstance(win, dict):
+        slim_win = {k: win[k] for k in _SYSINFO_WINDOWS_KEYS if k in win}
+        if "software" in slim_win:
+            slim_win["software"] = _slim_software(slim_win["software"])
+        slim_hw["windows"] = slim_win
+    return {"_id": doc.get("_id"), "type": doc.get("type"), "hardware": slim_hw}
+
+
+class MCRecordSet:
+    """Wanted MeshCentral records, indexed by mesh ID / node ID."""
+
+    KINDS = tuple(_PREFIXES)
+    _TABLES = {"mesh": "meshes", "node": "nodes", "sysinfo": "sysinfo",
+               "ifinfo": "ifinfo", "lastconnect": "lastconnect"}
+
+    def __init__(self):
+        # per kind: node ID → content fingerprint of the stored record
+        self._fp: dict[str, dict[str, int]] = {k: {} for k in self._TABLES}
+        self.meshes: dict[str, dict] = {}
+        self.nodes: dict[str, dict] = {}
+        self.sysinfo: dict[str, dict] = {}
+        self.ifinfo: dict[str, dict] = {}
+        self.lastconnect: dict[str, dict] = {}
+        self.generation = 0          # bumped on every pass that changed something
+
+    def _table(self, kind: str) -> dict:
+        return getattr(self, self._TABLES[kind])
+
+    def put(self, doc: dict, fp: int | None = None) -> bool:
+        """Route one record into its index. Returns False for unwanted rows.
+        fp is a fingerprint of the record's raw text; computed from doc if omitted.
+        """
+        kind = doc.get("type")
+        if kind not in _PREFIXES:
+            return False
+        rid = doc.get("_id", "")
+        if not rid.startswith(_PREFIXES[kind]):
+            return False
+        if fp is None:
+            fp = hash(json.dumps(doc, sort_keys=True, default=str))
+        if kind == "sysinfo":
+            doc = slim_sysinfo(doc)
+        key = node_id_of(rid)
+        self._table(kind)[key] = doc
+        self._fp[kind][key] = fp
+        return True
+
+    def remove(self, record_id: str) -> bool:
+        kind = kind_of(record_id)
+        if kind is None:
+            return False
+        self._fp[kind].pop(node_id_of(record_id), None)
+        return self._table(kind).pop(node_id_of(record_id), None) is not None
+
+    def clear(self):
+        for kind in self.KINDS:
+            self._table(kind).clear()
+            self._fp[kind].clear()
+
+    def fingerprint(self, node_id: str) -> tuple:
+        """Fingerprint of a node's node/sysinfo/ifinfo/lastconnect records:
+        changes whenever any of them is replaced with different content."""
+        return (self._fp["node"].get(node_id), self._fp["sysinfo"].get(node_id),
+                self._fp["ifinfo"].get(node_id), self._fp["lastconnect"].get(node_id))
+
+    def __len__(self) -> int:
+        return sum(len(self._table(k)) for k in self.KINDS)
+
+    @classmethod
+    def from_rows(cls, rows) -> "MCRecordSet":
+        rs = cls()
+        for r in rows:
+            rs.put(r)
+        rs.generation = 1
+        return rs
+
+
+class NeDBTail:
+    """Incrementally follow an append-only NeDB datafile into an MCRecordSet.
+
+    NeDB appends a full new copy of a document on every update and a
+    `{"$$deleted": true, "_id": ...}` line on delete; the last line for an
+    _id wins. On compaction the file is rewritten (new inode or shorter file),
+    which triggers a full re-read.
+    """
+
+    def __init__(self, path: str, records: MCRecordSet | None = None):
+        self.path = path
+        self.records = records or MCRecordSet()
+        self._inode = None
+        self._offset = 0
+        self._partial = b""
+        self.stats = {"full_reads": 0, "incremental_reads": 0, "bytes_read": 0, "lines": 0}
+
+    def available(self) -> bool:
+        return os.path.isfile(self.path)
+
+    def read(self) -> tuple[bool, list]:
+        """Read whatever was appended since the last call (blocking I/O — run it
+        in a worker thread). Returns (full_reload, changes) for apply();
+        changes maps record _id → (latest doc, fingerprint), or None if deleted.
+        Touches no shared state but the file cursor.
+        """
+        st = os.stat(self.path)
+        full = self._inode != (st.st_dev, st.st_ino) or st.st_size < self._offset
+        if full:
+            self._inode = (st.st_dev, st.st_ino)
+            self._offset = 0
+            self._partial = b""
+            self.stats["full_reads"] += 1
+        elif st.st_size == self._offset:
+            return False, {}
+        else:
+            self.stats["incremental_reads"] += 1
+
+        changes: dict[str, dict | None] = {}
+        with open(self.path, "rb") as f:
+            f.seek(self._offset)
+            while True:
+                chunk = f.read(1 << 20)
+                if not chunk:
+                    break
+                self._offset += len(chunk)
+                self.stats["bytes_read"] += len(chunk)
+                lines = (self._partial + chunk).split(b"\n")
+                self._partial = lines.pop()   # incomplete last line (if any)
+                for line in lines:
+                    parsed = self._parse(line)
+                    if parsed is not None:
+                        changes[parsed[0]] = parsed[1]   # last line for an _id wins
+        return full, changes
+
+    def apply(self, full: bool, changes: dict) -> int:
+        """Apply read() results to the record set (event-loop thread). Returns changed count."""
+        if full:
+            self.records.clear()
+        changed = 0
+        for rid, doc in changes.items():
+            if doc is None:
+                changed += self.records.remove(rid)
+            else:
+                changed += self.records.put(*doc)
+        if changed or full:
+            self.records.generation += 1
+        return changed
+
+    def _parse(self, line: bytes):
+        if not line:
+            return None
+        self.stats["lines"] += 1
+        text = line.decode("utf-8", errors="replace")
+        if '"$$deleted"' in text:
+            try:
+                doc = json.loads(text)
+            except ValueError:
+                return None
+            if doc.get("$$deleted"):
+                return (doc.get("_id", ""), None)
+        if not _WANTED_LINE.search(text):
+            return None
+        try:
+            doc = json.loads(text)
+        except ValueError as e:
+            log.warning(f"nedb tail: bad line skipped: {e}")
+            return None
+        if isinstance(doc, dict) and doc.get("type") in _PREFIXES:
+            return (doc.get("_id", ""), (doc, hash(line)))
+        return None
+
+
+# ─── Streaming --dbexport reader ─────────────────────────────────────
+
+def _skip_object(buf: str, pos: int) -> int:
+    """End index of the JSON object starting at buf[pos], or -1 if buf ends first.
+    Only braces and string tokens are visited, nothing is materialized.
+    """
+    depth = 0
+    for m in _SKIP_TOKEN.finditer(buf, pos):
+        tok = m.group()
+        if tok == "{":
+            depth += 1
+        elif tok == "}":
+            depth -= 1
+            if depth == 0:
+                return m.end()
+        elif tok == '"':
+            return -1          # unterminated string: need more data
+    return -1
+
+
+def iter_export(f, chunk_size: int = 1 << 20, stats: dict | None = None):
+    """Yield (record, fingerprint) for the wanted records of a
+    `meshcentral.js --dbexport` JSON array, one at a time. Rows whose leading
+    _id has an unwanted prefix (users, events, power, smbios, ...) are skipped
+    by a brace scan without being parsed.
+    Memory stays bounded by the chunk size plus the largest single record.
+    """
+    if stats is None:
+        stats = {}
+    stats.setdefault("rows", 0)
+    stats.setdefault("skipped", 0)
+    buf, pos, eof = "", 0, False
+
+    def more() -> bool:
+        nonlocal buf, pos, eof
+        chunk = f.read(chunk_size)
+        if not chunk:
+            eof = True
+            return False
+        buf, pos = buf[pos:] + chunk, 0
+        return True
+
+    while True:
+        while pos < len(buf) and buf[pos] in " \t\r\n,[":
+            pos += 1
+        if pos >= len(buf) or (not eof and len(buf) - pos < 256):
+            if not more() and pos >= len(buf):
+                return
+            continue
+        c = buf[pos]
+        if c == "]":
+            return
+        if c != "{":
+            raise ValueError(f"unexpected {c!r} at export offset {pos}")
+        stats["rows"] += 1
+        m = _OBJ_ID.match(buf, pos)
+        if m is not None and kind_of(m.group(1)) is None:
+            end = _skip_object(buf, pos)
+            while end == -1:
+                if not more():
+                    raise ValueError("truncated export")
+                end = _skip_object(buf, pos)
+            pos = end
+            stats["skipped"] += 1
+            continue
+        while True:
+            try:
+                doc, end = _decoder.raw_decode(buf, pos)
+                break
+            except json.JSONDecodeError:
+                if not more():
+                    raise
+        start, pos = pos, end
+        if isinstance(doc, dict) and doc.get("type") in _PREFIXES:
+            yield doc, hash(buf[start:end])
+        else:
+            stats["skipped"] += 1
+
+
+def load_export(path: str, chunk_size: int = 1 << 20, stats: dict | None = None) -> MCRecordSet:
+    """Stream an export file straight into a fresh MCRecordSet (blocking I/O)."""
+    rs = MCRecordSet()
+    with open(path, encoding="utf-8") as f:
+        for doc, fp in iter_export(f, chunk_size, stats):
+            rs.put(doc, fp)
+    rs.generation = 1
+    return rs
@@ -0,0 +1,559 @@
+"""
+Device objects handed out by get_full_devices().
+
+Device is a slotted, read-only record: raw values (bytes, epoch ms, tuples)
+are stored once and display strings (ram_total, volumes, nics, last_boot,
+...) are formatted on access. It also behaves as a read-only Mapping with
+the historical dict keys, so d["cpu"], d.get("nics", []), {**d} and dict(d)
+keep working. The list is shared by every handler and background loop;
+callers that need to annotate a device work on a copy ({**d, "key": value}).
+
+DeviceCache keeps each parsed device keyed by the fingerprint of its DB
+records (MCRecordSet.fingerprint), so a refresh only re-parses nodes whose
+records changed; online/offline_hours are applied on top as a cheap copy.
+Identical software inventories are shared between devices.
+
+DeviceIndex is built once per device refresh and answers lookups by node
+ID, name, group, IP, MAC and serial in O(1) instead of scanning the list.
+"""
+
+import time
+from collections.abc import Mapping
+from datetime import datetime, timezone
+
+
+class FrozenDict(dict):
+    """dict that refuses in-place changes. Still a dict: json.dumps, dict(d),
+    {**d} and .get() work unchanged; .copy() returns a plain mutable dict.
+    """
+
+    __slots__ = ()
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("device data is shared and read-only; copy it with dict(d) first")
+
+    __setitem__ = __delitem__ = __ior__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+    def copy(self) -> dict:
+        return dict(self)
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
+
+
+_ATOMS = frozenset((str, int, float, bool, type(None)))
+
+
+def freeze(obj):
+    """Deep read-only copy: dict → FrozenDict, list/tuple/set → tuple."""
+    t = type(obj)
+    if t in _ATOMS or t is FrozenDict:
+        return obj
+    if isinstance(obj, dict):
+        return FrozenDict({k: v if type(v) in _ATOMS else freeze(v) for k, v in obj.items()})
+    if isinstance(obj, (list, tuple, set)):
+        return tuple([v if type(v) in _ATOMS else freeze(v) for v in obj])
+    return obj
+
+
+def fmt_size(b) -> str:
+    b = int(b) if b else 0
+    if b >= 1024**4:
+        return f"{b / 1024**4:.1f} TB"
+    if b >= 1024**3:
+        return f"{b / 1024**3:.0f} GB"
+    if b >= 1024**2:
+        return f"{b / 1024**2:.0f} MB"
+    return f"{b} B"
+
+
+class SoftwareItem(Mapping):
+    """One installed package: sw["name"], sw["version"] (a quarter of a dict's size)."""
+
+    __slots__ = ("name", "version")
+    _KEYS = ("name", "version")
+
+    def __init__(self, name: str, version: str):
+        object.__setattr__(self, "name", name)
+        object.__setattr__(self, "version", version)
+
+    def __setattr__(self, key, value):
+        raise TypeError("SoftwareItem is shared and read-only")
+
+    def __getitem__(self, key: str):
+        if key == "name":
+            return self.name
+        if key == "version":
+            return self.version
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self._KEYS)
+
+    def __len__(self) -> int:
+        return 2
+
+    def __repr__(self) -> str:
+        return f"SoftwareItem({self.name!r}, {self.version!r})"
+
+    def __reduce__(self):
+        return (SoftwareItem, (self.name, self.version))
+
+
+class Device(Mapping):
+    """One MeshCentral device. Read-only; see the module docstring."""
+
+    # dict-compat keys, in the order the old device dicts had them
+    KEYS = (
+        "id", "name", "group", "online", "ip", "lc_addr", "offline_hours",
+        "os", "os_arch", "os_build", "os_sn", "os_install", "os_domain",
+        "cpu", "ram_total", "ram_details", "gpu", "resolution", "drives", "volumes",
+        "vol_alerts", "volumes_raw", "board", "board_sn", "bios", "bios_mode", "tpm",
+        "antivirus", "av_disabled", "firewall", "auto_update",
+        "nics", "nic_details", "dns", "users", "last_boot",
+        "agent_ver", "agent_core", "software",
+    )
+    _KEY_SET = frozenset(KEYS)
+
+    __slots__ = (
+        "id", "name", "group", "online", "ip", "lc_addr", "offline_hours", "lc_time",
+        "os", "os_arch", "os_build", "os_sn", "os_install", "os_domain",
+        "cpu", "ram_bytes", "ram_modules", "gpu", "resolution",
+        "drive_data", "volume_data",
+        "board", "board_sn", "bios", "bios_mode", "tpm",
+        "av", "firewall", "auto_update",
+        "nic_details", "dns", "users", "last_boot_ms",
+        "agent_ver", "agent_core", "software",
+    )
+    id: str
+    name: str
+    group: str
+    online: bool
+    ip: str
+    lc_addr: str
+    offline_hours: float
+    lc_time: int | None           # lastconnect, epoch ms
+    ram_bytes: int
+    ram_modules: tuple            # (slot, capacity bytes, part number, speed MHz)
+    drive_data: tuple             # (model, size bytes)
+    volume_data: tuple            # (letter, label, fs type, size bytes, free bytes)
+    av: tuple                     # raw antivirus entries (FrozenDict)
+    nic_details: tuple            # FrozenDict(name, ips, mac, status, speed)
+    last_boot_ms: int | None
+    software: tuple               # SoftwareItem, shared between devices
+
+    def __init__(self, **fields):
+        for k in self.__slots__:
+            object.__setattr__(self, k, fields[k])
+
+    def __setattr__(self, key, value):
+        raise TypeError("Device is shared and read-only")
+
+    __delattr__ = __setattr__
+
+    def with_status(self, online: bool, offline_hours: float) -> "Device":
+        """Copy with a new online/offline_hours (everything else shared)."""
+        if online == self.online and offline_hours == self.offline_hours:
+            return self
+        new = object.__new__(Device)
+        for k in self.__slots__:
+            object.__setattr__(new, k, getattr(self, k))
+        object.__setattr__(new, "online", online)
+        object.__setattr__(new, "offline_hours", offline_hours)
+        return new
+
+    # ── display fields, formatted on access ──
+
+    @property
+    def ram_total(self) -> str:
+        return fmt_size(self.ram_bytes)
+
+    @property
+    def ram_details(self) -> tuple:
+        return tuple(f"{slot}: {fmt_size(cap)} {pn} {spd}MHz" for slot, cap, pn, spd in self.ram_modules)
+
+    @property
+    def drives(self) -> tuple:
+        return tuple(f"{model} ({fmt_size(size)})" for model, size in self.drive_data)
+
+    @property
+    def volumes(self) -> tuple:
+        return tuple(f"{letter}:{f' [{label}]' if label else ''} {vtype} {fmt_size(free)}/{fmt_size(size)} free"
+                     for letter, label, vtype, size, free in self.volume_data)
+
+    @property
+    def vol_alerts(self) -> tuple:
+        alerts = []
+        for letter, _, _, size, free in self.volume_data:
+            if size and free:
+                used_pct = (1 - free / size) * 100
+                if used_pct >= 90:
+                    alerts.append(f"{letter}: {used_pct:.0f}%")
+        return tuple(alerts)
+
+    @property
+    def volumes_raw(self) -> FrozenDict:
+        return FrozenDict({letter: FrozenDict(total=size, free=free)
+                           for letter, _, _, size, free in self.volume_data if size > 0})
+
+    @property
+    def antivirus(self) -> str:
+        if not self.av:
+            return "-"
+        return ", ".join(f"{a.get('product', '?')} ({'on' if a.get('enabled') else 'off'})" for a in self.av)
+
+    @property
+    def av_disabled(self) -> bool:
+        return any(not a.get("enabled", True) for a in self.av)
+
+    @property
+    def nics(self) -> tuple:
+        return tuple(f"{nic['name']}: {', '.join(nic['ips'])} ({nic['mac']}) {nic['speed']} [{nic['status']}]"
+                     for nic in self.nic_details[:5])
+
+    @property
+    def last_boot(self) -> str:
+        if not self.last_boot_ms:
+            return "-"
+        return datetime.fromtimestamp(self.last_boot_ms / 1000, tz=timezone.utc).strftime("%d.%m.%Y %H:%M")
+
+    # ── read-only Mapping over KEYS ──
+
+    def __getitem__(self, key: str):
+        if key not in self._KEY_SET:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __iter__(self):
+        return iter(self.KEYS)
+
+    def __len__(self) -> int:
+        return len(self.KEYS)
+
+    def __contains__(self, key) -> bool:
+        return key in self._KEY_SET
+
+    def as_dict(self) -> dict:
+        """Plain dict with every display field (JSON export)."""
+        d = {k: getattr(self, k) for k in self.KEYS}
+        d["software"] = [{"name": sw.name, "version": sw.version} for sw in self.software]
+        return d
+
+    def __repr__(self) -> str:
+        return f"Device({self.name!r}, {self.id!r}, online={self.online})"
+
+    def __reduce__(self):
+        return (_device_from_fields, ({k: getattr(self, k) for k in self.__slots__},))
+
+
+def _device_from_fields(fields: dict) -> Device:
+    return Device(**fields)
+
+
+def _int(v) -> int:
+    return int(v) if v else 0
+
+
+def _software_pairs(software) -> tuple:
+    if isinstance(software, dict):
+        return tuple((name, info.get("version", "") if isinstance(info, dict) else "")
+                     for name, info in software.items())
+    if isinstance(software, list):
+        return tuple((sw.get("name", "?"), sw.get("version", "")) for sw in software)
+    return ()
+
+
+def _plain_software(pairs: tuple) -> tuple:
+    return tuple(SoftwareItem(name, ver) for name, ver in pairs)
+
+
+def build_device(nid: str, n: dict, si: dict, ii: dict, lc: dict, group: str,
+                 software=_plain_software) -> Device:
+    """Parse one node's DB records into a Device (status fields left at defaults).
+    software(pairs) turns the ((name, version), ...) inventory into the stored tuple.
+    """
+    hw = si.get("hardware", {})
+    win = hw.get("windows", {})
+    ident = hw.get("identifiers", {})
+    tpm = hw.get("tpm", {})
+    net_info = hw.get("network", {})
+
+    # CPU
+    cpus = win.get("cpu", [])
+    cpu_str = ", ".join(c.get("Name", "?").strip() for c in cpus) if cpus else ident.get("cpu_name", "-")
+
+    # RAM
+    ram_modules = tuple(
+        (m.get("DeviceLocator", ""), _int(m.get("Capacity", 0)), m.get("PartNumber", "").strip(), m.get("Speed", ""))
+        for m in win.get("memory", [])
+    )
+
+    # GPU
+    gpus = win.get("gpu", [])
+    gpu_str = ", ".join(g.get("Name", "?") for g in gpus) if gpus else ", ".join(ident.get("gpu_name", []))
+
+    # Drives
+    drives = win.get("drives", []) or ident.get("storage_devices", [])
+    drive_data = tuple((d.get("Model", d.get("Caption", "?")), _int(d.get("Size", 0))) for d in drives)
+
+    # Volumes
+    volume_data = tuple(
+        (letter, v.get("name", ""), v.get("type", ""), _int(v.get("size", 0)), _int(v.get("sizeremaining", 0)))
+        for letter, v in win.get("volumes", {}).items()
+    )
+
+    # Motherboard & BIOS
+    board = f"{ident.get('board_vendor', '')} {ident.get('board_name', '')}".strip() or "-"
+    bios_date = ident.get("bios_date", "")
+    bios = f"{ident.get('bios_vendor', '')} v{ident.get('bios_version', '')} ({bios_date[:8]})".strip()
+
+    # OS details
+    osinfo = win.get("osinfo", {})
+    wsc = n.get("wsc", {})
+
+    # Network interfaces
+    netifs = ii.get("netif2", {})
+    nic_details = []
+    for iname, addrs in netifs.items():
+        if "Loopback" in iname:
+            continue
+        ipv4s = [a["address"] for a in addrs if a.get("family") == "IPv4" and not a["address"].startswith("169.254")]
+        mac = addrs[0].get("mac", "") if addrs else ""
+        status = addrs[0].get("status", "") if addrs else ""
+        speed = addrs[0].get("speed", 0) if addrs else 0
+        speed_str = f"{speed // 1_000_000}Mbps" if speed and speed < 9e18 else ""
+        if ipv4s:
+            nic_details.append({"name": iname, "ips": ipv4s, "mac": mac, "status": status, "speed": speed_str})
+
+    # Resolution
+    res_str = "-"
+    if gpus:
+        g = gpus[0]
+        h = g.get("CurrentHorizontalResolution")
+        v = g.get("CurrentVerticalResolution")
+        if h and v:
+            res_str = f"{h}x{v}"
+
+    agent = n.get("agent", {})
+    return Device(
+        id=nid,
+        name=n.get("name", "?"),
+        group=group,
+        online=False,               # set by with_status()
+        ip=n.get("ip", ""),
+        lc_addr=lc.get("addr", "-"),
+        offline_hours=0,            # set by with_status()
+        lc_time=lc.get("time"),
+        # OS
+        os=osinfo.get("Caption", n.get("osdesc", "")),
+        os_arch=osinfo.get("OSArchitecture", ""),
+        os_build=osinfo.get("BuildNumber", ""),
+        os_sn=osinfo.get("SerialNumber", "-"),
+        os_install=osinfo.get("InstallDate", "")[:8] if osinfo.get("InstallDate") else "-",
+        os_domain=osinfo.get("Domain", "WORKGROUP"),
+        # Hardware
+        cpu=cpu_str,
+        ram_bytes=sum(m[1] for m in ram_modules),
+        ram_modules=ram_modules,
+        gpu=gpu_str or "-",
+        resolution=res_str,
+        drive_data=drive_data,
+        volume_data=volume_data,
+        board=board,
+        board_sn=ident.get("board_serial", "-"),
+        bios=bios,
+        bios_mode=ident.get("bios_mode", "-"),
+        tpm=f"v{tpm.get('SpecVersion', '?')} {tpm.get('ManufacturerId', '')}" if tpm else "-",
+        # Security
+        av=freeze(n.get("av", [])),
+        firewall=wsc.get("firewall", "-"),
+        auto_update=wsc.get("autoUpdate", "-"),
+        # Network
+        nic_details=freeze(nic_details),
+        dns=freeze(net_info.get("dns", [])),
+        # Users
+        users=freeze(n.get("users", [])),
+        last_boot_ms=n.get("lastbootuptime"),
+        # Agent
+        agent_ver=str(agent.get("ver", "")),
+        agent_core=agent.get("core", ""),
+        # Software
+        software=software(_software_pairs(win.get("software", {}))),
+    )
+
+
+def device_status(dev: Device, realtime_online: set, now_ms: float) -> Device:
+    """Device with online/offline_hours for this moment."""
+    lc_time = dev.lc_time
+    if realtime_online:
+        # meshctrl gave us live data — use it as source of truth
+        online = dev.id in realtime_online
+        offline_hours = 0 if online else (
+            (now_ms - lc_time) / 3_600_000 if lc_time else 0
+        )
+    else:
+        # fallback: use lastconnect timestamp (less accurate for stable connections)
+        online = False
+        offline_hours = 0
+        if lc_time:
+            diff_ms = now_ms - lc_time
+            online = diff_ms < 300_000
+            offline_hours = diff_ms / 3_600_000 if not online else 0
+    return dev.with_status(online, offline_hours)
+
+
+class DeviceCache:
+    """Parsed devices per node ID, re-derived only when the node's records change."""
+
+    def __init__(self):
+        # node ID → (fingerprint, group name, Device)
+        self._entries: dict[str, tuple] = {}
+        # software interning: (name, version) → entry, inventory → shared tuple
+        self._sw_entries: dict[tuple, SoftwareItem] = {}
+        self._sw_lists: dict[tuple, tuple] = {}
+        self.stats = {"rebuilt": 0, "reused": 0, "dropped": 0, "sw_shared": 0}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def clear(self):
+        self._entries.clear()
+        self._sw_entries.clear()
+        self._sw_lists.clear()
+
+    def _software(self, pairs: tuple) -> tuple:
+        shared = self._sw_lists.get(pairs)
+        if shared is not None:
+            self.stats["sw_shared"] += 1
+            return shared
+        entries = self._sw_entries
+        items = []
+        for pair in pairs:
+            e = entries.get(pair)
+            if e is None:
+                e = entries[pair] = SoftwareItem(*pair)
+            items.append(e)
+        shared = self._sw_lists[pairs] = tuple(items)
+        return shared
+
+    def _prune_software(self):
+        """Forget inventories no cached device uses any more."""
+        live = {id(e[2].software) for e in self._entries.values()}
+        self._sw_lists = {k: v for k, v in self._sw_lists.items() if id(v) in live}
+        used = {pair for pairs in self._sw_lists for pair in pairs}
+        self._sw_entries = {k: v for k, v in self._sw_entries.items() if k in used}
+
+    def devices(self, rs, realtime_online: set) -> list[Device]:
+        meshes = {mid: m.get("name", "?") for mid, m in rs.meshes.items()}
+        now_ms = time.time() * 1000
+        entries = self._entries
+        seen = set()
+        result = []
+        for nid, n in rs.nodes.items():
+            seen.add(nid)
+            fp = rs.fingerprint(nid)
+            group = meshes.get(n.get("meshid", ""), "?")
+            entry = entries.get(nid)
+            if entry is None or entry[0] != fp or entry[1] != group:
+                dev = build_device(nid, n, rs.sysinfo.get(nid, {}), rs.ifinfo.get(nid, {}),
+                                   rs.lastconnect.get(nid, {}), group, software=self._software)
+                entry = entries[nid] = (fp, group, dev)
+                self.stats["rebuilt"] += 1
+            else:
+                self.stats["reused"] += 1
+            result.append(device_status(entry[2], realtime_online, now_ms))
+        if len(seen) != len(entries):
+            for nid in [k for k in entries if k not in seen]:
+                del entries[nid]
+                self.stats["dropped"] += 1
+        if len(self._sw_lists) > 2 * len(entries) + 64:
+            self._prune_software()
+        return result
+
+
+def normalize_mac(mac: str) -> str:
+    return mac.strip().lower().replace("-", ":")
+
+
+class DeviceIndex:
+    """Lookups over one device refresh. Unique keys map to the first device in
+    list order (like next(x for x in devs if ...)); shared keys map to tuples.
+    """
+
+    _NO_SERIAL = frozenset(("", "-", "0", "none", "default string", "to be filled by o.e.m.",
+                            "system serial number"))
+
+    def __init__(self, devices):
+        self.devices: tuple = tuple(devices)
+        self._id: dict[str, Device] = {}
+        self._name: dict[str, Device] = {}
+        self._name_ci: dict[str, Device] = {}
+        groups: dict[str, list] = {}
+        wan: dict[str, list] = {}
+        lan: dict[str, list] = {}
+        mac: dict[str, list] = {}
+        serial: dict[str, list] = {}
+        online = []
+        for d in self.devices:
+            if d.online:
+                online.append(d)
+            self._id.setdefault(d.id, d)
+            self._name.setdefault(d.name, d)
+            self._name_ci.setdefault(d.name.casefold(), d)
+            groups.setdefault(d.group, []).append(d)
+            if d.ip:
+                wan.setdefault(d.ip, []).append(d)
+            for nic in d.nic_details:
+                for ip in nic["ips"]:
+                    lan.setdefault(ip, []).append(d)
+                m = normalize_mac(nic["mac"])
+                if m and m != "00:00:00:00:00:00":
+                    mac.setdefault(m, []).append(d)
+            for sn in {d.board_sn, d.os_sn}:
+                if isinstance(sn, str) and sn.strip().casefold() not in self._NO_SERIAL:
+                    serial.setdefault(sn.strip().casefold(), []).append(d)
+        self._groups = {g: tuple(v) for g, v in groups.items()}
+        self._groups_ci: dict[str, tuple] = {}
+        for g, v in self._groups.items():
+            key = g.casefold()
+            self._groups_ci[key] = self._groups_ci.get(key, ()) + v
+        self._wan = {k: tuple(v) for k, v in wan.items()}
+        self._lan = {k: tuple(v) for k, v in lan.items()}
+        self._mac = {k: tuple(v) for k, v in mac.items()}
+        self._serial = {k: tuple(v) for k, v in serial.items()}
+        self.online: tuple = tuple(online)     # online devices, in list order
+
+    def __len__(self) -> int:
+        return len(self.devices)
+
+    def get(self, node_id: str) -> Device | None:
+        return self._id.get(node_id)
+
+    def by_name(self, name: str, ignore_case: bool = False) -> Device | None:
+        if ignore_case:
+            return self._name_ci.get(name.casefold())
+        return self._name.get(name)
+
+    def group(self, name: str, ignore_case: bool = False) -> tuple:
+        if ignore_case:
+            return self._groups_ci.get(name.casefold(), ())
+        return self._groups.get(name, ())
+
+    @property
+    def groups(self) -> dict[str, tuple]:
+        """Group name → its devices, groups in order of first appearance."""
+        return self._groups
+
+    def by_wan_ip(self, ip: str) -> tuple:
+        return self._wan.get(ip, ())
+
+    def by_lan_ip(self, ip: str) -> tuple:
+        return self._lan.get(ip, ())
+
+    def by_mac(self, mac: str) -> tuple:
+        return self._mac.get(normalize_mac(mac), ())
+
+    def by_serial(self, serial: str) -> tuple:
+        """Devices whose board or OS serial matches (case-insensitive)."""
+        return self._serial.get(serial.strip().casefold(), ())
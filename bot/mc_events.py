@@ -0,0 +1,105 @@
+"""
+Device event bus for the bot's background loops.
+
+Every device refresh (one DeviceIndex) is published once. The bus diffs it
+against the previous refresh and fans typed DeviceEvents out to subscriber
+queues, so loops react to what changed instead of each one pulling the
+device list on its own timer and working out the difference itself.
+
+Event kinds:
+    added     node appeared
+    removed   node is gone (event.device is its last known state)
+    online    online state flipped (event.device.online is the new state)
+    hardware  CPU, RAM, GPU, board/BIOS, drives or network adapters changed
+    volumes   volume sizes/free space changed
+
+The first refresh only sets the baseline and publishes nothing.
+"""
+
+import asyncio
+import logging
+
+from mc_devices import Device, DeviceIndex
+
+log = logging.getLogger("mc-bot")
+
+ADDED = "added"
+REMOVED = "removed"
+ONLINE = "online"
+HARDWARE = "hardware"
+VOLUMES = "volumes"
+KINDS = (ADDED, REMOVED, ONLINE, HARDWARE, VOLUMES)
+
+
+class DeviceEvent:
+    __slots__ = ("kind", "device", "prev")
+
+    def __init__(self, kind: str, device: Device, prev: Device | None = None):
+        self.kind = kind
+        self.device = device      # current state (last known for removed)
+        self.prev = prev          # state in the previous refresh (None for added)
+
+    def __repr__(self) -> str:
+        return f"DeviceEvent({self.kind}, {self.device.name!r})"
+
+
+def _hardware(d: Device) -> tuple:
+    return (d.cpu, d.ram_bytes, d.ram_modules, d.gpu, d.board, d.board_sn, d.bios,
+            d.drive_data, d.nic_details)
+
+
+def diff_devices(prev: DeviceIndex, cur: DeviceIndex) -> list[DeviceEvent]:
+    """Events that turn refresh prev into refresh cur."""
+    events = []
+    for d in cur.devices:
+        p = prev.get(d.id)
+        if p is None:
+            events.append(DeviceEvent(ADDED, d))
+            continue
+        if p is d:
+            continue
+        if p.online != d.online:
+            events.append(DeviceEvent(ONLINE, d, p))
+        if _hardware(p) != _hardware(d):
+            events.append(DeviceEvent(HARDWARE, d, p))
+        if p.volume_data != d.volume_data:
+            events.append(DeviceEvent(VOLUMES, d, p))
+    if len(prev) > len(cur) - sum(e.kind == ADDED for e in events):
+        for p in prev.devices:
+            if cur.get(p.id) is None:
+                events.append(DeviceEvent(REMOVED, p, p))
+    return events
+
+
+class DeviceEventBus:
+    """Fan-out of DeviceEvents to asyncio queues, one per subscriber."""
+
+    def __init__(self):
+        self.index: DeviceIndex | None = None    # last published refresh
+        self._subs: list[tuple[asyncio.Queue, frozenset]] = []
+        self.stats = {"refreshes": 0, "events": 0, **{k: 0 for k in KINDS}}
+
+    def subscribe(self, kinds=KINDS) -> asyncio.Queue:
+        """Queue that receives every later event of the given kinds."""
+        q: asyncio.Queue = asyncio.Queue()
+        self._subs.append((q, frozenset(kinds)))
+        return q
+
+    def unsubscribe(self, q: asyncio.Queue):
+        self._subs = [s for s in self._subs if s[0] is not q]
+
+    def publish(self, index: DeviceIndex) -> list[DeviceEvent]:
+        """Diff a new refresh against the previous one and deliver the events."""
+        prev, self.index = self.index, index
+        if prev is None or prev is index:
+            return []
+        self.stats["refreshes"] += 1
+        events = diff_devices(prev, index)
+        for ev in events:
+            self.stats["events"] += 1
+            self.stats[ev.kind] += 1
+            for q, kinds in self._subs:
+                if ev.kind in kinds:
+                    q.put_nowait(ev)
+        return events
+
@@ -0,0 +1,222 @@
+"""
+Disk-fill forecast for the whole fleet from the daily disk snapshots.
+
+Every (device, volume) is a series of used GB by day. All series are fitted
+at once — with NumPy as one devices·volumes × days matrix (NaN where a day is
+missing), without it in plain Python — three ways:
+
+  ols      least squares over the whole history (what /disk_trend used to show)
+  recent   least squares over the last `window` days only: catches a disk
+           that started filling faster
+  robust   Theil–Sen (median of the pairwise slopes): one cleanup or a
+           one-off big copy doesn't tilt the line
+
+days_to_full comes from the robust slope (least squares with fewer than 3
+points) and its range from the least-squares standard error around it (95 %,
+Student t); the upper end is None when the disk may as well not be filling.
+
+DiskForecaster caches the result until the history changes (the bot passes
+a key that moves with every disk snapshot).
+"""
+
+import logging
+import math
+import statistics
+import time
+from datetime import date
+
+try:
+    import numpy as np
+    HAS_NUMPY = True
+except ImportError:
+    np = None
+    HAS_NUMPY = False
+
+log = logging.getLogger("mc-bot")
+
+GB = 1_073_741_824
+MIN_RATE = 0.001        # GB/day; slower counts as stable
+_PAIR_BLOCK = 4_000_000 # slopes held at once by the NumPy Theil–Sen
+
+# two-sided 95 % Student t by degrees of freedom (≥ the key), normal beyond 30
+_T95 = ((30, 2.04), (20, 2.09), (15, 2.13), (10, 2.23), (9, 2.26), (8, 2.31), (7, 2.36),
+        (6, 2.45), (5, 2.57), (4, 2.78), (3, 3.18), (2, 4.30), (1, 12.71))
+
+
+def _t95(df: int) -> float:
+    if df > 30:
+        return 1.96
+    return next(t for k, t in _T95 if df >= k)
+
+
+def _series(history: dict[str, list[dict]]):
+    """[(device, letter, days, used_gb, total_gb)] from {device: [{"date", "volumes"}]},
+    days as day numbers (each date string parsed once)."""
+    ordinals: dict[str, int] = {}
+    out = []
+    for device, entries in history.items():
+        vols: dict[str, tuple[list, list]] = {}
+        for e in entries:
+            day = ordinals.get(e["date"])
+            if day is None:
+                day = ordinals[e["date"]] = date.fromisoformat(e["date"]).toordinal()
+            for letter, v in (e.get("volumes") or {}).items():
+                total = v.get("total", 0)
+                if total <= 0:
+                    continue
+                xs, ys = vols.setdefault(letter, ([], []))
+                xs.append(day)
+                ys.append((total - v.get("free", 0)) / GB)
+        last = (entries[-1].get("volumes") or {}) if entries else {}
+        for letter, (xs, ys) in vols.items():
+            total = (last.get(letter) or {}).get("total", 0)
+            if len(xs) >= 2 and total > 0:
+                out.append((device, letter, xs, ys, total / GB))
+    return out
+
+
+# ── fits: per series (slope, intercept, se, recent slope, robust slope, n) ──
+
+def _fit_numpy(series, window: int):
+    days = sorted({x for s in series for x in s[2]})
+    col = {d: i for i, d in enumerate(days)}
+    x = np.array(days, dtype=float) - days[-1]                  # ≤ 0, today = 0
+    y = np.full((len(series), len(days)), np.nan)
+    for i, s in enumerate(series):
+        y[i, [col[d] for d in s[2]]] = s[3]
+    mask = ~np.isnan(y)
+    y0 = np.where(mask, y, 0.0)
+
+    def ols(m):
+        w = m.astype(float)
+        n = w.sum(1)
+        sx, sy = w @ x, (w * y0).sum(1)
+        sxx, sxy = w @ (x * x), (w * y0) @ x
+        sxx_c = sxx - sx * sx / np.maximum(n, 1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            a = (sxy - sx * sy / np.maximum(n, 1)) / sxx_c
+            b = (sy - a * sx) / n
+        return a, b, n, sxx_c
+
+    a, b, n, sxx_c = ols(mask)
+    resid = np.where(mask, y0 - (a[:, None] * x + b[:, None]), 0.0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        se = np.sqrt((resid ** 2).sum(1) / (n - 2) / sxx_c)
+    se = np.where(n > 2, se, np.nan)
+
+    last_x = np.where(mask, x, -np.inf).max(1)
+    recent, _, n_recent, _ = ols(mask & (x >= (last_x - window)[:, None]))
+    recent = np.where(n_recent >= 2, recent, np.nan)
+
+    # Theil–Sen: median over i < j of (y_j − y_i) / (x_j − x_i), built lag by
+    # lag from slices; missing days give NaN, sorted last as inf
+    lags = range(1, len(days))
+    robust = np.full(len(series), np.nan)
+    step = max(1, _PAIR_BLOCK // max(len(days) ** 2 // 2, 1))    # series per block
+    for r in range(0, len(series) if lags else 0, step):         # one day: no pairs
+        yb = y[r:r + step]
+        slopes = np.concatenate([(yb[:, lag:] - yb[:, :-lag]) / (x[lag:] - x[:-lag]) for lag in lags], axis=1)
+        missing = np.isnan(slopes)
+        k = slopes.shape[1] - missing.sum(1)
+        slopes[missing] = np.inf
+        slopes.sort(axis=1)
+        rows = np.arange(len(k))
+        med = (slopes[rows, np.maximum(k - 1, 0) // 2] + slopes[rows, k // 2]) / 2
+        robust[r:r + step] = np.where(k > 0, med, np.nan)
+    return zip(a.tolist(), b.tolist(), se.tolist(), recent.tolist(), robust.tolist(), n.astype(int).tolist())
+
+
+def _ols_py(xs, ys):
+    n = len(xs)
+    mx, my = sum(xs) / n, sum(ys) / n
+    sxx = sum((x - mx) ** 2 for x in xs)
+    if sxx == 0:
+        return math.nan, math.nan, math.nan
+    a = sum((x - mx) * (y - my) for x, y in zip(xs, ys)) / sxx
+    b = my - a * mx
+    se = math.nan
+    if n > 2:
+        se = math.sqrt(sum((y - a * x - b) ** 2 for x, y in zip(xs, ys)) / (n - 2) / sxx)
+    return a, b, se
+
+
+def _fit_python(series, window: int):
+    today = max(x for s in series for x in s[2])
+    for _, _, xs, ys, _ in series:
+        xs = [x - today for x in xs]
+        a, b, se = _ols_py(xs, ys)
+        tail = [(x, y) for x, y in zip(xs, ys) if x >= xs[-1] - window]
+        recent = _ols_py(*zip(*tail))[0] if len(tail) >= 2 else math.nan
+        pairs = [(ys[q] - ys[p]) / (xs[q] - xs[p])
+                 for p in range(len(xs)) for q in range(p + 1, len(xs)) if xs[q] != xs[p]]
+        robust = statistics.median(pairs) if pairs else math.nan
+        yield a, b, se, recent, robust, len(xs)
+
+
+def forecast(history: dict[str, list[dict]], window: int = 14, use_numpy: bool = True) -> list[dict]:
+    """Trend per (device, volume) with ≥ 2 snapshots, soonest to fill first."""
+    series = _series(history)
+    if not series:
+        return []
+    fits = (_fit_numpy if use_numpy and HAS_NUMPY else _fit_python)(series, window)
+    trends = []
+    for (device, letter, xs, ys, total_gb), (a, b, se, recent, robust, n) in zip(series, fits):
+        if math.isnan(a):
+            continue
+        rate = robust if n >= 3 and not math.isnan(robust) else a
+        used = ys[-1]
+        free = total_gb - used
+        left = max(free, 0.0)
+        d2f = lo = hi = None
+        if rate > MIN_RATE:
+            d2f = left / rate
+            if not math.isnan(se):
+                margin = _t95(n - 2) * se
+                lo = left / (rate + margin)
+                hi = left / (rate - margin) if rate - margin > MIN_RATE else None
+        trends.append({
+            "device": device,
+            "letter": letter,
+            "used_gb": round(used, 1),
+            "total_gb": round(total_gb, 1),
+            "free_gb": round(free, 1),
+            "used_pct": round(used / total_gb * 100, 1),
+            "fill_rate_gb_day": round(rate, 3),
+            "fill_rate_ols": round(a, 3),
+            "fill_rate_recent": None if math.isnan(recent) else round(recent, 3),
+            "days_to_full": round(d2f) if d2f is not None else None,
+            "days_to_full_min": round(lo) if lo is not None else None,
+            "days_to_full_max": round(hi) if hi is not None else None,
+            "points": n,
+        })
+    trends.sort(key=lambda t: (t["days_to_full"] is None, t["days_to_full"] or 99999))
+    return trends
+
+
+class DiskForecaster:
+    """forecast() cached by a key that changes with the disk history."""
+
+    def __init__(self, window: int = 14):
+        self.window = window
+        self._key = None
+        self.trends: list[dict] = []
+        self.devices = 0        # in the history the cached trends were computed from
+        self.points = 0
+        self.stats = {"hits": 0, "runs": 0, "last_ms": 0.0}
+
+    def get(self, key, load) -> list[dict]:
+        """Cached trends while key is unchanged; otherwise forecast(load())."""
+        if key is not None and key == self._key:
+            self.stats["hits"] += 1
+            return self.trends
+        t0 = time.perf_counter()
+        history = load()
+        self.trends = forecast(history, self.window)
+        self.devices = len(history)
+        self.points = sum(len(v) for v in history.values())
+        self._key = key
+        self.stats["runs"] += 1
+        self.stats["last_ms"] = (time.perf_counter() - t0) * 1000
+        log.info(f"disk forecast: {len(self.trends)} volumes of {self.devices} devices "
+                 f"in {self.stats['last_ms']:.0f} ms ({'numpy' if HAS_NUMPY else 'python'})")
+        return self.trends
@@ -0,0 +1,125 @@
+"""
+Per-device, per-probe circuit breaker for the background polls.
+
+Every (device, probe) pair — hardware, temperature, Wi-Fi, SNMP, ... — has
+a health record. Consecutive failures (timeouts, transport errors, no
+result) past a threshold open the circuit: the polls skip that pair until
+its backoff expires, so agents that never answer stop costing a 30-90 s
+timeout on every cycle. The backoff doubles with every failed retry, up to
+max_delay.
+
+When the backoff expires the circuit goes half-open and exactly one trial
+call is let through (allow() returns True once). Its success closes the
+circuit; its failure opens it again for longer. A trial that never reports
+back is given up after trial_timeout and the next allow() starts a new one.
+
+State lives in memory only: after a restart every pair gets one fresh try.
+"""
+
+import logging
+import random
+import time
+
+log = logging.getLogger("mc-bot")
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class ProbeHealth:
+    __slots__ = ("node", "probe", "state", "failures", "opens", "retry_at", "trial_at",
+                 "last_error", "last_fail")
+
+    def __init__(self, node: str, probe: str):
+        self.node = node
+        self.probe = probe
+        self.state = CLOSED
+        self.failures = 0             # consecutive
+        self.opens = 0                # consecutive openings (backoff exponent)
+        self.retry_at = 0.0
+        self.trial_at = 0.0
+        self.last_error = ""
+        self.last_fail = 0.0
+
+    def __repr__(self) -> str:
+        return f"ProbeHealth({self.node!r}, {self.probe}, {self.state}, failures={self.failures})"
+
+
+class CircuitBreaker:
+    """Health records by (node ID, probe); see the module docstring."""
+
+    def __init__(self, threshold: int = 3, base_delay: float = 600, max_delay: float = 6 * 3600,
+                 trial_timeout: float = 600):
+        self.threshold = threshold
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.trial_timeout = trial_timeout
+        self.records: dict[tuple[str, str], ProbeHealth] = {}
+        self.stats = {"skipped": 0, "opened": 0, "recovered": 0, "trials": 0}
+
+    def get(self, node: str, probe: str) -> ProbeHealth | None:
+        return self.records.get((node, probe))
+
+    def allow(self, node: str, probe: str, now: float | None = None) -> bool:
+        """Whether the poll may call probe on node now (claims the trial when half-open)."""
+        h = self.records.get((node, probe))
+        if h is None or h.state == CLOSED:
+            return True
+        now = time.time() if now is None else now
+        if h.state == OPEN and now < h.retry_at:
+            self.stats["skipped"] += 1
+            return False
+        if h.state == HALF_OPEN and now - h.trial_at < self.trial_timeout:
+            self.stats["skipped"] += 1
+            return False
+        h.state = HALF_OPEN
+        h.trial_at = now
+        self.stats["trials"] += 1
+        return True
+
+    def success(self, node: str, probe: str):
+        h = self.records.get((node, probe))
+        if h is None:
+            return
+        if h.state != CLOSED:
+            self.stats["recovered"] += 1
+            log.info(f"health: {node}/{probe} recovered after {h.failures} failures")
+        del self.records[(node, probe)]
+
+    def failure(self, node: str, probe: str, error: str = ""):
+        now = time.time()
+        h = self.records.get((node, probe))
+        if h is None:
+            h = self.records[(node, probe)] = ProbeHealth(node, probe)
+        h.failures += 1
+        h.last_fail = now
+        h.last_error = (error or "нет результата")[:200]
+        if h.state == HALF_OPEN or h.failures >= self.threshold:
+            delay = min(self.max_delay, self.base_delay * 2 ** h.opens)
+            h.retry_at = now + delay * random.uniform(0.9, 1.1)    # spread retries of a whole group
+            h.opens += 1
+            if h.state == CLOSED:
+                self.stats["opened"] += 1
+                log.warning(f"health: {node}/{probe} circuit open for {delay:.0f}s "
+                            f"after {h.failures} failures: {h.last_error}")
+            h.state = OPEN
+
+    def record(self, node: str, probe: str, ok: bool, error: str = ""):
+        if ok:
+            self.success(node, probe)
+        else:
+            self.failure(node, probe, error)
+
+    def reset(self, node: str | None = None, probe: str | None = None) -> int:
+        """Forget records (all, or matching node / probe); they get polled next cycle."""
+        keys = [k for k in self.records
+                if (node is None or k[0] == node) and (probe is None or k[1] == probe)]
+        for k in keys:
+            del self.records[k]
+        return len(keys)
+
+    def broken(self) -> list[ProbeHealth]:
+        """Open and half-open records, soonest retry first."""
+        return sorted((h for h in self.records.values() if h.state != CLOSED),
+                      key=lambda h: (h.retry_at, h.node, h.probe))
@@ -0,0 +1,134 @@
+"""
+Push-based online tracking for the bot.
+
+MeshCentral sends every control.ashx session a `nodeconnect` event whenever
+an agent connects or disconnects. PresenceTracker listens for those on the
+shared MCControlChannel and keeps the set of online node IDs current without
+polling ListDevices.
+
+Events sent while the channel was down are lost, so the set is only trusted
+(`live`) after a full ListDevices snapshot (reconcile) was taken on the
+current connection, and only for `reconcile_interval` seconds after it; the
+periodic reconcile corrects any drift. When not live, callers poll as before.
+"""
+
+import logging
+import time
+from typing import Callable
+
+from mc_control import MCControlChannel
+
+log = logging.getLogger("mc-bot")
+
+# conn bit set while the MeshAgent itself is connected (2 = CIRA, 4 = AMT, 8 = relay)
+CONN_AGENT = 1
+
+
+class PresenceTracker:
+    """Online node IDs kept current from the channel's nodeconnect events."""
+
+    def __init__(self, channel: MCControlChannel, reconcile_interval: float = 600):
+        self.channel = channel
+        self.reconcile_interval = reconcile_interval
+        self.online: set[str] = set()
+        self.generation = 0              # bumped whenever the online set changes
+        self._synced_conn: int | None = None   # channel connection the last reconcile ran on
+        self._synced_at = 0.0
+        # node ID → (monotonic time, online) of events since the last reconcile started
+        self._events: dict[str, tuple[float, bool]] = {}
+        self._listeners: list[Callable[[str, bool], None]] = []
+        self.stats = {"events": 0, "changes": 0, "reconciles": 0, "drift": 0}
+        channel.add_listener(self._on_message)
+
+    def add_listener(self, fn: Callable[[str, bool], None]):
+        """fn(node_id, online) is called for every change of a node's state."""
+        self._listeners.append(fn)
+
+    @property
+    def live(self) -> bool:
+        """True while the online set can be used as is (no poll needed)."""
+        return (self.channel.connected
+                and self._synced_conn == self.channel.stats["connects"]
+                and time.monotonic() - self._synced_at < self.reconcile_interval)
+
+    @property
+    def age(self) -> float:
+        """Seconds since the last reconcile."""
+        return time.monotonic() - self._synced_at if self._synced_at else float("inf")
+
+    # ── events ──
+
+    def _on_message(self, msg: dict):
+        if msg.get("action") != "event":
+            return
+        ev = msg.get("event")
+        if not isinstance(ev, dict):
+            return
+        action = ev.get("action")
+        nid = ev.get("nodeid") or ""
+        if not nid.startswith("node//"):
+            return
+        if action == "nodeconnect":
+            online = bool(int(ev.get("conn") or 0) & CONN_AGENT)
+        elif action == "removenode":
+            online = False
+        else:
+            return
+        self.stats["events"] += 1
+        self._events[nid] = (time.monotonic(), online)
+        self._set(nid, online)
+
+    def _set(self, nid: str, online: bool):
+        if (nid in self.online) == online:
+            return
+        if online:
+            self.online.add(nid)
+        else:
+            self.online.discard(nid)
+        self.generation += 1
+        self.stats["changes"] += 1
+        for fn in self._listeners:
+            try:
+                fn(nid, online)
+            except Exception as e:
+                log.error(f"presence listener: {e}")
+
+    # ── reconcile ──
+
+    def begin(self) -> tuple[float, int | None]:
+        """Token to take right before requesting a ListDevices snapshot."""
+        conn = self.channel.stats["connects"] if self.channel.connected else None
+        return time.monotonic(), conn
+
+    def reconcile(self, online_ids, token: tuple[float, int | None]) -> int:
+        """Bring the set in line with a ListDevices snapshot requested at `token`
+        (see begin). Events that arrived after the request are newer than the
+        snapshot and win. Returns the number of nodes corrected.
+
+        The first reconcile just seeds the set; later ones also notify the
+        listeners about what the events missed (e.g. while reconnecting).
+        """
+        started, conn = token
+        target = set(online_ids)
+        for nid, (t, online) in self._events.items():
+            if t >= started:
+                if online:
+                    target.add(nid)
+                else:
+                    target.discard(nid)
+        self._events = {k: v for k, v in self._events.items() if v[0] >= started}
+        diff = target ^ self.online
+        if self._synced_at:
+            for nid in diff:
+                self._set(nid, nid in target)
+            self.stats["drift"] += len(diff)
+        elif diff:
+            self.online = target
+            self.generation += 1
+        self.stats["reconciles"] += 1
+        self._synced_at = time.monotonic()
+        if conn is not None and self.channel.connected and conn == self.channel.stats["connects"]:
+            self._synced_conn = conn
+        if diff and self.stats["reconciles"] > 1:
+            log.info(f"presence: reconcile corrected {len(diff)} node(s)")
+        return len(diff)
@@ -0,0 +1,328 @@
+"""
+PowerShell probe scripts cached on the agents.
+
+The probes (keenetic, SNMP, hardware, temperature, printers) are 2-20 KB
+each. Instead of sending the full script with every RunCommand, a script is
+installed once per agent into PROBE_DIR under a name carrying its content
+hash, and every later poll sends a short invocation of a few hundred bytes:
+
+    $p="...\\keenetic_probe-<hash>.ps1"; <read $p>; if (<its SHA-256 is right>) { & <script> -RouterLogin '...' } else { 'MCBOT-PROBE-MISSING' }
+
+The probes run as SYSTEM, so the cached copy is read once, checked against
+the script's full SHA-256 and run from those same bytes: a file that was
+changed on the agent counts as missing. If the agent answers with the
+MISSING marker (first poll after a bot restart, cleaned-up ProgramData, new
+agent, tampered file), the same call is repeated as a deploy: lock PROBE_DIR
+down to SYSTEM and Administrators (owner, no inherited ACEs), write the
+script (base64, so no quoting issues) and run it in one round trip. Editing a .ps1 changes its hash, so every agent gets the
+new version on its next poll and older versions are removed.
+
+Parameters are passed to the script's param() block; scripts are run as a
+scriptblock, so the agent's execution policy does not apply.
+
+Probe output comes back framed: the invocation gzips the script's output
+and prints it base64-encoded between GZ_BEGIN/GZ_END, so large results
+(client lists, inventories) cost a fraction of the bytes over the relay,
+don't depend on the agent's console code page and are either complete or
+detectably broken. decode_output() unwraps a frame and passes anything else
+through unchanged, so plain output (meshctrl fallback, old agents, the
+MISSING marker) still works. extract_json() then finds the JSON in it.
+
+ProbeBundle packs several probes into one cached script whose -Sections
+parameter picks which of them to run, all in one PowerShell session. The
+reply is one JSON document between BUNDLE_BEGIN/BUNDLE_END lines with each
+section's raw output (or error), see parse_bundle(). -Known passes what the
+bot already has per section ("hw=<fingerprint>"); sections see it as the
+$ProbeKnown hashtable and may answer with less.
+"""
+
+import base64
+import binascii
+import gzip
+import hashlib
+import json
+import logging
+import re
+from pathlib import Path
+from typing import Awaitable, Callable
+
+log = logging.getLogger("mc-bot")
+
+PROBE_DIR = r"$env:ProgramData\MeshCentralBot\probes"
+PROBE_MISSING = "MCBOT-PROBE-MISSING"
+BUNDLE_BEGIN = "MCBOT-BUNDLE-BEGIN"
+BUNDLE_END = "MCBOT-BUNDLE-END"
+GZ_BEGIN = "MCBOT-GZ:"
+GZ_END = ":MCBOT-GZ"
+# PROBE_DIR and its parent: owned by Administrators, only SYSTEM and Administrators
+# have access, nothing inherited from ProgramData (where users may create folders);
+# a junction planted there is refused rather than followed
+_LOCK_DIR = (
+    "$__a = New-Object Security.AccessControl.DirectorySecurity; "
+    "$__a.SetAccessRuleProtection($true, $false); "
+    "$__a.SetOwner((New-Object Security.Principal.SecurityIdentifier 'S-1-5-32-544')); "
+    "foreach ($__s in 'S-1-5-18', 'S-1-5-32-544') { $__a.AddAccessRule((New-Object "
+    "Security.AccessControl.FileSystemAccessRule((New-Object Security.Principal.SecurityIdentifier $__s), "
+    "'FullControl', 'ContainerInherit,ObjectInherit', 'None', 'Allow'))) }; "
+    "foreach ($__x in (Split-Path $d), $d) { "
+    "if ((Get-Item -LiteralPath $__x -Force).Attributes -band [IO.FileAttributes]::ReparsePoint) "
+    "{ throw \"$__x is a link, not using it\" }; "
+    "Set-Acl -LiteralPath $__x -AclObject $__a -ErrorAction Stop }"
+)
+# runs {cmd} and prints its output gzip+base64 between GZ_BEGIN/GZ_END
+_GZ_WRAP = (
+    "$__o = & {{ {cmd} }} | Out-String; "
+    "$__b = [Text.Encoding]::UTF8.GetBytes($__o); $__m = New-Object IO.MemoryStream; "
+    "$__z = New-Object IO.Compression.GZipStream($__m, [IO.Compression.CompressionMode]::Compress); "
+    "$__z.Write($__b, 0, $__b.Length); $__z.Close(); "
+    f"'{GZ_BEGIN}' + [Convert]::ToBase64String($__m.ToArray()) + '{GZ_END}'"
+)
+_PARAM_NAME = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+
+def ps_quote(value) -> str:
+    """PowerShell single-quoted string literal."""
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def decode_output(out: str) -> tuple[str, bool]:
+    """(text, framed): the probe output inside a gzip+base64 frame, or out
+    unchanged if it has none. Raises ValueError for a broken frame."""
+    begin = out.find(GZ_BEGIN)
+    if begin == -1:
+        return out, False
+    end = out.find(GZ_END, begin + len(GZ_BEGIN))
+    if end == -1:
+        raise ValueError("probe output frame is cut off")
+    payload = "".join(out[begin + len(GZ_BEGIN):end].split())
+    try:
+        data = gzip.decompress(base64.b64decode(payload, validate=True))
+    except (binascii.Error, OSError, EOFError) as e:
+        raise ValueError(f"broken probe output frame: {e}") from None
+    return data.decode("utf-8", "replace").lstrip("\ufeff"), True
+
+
+def extract_json(text: str):
+    """The JSON object/array a probe printed, ignoring log lines around it;
+    None if there is none."""
+    text = text.strip().lstrip("\ufeff").replace("\x00", "")
+    if not text:
+        return None
+    try:
+        return json.loads(text)
+    except ValueError:
+        pass
+    for line in reversed(text.splitlines()):
+        line = line.strip().lstrip("\ufeff")
+        if line[:1] in ("{", "["):
+            try:
+                return json.loads(line)
+            except ValueError:
+                pass
+    brace = text.find("{")
+    if brace != -1:
+        try:
+            return json.JSONDecoder().raw_decode(text, brace)[0]
+        except ValueError:
+            pass
+    return None
+
+
+class ProbeScript:
+    """A .ps1 probe on disk; re-read only when the file changes."""
+
+    def __init__(self, path: Path, compress: bool = True):
+        self.path = Path(path)
+        self.name = self.path.stem
+        self.compress = compress
+        self._stat: tuple | None = None
+        self._data = b""
+        self.hash = ""          # short, for the file name
+        self.digest = ""        # full SHA-256, checked on the agent before running
+
+    def _key(self) -> tuple:
+        st = self.path.stat()
+        return st.st_mtime_ns, st.st_size
+
+    def _text(self) -> str:
+        return self.path.read_text(encoding="utf-8-sig")
+
+    def load(self) -> bytes:
+        """Script bytes (UTF-8 with BOM, so Windows PowerShell 5 reads it as UTF-8)."""
+        key = self._key()
+        if key != self._stat:
+            self._data = b"\xef\xbb\xbf" + self._text().encode("utf-8")
+            self.digest = hashlib.sha256(self._data).hexdigest()
+            self.hash = self.digest[:12]
+            self._stat = key
+        return self._data
+
+    def _file(self) -> str:
+        return f"{PROBE_DIR}\\{self.name}-{self.hash}.ps1"
+
+    @staticmethod
+    def _args(params: dict | None) -> str:
+        parts = []
+        for k, v in (params or {}).items():
+            if not _PARAM_NAME.match(k):
+                raise ValueError(f"bad probe parameter name: {k!r}")
+            parts.append(f"-{k} {ps_quote(v)}")
+        return " ".join(parts)
+
+    def _call(self, params: dict | None) -> str:
+        # runs the script bytes in $b (skipping the BOM)
+        run = f"& ([scriptblock]::Create([Text.Encoding]::UTF8.GetString($b, 3, $b.Length - 3))) {self._args(params)}".rstrip()
+        return _GZ_WRAP.format(cmd=run) if self.compress else run
+
+    def invoke(self, params: dict | None = None) -> str:
+        """Short command running the installed copy if its SHA-256 matches
+        (or printing PROBE_MISSING). The bytes that are checked are the ones run."""
+        self.load()
+        return (
+            f'$p="{self._file()}"; $b=$null; if (Test-Path $p) {{ $b=[IO.File]::ReadAllBytes($p) }}; '
+            f"if ($b -and ([BitConverter]::ToString([Security.Cryptography.SHA256]::Create().ComputeHash($b)) "
+            f"-replace '-', '') -eq '{self.digest}') {{ {self._call(params)} }} else {{ \"{PROBE_MISSING}\" }}"
+        )
+
+    def deploy(self, params: dict | None = None) -> str:
+        """Command that locks down PROBE_DIR, installs this version (replacing
+        any copy already there) and runs it. Stops if the ACL can't be set."""
+        data = self.load()
+        b64 = base64.b64encode(data).decode("ascii")
+        return (
+            f'$d="{PROBE_DIR}"; $p="{self._file()}"; '
+            f"New-Item -ItemType Directory -Force -Path $d | Out-Null; {_LOCK_DIR}; "
+            f"Get-ChildItem -Path $d -Filter '{self.name}-*.ps1' | Remove-Item -Force -ErrorAction SilentlyContinue; "
+            f"$b=[Convert]::FromBase64String('{b64}'); [IO.File]::WriteAllBytes($p, $b); "
+            f"{self._call(params)}"
+        )
+
+
+class ProbeBundle(ProbeScript):
+    """Probe scripts as named sections of one cached script; run with
+    params {"Sections": "hw,temp"} to pick sections (and optionally
+    "Known": "hw=<fingerprint>"). Files that don't exist are left out (see
+    available)."""
+
+    def __init__(self, sections: dict[str, Path], name: str = "probe_bundle", compress: bool = True):
+        super().__init__(Path(f"{name}.ps1"), compress)
+        self.sections = {k: Path(v) for k, v in sections.items()}
+
+    @property
+    def available(self) -> list[str]:
+        return [k for k, path in self.sections.items() if path.exists()]
+
+    def _key(self) -> tuple:
+        key = []
+        for k in self.available:
+            st = self.sections[k].stat()
+            key.append((k, st.st_mtime_ns, st.st_size))
+        return tuple(key)
+
+    def _text(self) -> str:
+        names = self.available
+        lines = [
+            f"# Probe bundle ({', '.join(names)}), generated by the bot from the probe scripts.",
+            f"param([string]$Sections = {ps_quote(','.join(names))}, [string]$Known = '')",
+            "$ProbeKnown = @{}",
+            "foreach ($__kv in ($Known -split ',')) {",
+            "    $__k, $__v = $__kv -split '=', 2",
+            "    if ($__v) { $ProbeKnown[$__k.Trim()] = $__v.Trim() }",
+            "}",
+            "$__src = @{}",
+        ]
+        for k in names:
+            # base64 so one section's syntax (e.g. PS7-only operators on PS5) can't break the others
+            b64 = base64.b64encode(self.sections[k].read_text(encoding="utf-8-sig").encode("utf-8")).decode("ascii")
+            lines.append(f"$__src[{ps_quote(k)}] = '{b64}'")
+        lines += [
+            "$__doc = [ordered]@{ v = 1; host = $env:COMPUTERNAME; sections = [ordered]@{} }",
+            "foreach ($__name in ($Sections -split ',')) {",
+            "    $__name = $__name.Trim()",
+            "    if (-not $__src.ContainsKey($__name)) { continue }",
+            "    $__sw = [Diagnostics.Stopwatch]::StartNew()",
+            "    try {",
+            "        $__code = [Text.Encoding]::UTF8.GetString([Convert]::FromBase64String($__src[$__name]))",
+            "        $__out = & ([scriptblock]::Create($__code)) | Out-String",
+            "        $__doc.sections[$__name] = [ordered]@{ ok = $true; ms = $__sw.ElapsedMilliseconds; out = $__out }",
+            "    } catch {",
+            "        $__doc.sections[$__name] = [ordered]@{ ok = $false; ms = $__sw.ElapsedMilliseconds; out = ''; error = \"$_\" }",
+            "    }",
+            "}",
+            f"'{BUNDLE_BEGIN}'",
+            "$__doc | ConvertTo-Json -Depth 4 -Compress",
+            f"'{BUNDLE_END}'",
+        ]
+        return "\r\n".join(lines) + "\r\n"
+
+
+def parse_bundle(out: str) -> dict[str, dict]:
+    """Sections of a ProbeBundle reply: name → {"ok", "ms", "out"[, "error"]}.
+    Raises ValueError if the output has no complete bundle frame."""
+    begin = out.find(BUNDLE_BEGIN)
+    end = out.find(BUNDLE_END, begin + 1)
+    if begin == -1 or end == -1:
+        raise ValueError("no probe bundle in output")
+    doc = json.loads(out[begin + len(BUNDLE_BEGIN):end].strip().lstrip("\ufeff"))
+    sections = doc.get("sections") if isinstance(doc, dict) else None
+    return sections if isinstance(sections, dict) else {}
+
+
+class ProbeRunner:
+    """Runs ProbeScripts on agents through run(node_id, command, timeout),
+    remembering which script version each agent has installed."""
+
+    def __init__(self, run: Callable[[str, str, float], Awaitable[str]]):
+        self._run = run
+        self.installed: dict[str, dict[str, str]] = {}   # node ID → script name → hash
+        self.stats = {"calls": 0, "deploys": 0, "misses": 0, "bytes_sent": 0, "bytes_full": 0,
+                      "framed": 0, "plain": 0, "bad_frames": 0, "no_json": 0,
+                      "bytes_received": 0, "bytes_output": 0}
+
+    async def run(self, node_id: str, script: ProbeScript, params: dict | None = None,
+                  timeout: float = 60) -> str:
+        """Output of script on the agent (unwrapped from its gzip frame).
+        Raises like run() does, and ValueError for a broken frame."""
+        return self._decode(await self._exec(node_id, script, params, timeout))
+
+    async def run_json(self, node_id: str, script: ProbeScript, params: dict | None = None,
+                       timeout: float = 60):
+        """extract_json() of the script's output; None if it printed none."""
+        obj = extract_json(await self.run(node_id, script, params, timeout))
+        if obj is None:
+            self.stats["no_json"] += 1
+        return obj
+
+    def _decode(self, out: str) -> str:
+        st = self.stats
+        st["bytes_received"] += len(out)
+        try:
+            text, framed = decode_output(out)
+        except ValueError:
+            st["bad_frames"] += 1
+            raise
+        st["framed" if framed else "plain"] += 1
+        st["bytes_output"] += len(text)
+        return text
+
+    async def _exec(self, node_id: str, script: ProbeScript, params: dict | None, timeout: float) -> str:
+        st = self.stats
+        st["calls"] += 1
+        known = self.installed.get(node_id, {}).get(script.name)
+        st["bytes_full"] += len(script.load())    # what sending the whole script would cost
+        # unknown agent: try the short call first, a miss costs one small round trip
+        if known is None or known == script.hash:
+            cmd = script.invoke(params)
+            st["bytes_sent"] += len(cmd)
+            out = await self._run(node_id, cmd, timeout)
+            if PROBE_MISSING not in out:
+                self.installed.setdefault(node_id, {})[script.name] = script.hash
+                return out
+            st["misses"] += 1
+        cmd = script.deploy(params)
+        st["bytes_sent"] += len(cmd)
+        st["deploys"] += 1
+        out = await self._run(node_id, cmd, timeout)
+        self.installed.setdefault(node_id, {})[script.name] = script.hash
+        log.info(f"probes: deployed {script.name}-{script.hash} to {node_id}")
+        return out
@@ -0,0 +1,249 @@
+"""
+Task scheduler for the bot's background jobs.
+
+One timer heap instead of a `while not _shutdown_event` loop per job. Jobs
+are plain async functions doing a single pass; the scheduler decides when
+they run:
+
+    Every(seconds, jitter)            fixed interval (+ random 0..jitter s)
+    Daily(hour, minute, weekday)      once a day / once a week, UTC; a slot
+                                      missed within catchup s (restart) runs late
+    None                              only when woken (wake / wake_on)
+
+A job never runs twice at once: a timer firing while the previous run is
+still going is skipped, a wake() during a run queues exactly one re-run.
+Jobs marked heavy (they talk to MeshCentral agents) share a global
+concurrency budget, so an interval burst can't stack up meshctrl/agent
+work. Errors are logged and counted; the job keeps its schedule.
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable
+
+log = logging.getLogger("mc-bot")
+
+SKIPPED_RETRY = 60      # s; a due Daily slot skipped because the job was still running
+
+
+class Every:
+    def __init__(self, seconds: float, jitter: float = 0):
+        self.seconds = seconds
+        self.jitter = jitter
+
+    def next(self, now: float) -> float:
+        return now + self.seconds + (random.uniform(0, self.jitter) if self.jitter else 0)
+
+    def __str__(self) -> str:
+        s = self.seconds
+        return f"каждые {s / 3600:g} ч" if s >= 3600 else f"каждые {s / 60:g} мин" if s >= 60 else f"каждые {s:g} с"
+
+
+class Daily:
+    """hour:minute UTC every day, or only on weekday (0 = Monday ... 6 = Sunday).
+
+    A slot missed by less than catchup seconds (the bot was restarted at
+    09:20 for a 09:00 job) still runs, right away, unless that day's run
+    already happened: `last` is the ISO date of the last run, and
+    on_fire(date) is called on every run so the caller can keep it across
+    restarts.
+    """
+
+    def __init__(self, hour: int, minute: int = 0, weekday: int | None = None, jitter: float = 0,
+                 catchup: float = 3600, last: str | None = None,
+                 on_fire: Callable[[str], None] | None = None):
+        self.hour = hour
+        self.minute = minute
+        self.weekday = weekday
+        self.jitter = jitter
+        self.catchup = catchup
+        self.last = last
+        self.on_fire = on_fire
+
+    def _slot(self, t: datetime) -> datetime:
+        return t.replace(hour=self.hour, minute=self.minute, second=0, microsecond=0)
+
+    def next(self, now: float) -> float:
+        t = datetime.fromtimestamp(now, timezone.utc)
+        at = self._slot(t)
+        if (at <= t < at + timedelta(seconds=self.catchup) and self.last != at.date().isoformat()
+                and (self.weekday is None or at.weekday() == self.weekday)):
+            return now
+        while at <= t or (self.weekday is not None and at.weekday() != self.weekday):
+            at += timedelta(days=1)
+        return at.timestamp() + (random.uniform(0, self.jitter) if self.jitter else 0)
+
+    def fired(self, now: float):
+        """The job is starting: its slot (the latest one at or before now) is done."""
+        t = datetime.fromtimestamp(now, timezone.utc)
+        at = self._slot(t)
+        if at > t:
+            at -= timedelta(days=1)
+        self.last = at.date().isoformat()
+        if self.on_fire is not None:
+            try:
+                self.on_fire(self.last)
+            except Exception as e:
+                log.error(f"scheduler: saving the last run of a {self} job: {e}")
+
+    def __str__(self) -> str:
+        days = ("пн", "вт", "ср", "чт", "пт", "сб", "вс")
+        when = f"{self.hour:02d}:{self.minute:02d} UTC"
+        return f"{days[self.weekday]} {when}" if self.weekday is not None else f"ежедневно {when}"
+
+
+class Job:
+    __slots__ = ("name", "fn", "trigger", "heavy", "next_run", "running", "rerun", "stats")
+
+    def __init__(self, name: str, fn: Callable[[], Awaitable], trigger, heavy: bool):
+        self.name = name
+        self.fn = fn
+        self.trigger = trigger
+        self.heavy = heavy
+        self.next_run = float("inf")
+        self.running = False
+        self.rerun = False
+        self.stats = {"runs": 0, "errors": 0, "skipped": 0, "last_run": 0.0,
+                      "last_ms": 0.0, "wait_ms": 0.0, "last_error": ""}
+
+
+class Scheduler:
+    def __init__(self, budget: int = 2):
+        self.budget = budget
+        self._budget = asyncio.Semaphore(budget)
+        self._jobs: dict[str, Job] = {}
+        self._heap: list[tuple[float, int, Job]] = []
+        self._seq = itertools.count()
+        self._changed = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._tasks: set[asyncio.Task] = set()     # running jobs and event watchers
+
+    # ── setup ──
+
+    def add(self, name: str, fn: Callable[[], Awaitable], trigger=None, *,
+            delay: float | None = None, heavy: bool = False) -> Job:
+        """Register a job. First run after delay seconds if given, else at the
+        trigger's first fire time (never, for trigger None, until woken)."""
+        job = self._jobs[name] = Job(name, fn, trigger, heavy)
+        now = time.time()
+        if delay is not None:
+            self._schedule(job, now + delay)
+        elif trigger is not None:
+            self._schedule(job, trigger.next(now))
+        return job
+
+    def wake(self, name: str, delay: float = 0):
+        """Run a job within delay seconds (an earlier planned run is kept).
+        Repeated wakes inside the window coalesce into one run."""
+        job = self._jobs[name]
+        if job.running:
+            job.rerun = True
+            return
+        self._schedule(job, min(job.next_run, time.time() + delay))
+
+    def wake_on(self, queue: asyncio.Queue, name: str, delay: float = 0,
+                collect: Callable[[list], None] | None = None):
+        """Wake job `name` whenever items arrive on queue; collect(batch) gets
+        the items first (e.g. to remember which devices to process)."""
+        async def watch():
+            while True:
+                batch = [await queue.get()]
+                while not queue.empty():
+                    batch.append(queue.get_nowait())
+                if collect is not None:
+                    collect(batch)
+                self.wake(name, delay)
+        self._spawn(watch())
+
+    @property
+    def jobs(self) -> list[Job]:
+        """All jobs, soonest first."""
+        return sorted(self._jobs.values(), key=lambda j: j.next_run)
+
+    # ── running ──
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        tasks = [t for t in (self._task, *self._tasks) if t is not None]
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None
+
+    def _spawn(self, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def _schedule(self, job: Job, at: float):
+        job.next_run = at
+        heapq.heappush(self._heap, (at, next(self._seq), job))
+        self._changed.set()
+
+    async def _run(self):
+        while True:
+            self._changed.clear()
+            now = time.time()
+            while self._heap and self._heap[0][0] <= now:
+                at, _, job = heapq.heappop(self._heap)
+                if at != job.next_run:
+                    continue      # superseded by a later _schedule
+                starts = not job.running
+                if starts and hasattr(job.trigger, "fired"):
+                    job.trigger.fired(now)      # only a run that starts uses up a Daily slot
+                job.next_run = job.trigger.next(now) if job.trigger is not None else float("inf")
+                if not starts and job.next_run <= now:
+                    job.next_run = now + SKIPPED_RETRY    # slot still due (catch-up): retry later
+                if job.next_run != float("inf"):
+                    heapq.heappush(self._heap, (job.next_run, next(self._seq), job))
+                if not starts:
+                    job.stats["skipped"] += 1
+                    continue
+                job.running = True
+                self._spawn(self._run_job(job))
+            timeout = self._heap[0][0] - now if self._heap else None
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _run_job(self, job: Job):
+        st = job.stats
+        try:
+            t0 = time.perf_counter()
+            if job.heavy:
+                async with self._budget:
+                    st["wait_ms"] = (time.perf_counter() - t0) * 1000
+                    await self._call(job)
+            else:
+                await self._call(job)
+        finally:
+            job.running = False
+            if job.rerun:
+                job.rerun = False
+                self.wake(job.name)
+
+    async def _call(self, job: Job):
+        st = job.stats
+        st["last_run"] = time.time()
+        t0 = time.perf_counter()
+        try:
+            await job.fn()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            st["errors"] += 1
+            st["last_error"] = str(e)[:200]
+            log.error(f"job {job.name}: {e}")
+        finally:
+            st["runs"] += 1
+            st["last_ms"] = (time.perf_counter() - t0) * 1000
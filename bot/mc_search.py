@@ -0,0 +1,189 @@
+"""
+Device search for /search.
+
+SearchIndex is built from one device refresh. For every searchable field it
+keeps the distinct lower-cased values, which devices carry each value, and a
+trigram → values posting list. A term is answered by intersecting the
+trigram postings of the term (over distinct values, not devices), verifying
+the few candidate values with a substring check, and unioning their
+devices. Results are ranked (exact > prefix > substring, weighted by field)
+and memoized per query, so paging through results never rescans.
+
+Query syntax: space-separated terms, all must match. A term may be scoped
+to a field: name:, ip:, os:, cpu:, sn:, group:, nic:, mac:, user:, sw:.
+Unscoped terms search name, IP, OS, CPU, serials, group, NICs and users.
+"""
+
+import re
+from collections import OrderedDict
+
+# field → (weight, scoped only)
+FIELDS = {
+    "name":  (8.0, False),
+    "ip":    (4.0, False),
+    "sn":    (4.0, False),
+    "mac":   (3.0, True),
+    "group": (2.0, False),
+    "user":  (2.0, False),
+    "nic":   (1.0, False),
+    "os":    (1.0, False),
+    "cpu":   (1.0, False),
+    "sw":    (1.0, True),
+}
+ALIASES = {
+    "host": "name", "serial": "sn", "grp": "group", "users": "user",
+    "soft": "sw", "software": "sw", "app": "sw",
+}
+DEFAULT_FIELDS = tuple(f for f, (_, scoped) in FIELDS.items() if not scoped)
+
+_EXACT, _PREFIX, _SUBSTR = 3.0, 2.0, 1.0
+_TOKEN_SPLIT = re.compile(r"[\s,;:()\[\]/\\]+")
+
+
+def _device_values(d) -> dict[str, list[str]]:
+    nic_ips = [ip for nic in d.nic_details for ip in nic["ips"]]
+    return {
+        "name": [d.name],
+        "ip": [d.ip, *nic_ips],
+        "sn": [d.board_sn, d.os_sn],
+        "mac": [nic["mac"] for nic in d.nic_details],
+        "group": [d.group],
+        "user": [str(u) for u in d.users],
+        "nic": list(d.nics),
+        "os": [d.os],
+        "cpu": [d.cpu],
+    }
+
+
+class _FieldIndex:
+    __slots__ = ("values", "docs", "tri", "_ids")
+
+    def __init__(self):
+        self.values: list[str] = []          # distinct lower-cased values
+        self.docs: list[list[int]] = []      # value id → device positions
+        self.tri: dict[str, set[int]] = {}   # trigram → value ids
+        self._ids: dict[str, int] = {}
+
+    def intern(self, value: str) -> int | None:
+        """Value id for value (registered on first sight); None for empty values."""
+        v = value.strip().lower()
+        if not v or v == "-":
+            return None
+        vid = self._ids.get(v)
+        if vid is None:
+            vid = self._ids[v] = len(self.values)
+            self.values.append(v)
+            self.docs.append([])
+            for i in range(len(v) - 2):
+                self.tri.setdefault(v[i:i + 3], set()).add(vid)
+        return vid
+
+    def add(self, value: str, doc: int):
+        vid = self.intern(value)
+        if vid is None:
+            return
+        docs = self.docs[vid]
+        if not docs or docs[-1] != doc:
+            docs.append(doc)
+
+    def match(self, term: str) -> dict[int, float]:
+        """device position → best match kind (_EXACT/_PREFIX/_SUBSTR) for term."""
+        if len(term) >= 3:
+            cand = None
+            for i in range(len(term) - 2):
+                post = self.tri.get(term[i:i + 3])
+                if not post:
+                    return {}
+                cand = set(post) if cand is None else cand & post
+                if not cand:
+                    return {}
+        else:
+            cand = range(len(self.values))
+        hits: dict[int, float] = {}
+        for vid in cand:
+            v = self.values[vid]
+            if term not in v:
+                continue
+            if v == term:
+                kind = _EXACT
+            elif v.startswith(term) or any(t.startswith(term) for t in _TOKEN_SPLIT.split(v)):
+                kind = _PREFIX
+            else:
+                kind = _SUBSTR
+            for doc in self.docs[vid]:
+                if hits.get(doc, 0) < kind:
+                    hits[doc] = kind
+        return hits
+
+
+class SearchIndex:
+    """Ranked search over one device refresh (see module docstring)."""
+
+    CACHE_SIZE = 64
+
+    def __init__(self, devices):
+        self.devices = tuple(devices)
+        self.fields = {f: _FieldIndex() for f in FIELDS}
+        sw = self.fields["sw"]
+        sw_vids: dict[int, tuple] = {}   # id(shared software tuple) → its value ids
+        for pos, d in enumerate(self.devices):
+            for field, values in _device_values(d).items():
+                fi = self.fields[field]
+                for v in values:
+                    if v:
+                        fi.add(v, pos)
+            # software tuples are shared between devices: normalize each one once
+            vids = sw_vids.get(id(d.software))
+            if vids is None:
+                vids = sw_vids[id(d.software)] = tuple(
+                    {vid for vid in map(sw.intern, (item.name for item in d.software)) if vid is not None})
+            for vid in vids:
+                sw.docs[vid].append(pos)
+        self._cache: OrderedDict[str, tuple] = OrderedDict()
+        self.stats = {"queries": 0, "cache_hits": 0}
+
+    @staticmethod
+    def parse(query: str) -> list[tuple[tuple[str, ...], str]]:
+        """'sw:chrome ip:10.0.' → [(("sw",), "chrome"), (("ip",), "10.0.")]"""
+        terms = []
+        for raw in query.lower().split():
+            field, sep, term = raw.partition(":")
+            field = ALIASES.get(field, field)
+            if sep and field in FIELDS and term:
+                terms.append(((field,), term))
+            else:
+                terms.append((DEFAULT_FIELDS, raw))
+        return terms
+
+    def search(self, query: str) -> tuple:
+        """Devices matching every term, best first (ties by name)."""
+        key = " ".join(query.lower().split())
+        self.stats["queries"] += 1
+        cached = self._cache.get(key)
+        if cached is not None:
+            self._cache.move_to_end(key)
+            self.stats["cache_hits"] += 1
+            return cached
+
+        scores: dict[int, float] | None = None
+        for fields, term in self.parse(key):
+            term_scores: dict[int, float] = {}
+            for field in fields:
+                weight = FIELDS[field][0]
+                for doc, kind in self.fields[field].match(term).items():
+                    s = kind * weight
+                    if term_scores.get(doc, 0) < s:
+                        term_scores[doc] = s
+            if scores is None:
+                scores = term_scores
+            else:
+                scores = {doc: s + term_scores[doc] for doc, s in scores.items() if doc in term_scores}
+            if not scores:
+                break
+        ranked = sorted((scores or {}).items(), key=lambda x: (-x[1], self.devices[x[0]].name))
+        result = tuple(self.devices[doc] for doc, _ in ranked)
+
+        self._cache[key] = result
+        if len(self._cache) > self.CACHE_SIZE:
+            self._cache.popitem(last=False)
+        return result
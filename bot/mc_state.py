@@ -0,0 +1,372 @@
+"""
+The bot's own state in one SQLite database (WAL mode).
+
+Used to be ~15 JSON files, each loaded and rewritten whole for every
+change. Now each domain is a table and writes touch only the rows that
+changed:
+
+  Keyed documents (DOC_TABLES): one row per key — usually a device or agent
+  name — holding the JSON of what used to be data[key] in the domain's file.
+  DocTable keeps the JSON text of every row in memory, so put_many() and
+  replace() skip unchanged rows without a read, and all()/get() don't touch
+  the disk.
+
+  Time series with real columns and (device, time) keys:
+    disk_history(device, day, volumes)    one row per device per day
+    snap_history(day, device, data)       one row per device per day
+
+  (The uptime table only passes uptime.json on to mc_uptime, which keeps
+  uptime now; see take_uptime().)
+
+WAL lets the readers (Telegram handlers) run while a job writes, and every
+batch of rows is one transaction. WriteBehind coalesces the polls' changes
+so a sweep over hundreds of devices is a few transactions, not hundreds. migrate_json() imports the old JSON files
+once (recorded in the meta table) and renames them to *.migrated.
+"""
+
+import json
+import logging
+import sqlite3
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+
+log = logging.getLogger("mc-bot")
+
+DOC_TABLES = ("hw_inventory", "temp_data", "snmp_data", "wifi_clients", "printers", "ink_alerts",
+              "alerts_sent", "mutes", "notes", "snapshots", "scheduler")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS uptime (
+    device TEXT NOT NULL, t INTEGER NOT NULL, online INTEGER NOT NULL,
+    PRIMARY KEY (device, t)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS uptime_t ON uptime (t);
+CREATE TABLE IF NOT EXISTS disk_history (
+    device TEXT NOT NULL, day TEXT NOT NULL, volumes TEXT NOT NULL,
+    PRIMARY KEY (device, day)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS disk_history_day ON disk_history (day);
+CREATE TABLE IF NOT EXISTS snap_history (
+    day TEXT NOT NULL, device TEXT NOT NULL, data TEXT NOT NULL,
+    PRIMARY KEY (day, device)) WITHOUT ROWID;
+"""
+_DOC_SCHEMA = """
+CREATE TABLE IF NOT EXISTS {t} (key TEXT PRIMARY KEY, data TEXT NOT NULL, updated REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS {t}_updated ON {t} (updated);
+"""
+
+
+def _dumps(value) -> str:
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+class DocTable:
+    """Rows of JSON documents by key; see the module docstring."""
+
+    def __init__(self, store: "StateStore", name: str):
+        self._store = store
+        self.name = name
+        self._rows: dict[str, str] | None = None    # key → JSON text, in insertion order
+
+    def _cached(self) -> dict[str, str]:
+        if self._rows is None:
+            cur = self._store.db.execute(f"SELECT key, data FROM {self.name} ORDER BY rowid")
+            self._rows = dict(cur.fetchall())
+        return self._rows
+
+    def all(self) -> dict:
+        return {k: json.loads(v) for k, v in self._cached().items()}
+
+    def get(self, key: str, default=None):
+        text = self._cached().get(str(key))
+        return json.loads(text) if text is not None else default
+
+    def keys(self) -> list[str]:
+        return list(self._cached())
+
+    def __len__(self) -> int:
+        return len(self._cached())
+
+    def put(self, key: str, value) -> bool:
+        return self.put_many({key: value}) > 0
+
+    def put_many(self, items: dict) -> int:
+        """Upsert the rows whose JSON changed; returns how many were written."""
+        rows = self._cached()
+        now = time.time()
+        changed = []
+        for key, value in items.items():
+            key, text = str(key), _dumps(value)
+            if rows.get(key) != text:
+                changed.append((key, text, now))
+        if changed:
+            with self._store.transaction() as db:
+                db.executemany(
+                    f"INSERT INTO {self.name} (key, data, updated) VALUES (?, ?, ?) "
+                    f"ON CONFLICT(key) DO UPDATE SET data = excluded.data, updated = excluded.updated",
+                    changed)
+            for key, text, _ in changed:
+                rows[key] = text
+            self._store.stats["rows"] += len(changed)
+        return len(changed)
+
+    def delete(self, *keys) -> int:
+        rows = self._cached()
+        gone = [str(k) for k in keys if str(k) in rows]
+        if gone:
+            with self._store.transaction() as db:
+                db.executemany(f"DELETE FROM {self.name} WHERE key = ?", [(k,) for k in gone])
+            for k in gone:
+                del rows[k]
+            self._store.stats["deletes"] += len(gone)
+        return len(gone)
+
+    def replace(self, items: dict) -> int:
+        """Make the table equal to items, touching only the differing rows."""
+        written = self.put_many(items)
+        keep = {str(k) for k in items}
+        return written + self.delete(*[k for k in self._cached() if k not in keep])
+
+
+class StateStore:
+    """The bot's SQLite database; opened on first use."""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._db: sqlite3.Connection | None = None
+        self._docs = {name: DocTable(self, name) for name in DOC_TABLES}
+        self._depth = 0
+        self.stats = {"transactions": 0, "rows": 0, "deletes": 0}
+        self.disk_version = 0   # bumped by disk_put(): cache key for what is computed from the history
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self._db is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            db = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("PRAGMA busy_timeout=5000")
+            db.executescript(_SCHEMA + "".join(_DOC_SCHEMA.format(t=t) for t in DOC_TABLES))
+            self._db = db
+        return self._db
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+            for doc in self._docs.values():
+                doc._rows = None
+
+    @contextmanager
+    def transaction(self):
+        """One write transaction (nested calls join the outer one)."""
+        db = self.db
+        if self._depth:
+            self._depth += 1
+            try:
+                yield db
+            finally:
+                self._depth -= 1
+            return
+        db.execute("BEGIN IMMEDIATE")
+        self._depth = 1
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        else:
+            db.execute("COMMIT")
+            self.stats["transactions"] += 1
+        finally:
+            self._depth = 0
+
+    def doc(self, name: str) -> DocTable:
+        return self._docs[name]
+
+    def meta_get(self, key: str, default: str | None = None) -> str | None:
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def meta_set(self, key: str, value: str):
+        with self.transaction() as db:
+            db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    # ── uptime (legacy) ──
+
+    def take_uptime(self) -> list[tuple[str, int, bool]]:
+        """Remove and return the (device, unix time, online) samples of the
+        uptime table. Uptime is kept by mc_uptime.UptimeStore now; the table
+        only holds what was imported from uptime.json before that."""
+        rows = self.db.execute("SELECT device, t, online FROM uptime ORDER BY t").fetchall()
+        if rows:
+            with self.transaction() as db:
+                db.execute("DELETE FROM uptime")
+            self.stats["deletes"] += len(rows)
+        return [(d, t, bool(on)) for d, t, on in rows]
+
+    # ── disk history ──
+
+    def disk_put(self, day: str, volumes: dict[str, dict], keep_days: int | None = None):
+        """Store day's volumes of each device ({device: volumes}); keep the last keep_days days per device."""
+        with self.transaction() as db:
+            db.executemany("INSERT OR REPLACE INTO disk_history (device, day, volumes) VALUES (?, ?, ?)",
+                           [(dev, day, _dumps(v)) for dev, v in volumes.items()])
+            if keep_days:
+                db.execute(
+                    "DELETE FROM disk_history WHERE day NOT IN ("
+                    "SELECT day FROM disk_history h WHERE h.device = disk_history.device "
+                    "ORDER BY day DESC LIMIT ?)", (keep_days,))
+        self.stats["rows"] += len(volumes)
+        self.disk_version += 1
+
+    def disk_history(self) -> dict[str, list[dict]]:
+        """{device: [{"date", "volumes"}, ...]} oldest day first (the old disk_history.json shape)."""
+        hist: dict[str, list[dict]] = {}
+        for dev, day, vols in self.db.execute(
+                "SELECT device, day, volumes FROM disk_history ORDER BY device, day"):
+            hist.setdefault(dev, []).append({"date": day, "volumes": json.loads(vols)})
+        return hist
+
+    # ── snapshot history ──
+
+    def snap_put(self, day: str, snaps: dict[str, dict], keep_days: int | None = None):
+        with self.transaction() as db:
+            db.execute("DELETE FROM snap_history WHERE day = ?", (day,))
+            db.executemany("INSERT INTO snap_history (day, device, data) VALUES (?, ?, ?)",
+                           [(day, dev, _dumps(s)) for dev, s in snaps.items()])
+            if keep_days:
+                db.execute("DELETE FROM snap_history WHERE day NOT IN ("
+                           "SELECT DISTINCT day FROM snap_history ORDER BY day DESC LIMIT ?)", (keep_days,))
+        self.stats["rows"] += len(snaps)
+
+    def snap_days(self) -> list[str]:
+        return [r[0] for r in self.db.execute("SELECT DISTINCT day FROM snap_history ORDER BY day")]
+
+    def snap_day(self, day: str) -> dict[str, dict]:
+        return {dev: json.loads(data) for dev, data in self.db.execute(
+            "SELECT device, data FROM snap_history WHERE day = ?", (day,))}
+
+    # ── migration ──
+
+    def migrate_json(self, files: dict[str, Path]):
+        """One-shot import of the old JSON files: {domain: path}, domain being
+        a DOC_TABLES name, "uptime", "disk_history" or "snap_history"."""
+        for domain, path in files.items():
+            path = Path(path)
+            done = self.db.execute("SELECT 1 FROM meta WHERE key = ?", (f"migrated:{domain}",)).fetchone()
+            if done or not path.exists():
+                continue
+            try:
+                data = json.loads(path.read_text(encoding="utf-8") or "null")
+                with self.transaction() as db:
+                    n = self._import(domain, data)
+                    db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                               (f"migrated:{domain}", str(path)))
+            except Exception as e:
+                log.error(f"state: migrating {path.name} failed, keeping the file: {e}")
+                if domain in self._docs:
+                    self._docs[domain]._rows = None    # cache may hold rolled-back rows
+                continue
+            path.rename(path.with_name(path.name + ".migrated"))
+            log.info(f"state: migrated {path.name} → {domain} ({n} rows)")
+
+    def _import(self, domain: str, data) -> int:
+        if not data:
+            return 0
+        if domain == "uptime":
+            rows = []
+            for dev, records in data.items():
+                for r in records:
+                    try:
+                        t = datetime.fromisoformat(r["t"])
+                    except (KeyError, TypeError, ValueError):
+                        continue
+                    if t.tzinfo is None:
+                        t = t.replace(tzinfo=timezone.utc)
+                    rows.append((dev, int(t.timestamp()), int(bool(r.get("on")))))
+            self.db.executemany("INSERT OR REPLACE INTO uptime (device, t, online) VALUES (?, ?, ?)", rows)
+            return len(rows)
+        if domain == "disk_history":
+            n = 0
+            for dev, entries in data.items():
+                for e in entries:
+                    if e.get("date"):
+                        self.disk_put(e["date"], {dev: e.get("volumes") or {}})
+                        n += 1
+            return n
+        if domain == "snap_history":
+            for day, snaps in data.items():
+                self.snap_put(day, snaps or {})
+            return sum(len(s or {}) for s in data.values())
+        if domain == "scheduler" and isinstance(data, list):
+            data = {str(t.get("id", i)): t for i, t in enumerate(data)}
+        return self._docs[domain].put_many(data)
+
+
+class WriteBehind:
+    """Debounced writes of the bot's in-memory dicts into doc tables.
+
+    The polls mutate their dicts (_hw_inventory, _temp_data, ...) and call
+    mark(table, key, ...) instead of saving; flush() writes each marked
+    table at most once per interval — just the marked keys, or the whole
+    dict when mark() was given none — and flush(force=True) writes
+    everything pending (shutdown). A key that is no longer in the dict is
+    deleted.
+    """
+
+    def __init__(self, store: StateStore, interval: float = 30):
+        self.store = store
+        self.interval = interval
+        self._sources: dict = {}               # table → function returning its dict
+        self._dirty: dict[str, set[str] | None] = {}     # None = the whole dict
+        self._flushed_at: dict[str, float] = {}
+        self.stats = {"marks": 0, "flushes": 0, "rows": 0}
+
+    def bind(self, table: str, source):
+        """source() returns the current dict behind table (globals get reassigned)."""
+        self._sources[table] = source
+
+    def mark(self, table: str, *keys):
+        self.stats["marks"] += 1
+        if not keys:
+            self._dirty[table] = None
+        elif table not in self._dirty:
+            self._dirty[table] = {str(k) for k in keys}
+        elif self._dirty[table] is not None:
+            self._dirty[table].update(str(k) for k in keys)
+
+    def pending(self) -> int:
+        return len(self._dirty)
+
+    def flush(self, force: bool = False) -> int:
+        """Write the due tables in one transaction; returns rows written."""
+        now = time.monotonic()
+        due = [t for t in self._dirty
+               if force or now - self._flushed_at.get(t, 0) >= self.interval]
+        if not due:
+            return 0
+        rows = 0
+        try:
+            with self.store.transaction():
+                for table in due:
+                    keys = self._dirty[table]
+                    data = {str(k): v for k, v in self._sources[table]().items()}
+                    doc = self.store.doc(table)
+                    if keys is None:
+                        rows += doc.replace(data)
+                    else:
+                        rows += doc.put_many({k: data[k] for k in keys if k in data})
+                        rows += doc.delete(*[k for k in keys if k not in data])
+        except Exception:
+            for table in due:
+                self.store.doc(table)._rows = None   # cache may hold rolled-back rows
+            raise                                     # still marked: retried next flush
+        for table in due:
+            del self._dirty[table]
+            self._flushed_at[table] = now
+        self.stats["flushes"] += 1
+        self.stats["rows"] += rows
+        return rows
@@ -0,0 +1,192 @@
+"""
+Temperature history and alert state.
+
+TempHistory keeps every device's readings per sensor as a compact time
+series in memory (epoch seconds in array('l'), tenths of a degree in
+array('h')) for `retention` seconds. On disk it is an append-only JSON-lines
+file, one line per device reading:
+
+    {"d": "PC-1", "t": 1700000000, "s": {"CPU": 52.5, "load": 12}}
+
+flush() appends what was added since the last flush; compact() rewrites
+the file without expired samples once it holds about twice what is live.
+
+alert_step() is the hysteresis/cooldown rule for the over-temperature
+alert: it fires when a device crosses the threshold, clears only after the
+temperature drops `hysteresis` degrees below it, and is not repeated for a
+device that stays hot (or flaps around the threshold) within `cooldown`.
+"""
+
+import bisect
+import json
+import logging
+import os
+import time
+from array import array
+from pathlib import Path
+
+log = logging.getLogger("mc-bot")
+
+SPARK = "▁▂▃▄▅▆▇█"
+
+HOT = "hot"          # crossed the threshold
+STILL_HOT = "still"  # still above it after the cooldown (reminder)
+COOL = "cool"        # back below threshold − hysteresis
+
+
+def sparkline(values, width: int = 24, lo: float | None = None, hi: float | None = None) -> str:
+    """Unicode block sparkline of values, averaged down to at most width points."""
+    values = list(values)
+    if not values:
+        return ""
+    if len(values) > width:
+        step = len(values) / width
+        values = [sum(chunk) / len(chunk)
+                  for chunk in (values[int(i * step):int((i + 1) * step)] for i in range(width)) if chunk]
+    lo = min(values) if lo is None else lo
+    hi = max(values) if hi is None else hi
+    if hi - lo < 1e-9:
+        return SPARK[len(SPARK) // 2] * len(values)
+    top = len(SPARK) - 1
+    return "".join(SPARK[max(0, min(top, round((v - lo) / (hi - lo) * top)))] for v in values)
+
+
+def alert_step(state: dict | None, temp: float, now: float, warn: float,
+               hysteresis: float = 5, cooldown: float = 6 * 3600) -> tuple[dict, str | None]:
+    """(new state, event) for a device's hottest reading. state is
+    {"hot": bool, "at": time of the last alert} as returned before (None at
+    first); event is HOT, STILL_HOT, COOL or None (nothing to send)."""
+    state = dict(state or {"hot": False, "at": 0})
+    if state["hot"]:
+        if temp <= warn - hysteresis:
+            state["hot"] = False
+            return state, COOL
+        if temp >= warn and now - state["at"] >= cooldown:
+            state["at"] = now
+            return state, STILL_HOT
+        return state, None
+    if temp >= warn:
+        state["hot"] = True
+        if now - state["at"] >= cooldown:    # don't re-alert a device flapping around the threshold
+            state["at"] = now
+            return state, HOT
+    return state, None
+
+
+class TempSeries:
+    __slots__ = ("ts", "v")
+
+    def __init__(self):
+        self.ts = array("l")
+        self.v = array("h")     # tenths of a degree (load: tenths of a percent)
+
+    def add(self, ts: int, value: float):
+        self.ts.append(ts)
+        self.v.append(max(-32768, min(32767, round(value * 10))))
+
+    def since(self, t: float) -> list[tuple[int, float]]:
+        i = bisect.bisect_left(self.ts, t)
+        return [(self.ts[j], self.v[j] / 10) for j in range(i, len(self.ts))]
+
+    def trim(self, t: float) -> int:
+        """Drop samples older than t; returns how many were dropped."""
+        i = bisect.bisect_left(self.ts, t)
+        if i:
+            del self.ts[:i]
+            del self.v[:i]
+        return i
+
+    def __len__(self) -> int:
+        return len(self.ts)
+
+
+class TempHistory:
+    """Per-device, per-sensor temperature series; see the module docstring."""
+
+    def __init__(self, path: Path, retention: float = 7 * 86400):
+        self.path = Path(path)
+        self.retention = retention
+        self.series: dict[str, dict[str, TempSeries]] = {}
+        self._pending: list[str] = []
+        self._lines = 0         # lines in the file
+        self._samples = 0       # device readings held in memory
+
+    def load(self):
+        self.series.clear()
+        self._lines = self._samples = 0
+        cutoff = time.time() - self.retention
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    self._lines += 1
+                    try:
+                        rec = json.loads(line)
+                        if rec["t"] >= cutoff:
+                            self._add(rec["d"], int(rec["t"]), rec["s"])
+                    except (ValueError, KeyError, TypeError):
+                        continue
+        except FileNotFoundError:
+            pass
+        log.info(f"temp history: {self._samples} readings of {len(self.series)} devices")
+
+    def _add(self, device: str, ts: int, readings: dict):
+        sensors = self.series.setdefault(device, {})
+        for name, value in readings.items():
+            if isinstance(value, (int, float)):
+                sensors.setdefault(name, TempSeries()).add(ts, value)
+        self._samples += 1
+
+    def add(self, device: str, readings: dict[str, float], ts: float | None = None):
+        """Record one reading of a device: {sensor: value}."""
+        ts = int(time.time() if ts is None else ts)
+        self._add(device, ts, readings)
+        self._pending.append(json.dumps({"d": device, "t": ts, "s": readings},
+                                        ensure_ascii=False, separators=(",", ":")))
+
+    def get(self, device: str, sensor: str, since: float = 0) -> list[tuple[int, float]]:
+        s = self.series.get(device, {}).get(sensor)
+        return s.since(since) if s else []
+
+    def sensors(self, device: str) -> list[str]:
+        return list(self.series.get(device, {}))
+
+    def flush(self):
+        """Append new readings to the file (compacting it when mostly expired)."""
+        if self._pending:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write("\n".join(self._pending) + "\n")
+            self._lines += len(self._pending)
+            self._pending.clear()
+        self.expire()
+        if self._lines > 2 * self._samples + 1000:
+            self.compact()
+
+    def expire(self):
+        cutoff = time.time() - self.retention
+        for device in list(self.series):
+            sensors = self.series[device]
+            dropped = 0
+            for name in list(sensors):
+                dropped = max(dropped, sensors[name].trim(cutoff))
+                if not sensors[name]:
+                    del sensors[name]
+            self._samples -= dropped
+            if not sensors:
+                del self.series[device]
+
+    def compact(self):
+        """Rewrite the file with only the live readings."""
+        rows: dict[tuple[str, int], dict] = {}
+        for device, sensors in self.series.items():
+            for name, s in sensors.items():
+                for ts, v in zip(s.ts, s.v):
+                    rows.setdefault((device, ts), {})[name] = v / 10
+        tmp = self.path.with_suffix(".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            for (device, ts), readings in sorted(rows.items(), key=lambda kv: kv[0][1]):
+                f.write(json.dumps({"d": device, "t": ts, "s": readings},
+                                   ensure_ascii=False, separators=(",", ":")) + "\n")
+        os.replace(tmp, self.path)
+        self._lines = self._samples = len(rows)
+        log.info(f"temp history: compacted to {len(rows)} readings")
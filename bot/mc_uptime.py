@@ -0,0 +1,269 @@
+"""
+Device uptime as run-length encoded online/offline runs.
+
+Every device check (45 s) gives each device one online/offline sample;
+nearly all of them repeat the previous state. Instead of storing every
+sample, a device's history is a list of runs — (start, end, online), epoch
+seconds — and a sample either moves the end of the device's last run or, when
+the state changed or samples were missed for more than `gap` seconds (bot
+down), starts a new run.
+
+On disk (uptime.bin, memory-mapped) that is a 16-byte header and fixed
+16-byte records:
+
+    header  b"MCUPTIME", record count (u32), reserved (u32)
+    record  device index (u32), start (u32), end (u32), online (u8), padding
+
+so extending a run is one 4-byte write into the map and a new run is one
+appended record: a tick costs O(devices) whatever the history length. Device
+names are appended to uptime.names, one per line; the line number is the
+device index. Runs that ended more than `keep` seconds ago are dropped from
+memory, and the file is rewritten without them once they are most of it.
+"""
+
+import bisect
+import logging
+import mmap
+import os
+import struct
+import time
+from array import array
+from pathlib import Path
+
+log = logging.getLogger("mc-bot")
+
+_MAGIC = b"MCUPTIME"
+_HEADER = struct.Struct("<8sII")
+_RECORD = struct.Struct("<IIIB3x")
+_END_OFFSET = 8                     # of the end field in a record
+_GROW = 64 * 1024
+
+
+class DeviceRuns:
+    __slots__ = ("start", "end", "online", "rec")
+
+    def __init__(self):
+        self.start = array("L")
+        self.end = array("L")
+        self.online = bytearray()
+        self.rec = -1               # file record of the last run
+
+    def __len__(self) -> int:
+        return len(self.start)
+
+    def trim(self, t: float) -> int:
+        """Drop the runs that ended before t; returns how many were dropped."""
+        i = bisect.bisect_left(self.end, t)
+        if i:
+            del self.start[:i]
+            del self.end[:i]
+            del self.online[:i]
+        return i
+
+
+class UptimeStore:
+    """Per-device online/offline runs; see the module docstring."""
+
+    def __init__(self, path: Path, keep: float = 7 * 86400, gap: float = 180, step: float = 45):
+        self.path = Path(path)
+        self.names_path = self.path.with_suffix(".names")
+        self.keep = keep
+        self.gap = gap              # longer without samples = no data
+        self.step = step            # how long one sample counts for
+        self.devices: dict[str, DeviceRuns] = {}
+        self._index: dict[str, int] = {}
+        self._names: list[str] = []
+        self._file = None
+        self._map: mmap.mmap | None = None
+        self._count = 0             # records in the file
+        self._live = 0              # runs in memory
+        self._expired_at = 0.0
+        self.stats = {"samples": 0, "extended": 0, "appended": 0, "compactions": 0}
+
+    # ── file ──
+
+    def load(self):
+        self.close()
+        self.devices.clear()
+        self._index.clear()
+        self._names = []
+        self._live = 0
+        try:
+            self._names = self.names_path.read_text(encoding="utf-8").splitlines()
+        except FileNotFoundError:
+            pass
+        self._index = {n: i for i, n in enumerate(self._names)}
+        self._open()
+        magic, count, _ = _HEADER.unpack_from(self._map, 0)
+        if magic != _MAGIC:
+            log.error(f"uptime: {self.path.name} is not an uptime file, starting a new one")
+            self.close()
+            self.path.rename(self.path.with_name(self.path.name + ".bad"))
+            self._open()
+            count = 0
+        self._count = min(count, (len(self._map) - _HEADER.size) // _RECORD.size)
+        cutoff = time.time() - self.keep
+        for rec in range(self._count):
+            idx, start, end, online = _RECORD.unpack_from(self._map, _HEADER.size + rec * _RECORD.size)
+            if idx >= len(self._names):
+                continue
+            runs = self.devices.setdefault(self._names[idx], DeviceRuns())
+            runs.rec = rec
+            if end >= cutoff:
+                runs.start.append(start)
+                runs.end.append(end)
+                runs.online.append(online)
+                self._live += 1
+        log.info(f"uptime: {self._live} runs of {len(self.devices)} devices")
+
+    def _open(self):
+        new = not self.path.exists()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(self.path, "w+b" if new else "r+b")
+        if new:
+            self._file.write(_HEADER.pack(_MAGIC, 0, 0))
+            self._file.truncate(_GROW)
+            self._file.flush()
+        size = os.fstat(self._file.fileno()).st_size
+        if size < _HEADER.size:
+            self._file.truncate(_GROW)
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        if new:
+            self._count = 0
+
+    def _grow(self, records: int):
+        need = _HEADER.size + records * _RECORD.size
+        if need <= len(self._map):
+            return
+        size = max(need, len(self._map) * 2)
+        self._map.close()
+        self._file.truncate(size)
+        self._map = mmap.mmap(self._file.fileno(), 0)
+
+    def flush(self):
+        if self._map is not None:
+            self._map.flush()
+
+    def close(self):
+        if self._map is not None:
+            self._map.flush()
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _device_index(self, name: str) -> int:
+        idx = self._index.get(name)
+        if idx is None:
+            idx = self._index[name] = len(self._names)
+            self._names.append(name)
+            with open(self.names_path, "a", encoding="utf-8") as f:
+                f.write(name.replace("\n", " ") + "\n")
+        return idx
+
+    # ── writing ──
+
+    def record(self, samples: list[tuple[str, bool]], now: float | None = None):
+        """One check of all devices: [(device, online)] at now."""
+        if self._map is None:
+            self.load()
+        now = int(time.time() if now is None else now)
+        for name, online in samples:
+            self._add(name, now, bool(online))
+        self._header()
+        if now - self._expired_at >= 3600:
+            self.expire(now)
+
+    def _add(self, name: str, t: int, online: bool):
+        self.stats["samples"] += 1
+        runs = self.devices.get(name)
+        if runs is None:
+            runs = self.devices[name] = DeviceRuns()
+        if runs and runs.online[-1] == online and 0 <= t - runs.end[-1] <= self.gap:
+            runs.end[-1] = t
+            if runs.rec >= 0:
+                struct.pack_into("<I", self._map, _HEADER.size + runs.rec * _RECORD.size + _END_OFFSET, t)
+            self.stats["extended"] += 1
+            return
+        if runs and t < runs.end[-1]:
+            return                  # older than what we have
+        self._grow(self._count + 1)
+        _RECORD.pack_into(self._map, _HEADER.size + self._count * _RECORD.size,
+                          self._device_index(name), t, t, online)
+        runs.start.append(t)
+        runs.end.append(t)
+        runs.online.append(online)
+        runs.rec = self._count
+        self._count += 1
+        self._live += 1
+        self.stats["appended"] += 1
+
+    def _header(self):
+        _HEADER.pack_into(self._map, 0, _MAGIC, self._count, 0)
+
+    def import_samples(self, samples: list[tuple[str, int, bool]]) -> int:
+        """Add older (device, time, online) samples, e.g. from a previous format."""
+        if self._map is None:
+            self.load()
+        for name, t, online in sorted(samples, key=lambda s: s[1]):
+            self._add(name, int(t), bool(online))
+        self._header()
+        self.expire()
+        return len(samples)
+
+    def expire(self, now: float | None = None):
+        now = time.time() if now is None else now
+        self._expired_at = now
+        cutoff = now - self.keep
+        for runs in self.devices.values():
+            self._live -= runs.trim(cutoff)
+        if self._count > 2 * self._live + 10000:
+            self.compact()
+
+    def compact(self):
+        """Rewrite the file with only the runs in memory."""
+        tmp = self.path.with_suffix(".tmp")
+        rec = 0
+        with open(tmp, "wb") as f:
+            f.write(_HEADER.pack(_MAGIC, self._live, 0))
+            for name, runs in self.devices.items():
+                idx = self._device_index(name)
+                for start, end, online in zip(runs.start, runs.end, runs.online):
+                    f.write(_RECORD.pack(idx, start, end, online))
+                    rec += 1
+                runs.rec = rec - 1 if runs else -1
+        self.close()
+        os.replace(tmp, self.path)
+        self._open()
+        self._count = rec
+        self.stats["compactions"] += 1
+        log.info(f"uptime: compacted to {rec} runs")
+
+    # ── reading ──
+
+    def runs(self, device: str, since: float = 0) -> list[tuple[int, int, bool]]:
+        """(start, end, online) runs of a device that end at or after since, oldest first."""
+        if self._map is None:
+            self.load()
+        runs = self.devices.get(device)
+        if not runs:
+            return []
+        i = bisect.bisect_left(runs.end, since)
+        return [(runs.start[j], runs.end[j], bool(runs.online[j])) for j in range(i, len(runs))]
+
+    def online_seconds(self, device: str, since: float, bucket: int) -> dict[int, tuple[float, float]]:
+        """{bucket start: (seconds online, seconds with data)} in bucket-second
+        slots (aligned to the epoch) from since; each sample counts for step seconds."""
+        out: dict[int, list[float]] = {}
+        for start, end, online in self.runs(device, since):
+            a, b = max(start, since), end + self.step
+            while a < b:
+                slot = int(a // bucket * bucket)
+                part = min(b, slot + bucket) - a
+                acc = out.setdefault(slot, [0.0, 0.0])
+                acc[1] += part
+                if online:
+                    acc[0] += part
+                a += part
+        return {k: (v[0], v[1]) for k, v in out.items()}
@@ -1,10 +1,10 @@
 # snmp_probe.ps1 — Minimal SNMP v1 GET probe for local router
 # Runs via MeshCentral RunCommand on a Windows PC in the target LAN.
-# Placeholders replaced by bot before execution.
+# The bot passes the community string as -Community.
 
 param(
     [string]$RouterIP  = "",
-    [string]$Community = "SNMP_COMMUNITY_PLACEHOLDER"
+    [string]$Community = "public"
 )
 
 # ── Auto-detect default gateway ──────────────────────────────────────
@@ -15,7 +15,7 @@ if (-not $RouterIP) {
         if ($gw) { $RouterIP = $gw } else { throw "no route" }
     } catch {
         Write-Output ('{"error":"cannot detect gateway: ' + $_.Exception.Message + '"}')
-        exit 1
+        return
     }
 }
 
@@ -134,7 +134,7 @@ $ifOut3    = Get-SnmpV1 $RouterIP $Community "1.3.6.1.2.1.2.2.1.16.3"
 
 if ($null -eq $sysName -and $null -eq $sysDescr) {
     Write-Output ('{"error":"SNMP no response at ' + $RouterIP + ' (community=' + $Community + ')"}')
-    exit 0
+    return
 }
 
 # Uptime formatting
@@ -126,7 +126,7 @@ EOF
 python3 -m venv "$BOT_DIR/venv"
 "$BOT_DIR/venv/bin/pip" install -q --upgrade pip
 "$BOT_DIR/venv/bin/pip" install -q \
-    aiogram==3.25.0 aiohttp requests APScheduler pytz
+    aiogram==3.25.0 aiohttp requests APScheduler pytz cryptography
 
 # Инициализируем пустые JSON-файлы если их нет
 for f in keenetic_probes alerts_cfg mute scripts; do
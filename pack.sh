@@ -19,7 +19,7 @@ info "Копирую файлы бота..."
 BOT_SRC="/opt/meshcentral-bot"
 
 # Только нужные файлы (без venv, кешей, секретных данных)
-cp "$BOT_SRC/bot.py"              "$OUT/bot/"
+cp "$BOT_SRC/"*.py                "$OUT/bot/"
 cp "$BOT_SRC/keenetic_probe.ps1"  "$OUT/bot/" 2>/dev/null || true
 cp "$BOT_SRC/device_probe.ps1"    "$OUT/bot/" 2>/dev/null || true
 
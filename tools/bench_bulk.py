@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Group-command benchmark: the old fixed asyncio.Semaphore(5) fan-out vs
+BulkRunner (bot/mc_bulk.py) against the fake MeshCentral in
+fake_mc_server.py, with a hub that slows down past --capacity commands in
+flight and a share of agents that never answer.
+
+Usage:
+    python tools/bench_bulk.py --nodes 200 --latency 1 --capacity 40 --hang 0.02
+"""
+
+import argparse
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "bot"))
+
+from fake_mc_server import FakeMeshCentral, _serve  # noqa: E402
+from mc_bulk import OK, BulkRunner  # noqa: E402
+from mc_control import MCControlChannel  # noqa: E402
+
+
+async def semaphore5(ch, nodes, timeout) -> tuple[int, float]:
+    """What cmd_run_group did before BulkRunner."""
+    sem = asyncio.Semaphore(5)
+    ok = 0
+
+    async def run_one(d):
+        nonlocal ok
+        async with sem:
+            try:
+                await ch.run_command(d["id"], "hostname", timeout=timeout)
+                ok += 1
+            except Exception:
+                pass
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*[run_one(d) for d in nodes])
+    return ok, time.perf_counter() - t0
+
+
+async def bulk(ch, nodes, timeout, max_concurrency) -> tuple[int, float, dict]:
+    async def run(d, t):
+        return await ch.run_command(d["id"], "hostname", timeout=t)
+
+    runner = BulkRunner(max_concurrency=max_concurrency)
+    t0 = time.perf_counter()
+    results = await runner.run(nodes, run, timeout=timeout)
+    return sum(r.state == OK for r in results), time.perf_counter() - t0, runner.stats["last"]
+
+
+async def main_async(args):
+    fake = FakeMeshCentral(nodes=args.nodes, latency=args.latency, online_ratio=1.0,
+                           capacity=args.capacity, hang=args.hang)
+    runner = await _serve(fake, "127.0.0.1", args.port)
+    ch = MCControlChannel(f"ws://127.0.0.1:{args.port}", user="admin", password="x")
+    ch.start()
+    try:
+        assert await ch.wait_ready(5), "channel did not connect"
+        nodes = [{"id": nid, "name": n["name"]} for nid, n in fake.nodes.items()]
+        print(f"{len(nodes)} devices, agent reply {args.latency:g} s, hub capacity {args.capacity or '∞'}, "
+              f"{len(fake.hung)} hung agents, timeout {args.timeout:g} s")
+        ok, dt = await semaphore5(ch, nodes, args.timeout)
+        print(f"  Semaphore(5):  {dt:7.1f} s   ok {ok}")
+        ok, dt, last = await bulk(ch, nodes, args.timeout, args.max_concurrency)
+        print(f"  BulkRunner:    {dt:7.1f} s   ok {ok}   peak concurrency {last['peak']}, "
+              f"ended at {last['limit']}, timeouts {last['timeout']}")
+    finally:
+        await ch.close()
+        await runner.cleanup()
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--port", type=int, default=18444)
+    ap.add_argument("--nodes", type=int, default=200)
+    ap.add_argument("--latency", type=float, default=1.0, help="agent reply time, s")
+    ap.add_argument("--capacity", type=int, default=40, help="commands in flight before the hub slows down")
+    ap.add_argument("--hang", type=float, default=0.02, help="share of agents that never reply")
+    ap.add_argument("--timeout", type=float, default=10, help="per-device timeout, s")
+    ap.add_argument("--max-concurrency", type=int, default=32)
+    asyncio.run(main_async(ap.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Peak-memory benchmark: json.load of a MeshCentral --dbexport vs the
+streaming reader in bot/mc_db.py (load_export).
+
+Builds a synthetic export (nodes with sysinfo/ifinfo/lastconnect, plus the
+event/power/smbios rows the bot never reads), then measures each loader with
+tracemalloc in a fresh state.
+
+Usage:
+    python tools/bench_db_export.py --nodes 5000
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "bot"))
+
+from mc_db import MCRecordSet, load_export  # noqa: E402
+
+
+def _software(rnd: random.Random, n: int) -> list:
+    return [{"name": f"Package {rnd.randrange(3000)}", "version": f"{rnd.randrange(20)}.{rnd.randrange(100)}",
+             "publisher": f"Vendor {rnd.randrange(200)}", "installdate": "20240101"} for _ in range(n)]
+
+
+def write_export(path: str, nodes: int, groups: int = 8, seed: int = 1, installs: int = 0):
+    """installs > 0: nodes share that many distinct software inventories (imaged PCs)."""
+    rnd = random.Random(seed)
+    images = [_software(rnd, rnd.randrange(80, 200)) for _ in range(installs)]
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("[")
+        first = True
+
+        def row(doc):
+            nonlocal first
+            f.write(("" if first else ",\n") + json.dumps(doc))
+            first = False
+
+        for g in range(groups):
+            row({"_id": f"mesh//m{g}", "type": "mesh", "name": f"Office-{g}", "domain": ""})
+        for i in range(nodes):
+            key = f"n{i:05d}"
+            row({"_id": f"node//{key}", "type": "node", "meshid": f"mesh//m{i % groups}",
+                 "name": f"PC-{i:05d}", "host": f"pc{i}.local", "ip": f"10.0.{i // 250}.{i % 250}",
+                 "osdesc": "Windows 11 Pro", "agent": {"id": 4, "ver": 0}})
+            row({"_id": f"sinode//{key}", "type": "sysinfo", "hash": "x" * 64, "hardware": {
+                "windows": {
+                    "cpu": [{"Name": "Intel(R) Core(TM) i5-10400 CPU @ 2.90GHz"}],
+                    "memory": [{"Capacity": "8589934592", "Speed": 2666}] * 2,
+                    "drives": [{"Caption": "Samsung SSD 870", "Size": "500105249280"}],
+                    "osinfo": {"Caption": "Microsoft Windows 11 Pro", "Version": "10.0.22631"},
+                    "software": images[i % installs] if images else _software(rnd, rnd.randrange(80, 200)),
+                },
+                "identifiers": {"bios_serial": f"SN{i:08d}", "board_vendor": "ASUS"},
+            }})
+            row({"_id": f"ifnode//{key}", "type": "ifinfo", "netif2": {
+                "Ethernet": [{"address": f"10.0.{i // 250}.{i % 250}", "family": "IPv4",
+                              "mac": "00:11:22:33:44:55"}]}})
+            row({"_id": f"lcnode//{key}", "type": "lastconnect", "time": 1700000000000 + i, "addr": "1.2.3.4"})
+            # rows the bot never reads
+            row({"_id": f"smbios//{key}", "type": "smbios", "raw": "ab" * 400})
+            row({"_id": f"pw{i}", "type": "power", "nodeid": f"node//{key}", "power": 1,
+                 "time": "2024-01-01T00:00:00Z"})
+            for e in range(3):
+                row({"_id": f"ev{i}-{e}", "type": "event", "etype": "node", "nodeid": f"node//{key}",
+                     "msg": f"Agent connected {{\"x\": {e}}} \\ end", "time": 1700000000})
+        f.write("]")
+
+
+def load_json(path: str) -> MCRecordSet:
+    with open(path) as f:
+        data = json.load(f)
+    return MCRecordSet.from_rows(data)
+
+
+def measure(fn, path: str):
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    rs = fn(path)
+    dt = time.perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return rs, dt, peak
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--nodes", type=int, default=5000)
+    args = ap.parse_args()
+
+    fd, path = tempfile.mkstemp(suffix=".db.json")
+    os.close(fd)
+    try:
+        write_export(path, args.nodes)
+        size = os.path.getsize(path)
+        print(f"export: {args.nodes} nodes, {size / 1e6:.1f} MB")
+
+        stats: dict = {}
+        a, t_a, peak_a = measure(load_json, path)
+        b, t_b, peak_b = measure(lambda p: load_export(p, stats=stats), path)
+
+        for name in MCRecordSet.KINDS:
+            ta, tb = a._table(name), b._table(name)
+            assert ta == tb, f"{name}: loaders disagree"
+        print(f"json.load + index : peak {peak_a / 1e6:7.1f} MB  {t_a:6.2f} s")
+        print(f"load_export stream: peak {peak_b / 1e6:7.1f} MB  {t_b:6.2f} s  "
+              f"({stats['rows']} rows, {stats['skipped']} skipped unparsed)")
+        print(f"peak reduction    : {peak_a / peak_b:.1f}x, records {len(b)}")
+    finally:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
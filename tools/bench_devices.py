@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for bot/mc_devices.py on a synthetic fleet.
+
+1. Full rebuild vs incremental rebuild (DeviceCache). Each pass simulates a
+   typical refresh: a few nodes get new records (lastconnect updated) and a
+   few percent flip online/offline.
+2. Memory per device: the old 40-key frozen dict vs the slotted Device with
+   shared software inventories (tracemalloc, device list only).
+
+Usage:
+    python tools/bench_devices.py --nodes 2000 --passes 20
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "bot"))
+
+from bench_db_export import write_export  # noqa: E402
+from mc_db import load_export  # noqa: E402
+from mc_devices import DeviceCache, freeze  # noqa: E402
+
+
+def _as_old_dict(dev):
+    """The pre-Device representation: every field pre-formatted, own software list."""
+    return freeze(dev.as_dict())
+
+
+def measure_memory(rs, online: set):
+    n = len(rs.nodes)
+    devices = DeviceCache().devices(rs, online)
+    tracemalloc.start()
+    old = [_as_old_dict(d) for d in devices]
+    old_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del old, devices
+
+    tracemalloc.start()
+    new = DeviceCache().devices(rs, online)
+    new_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    assert len(new) == n
+    print(f"memory, dict per device : {old_bytes / n / 1024:7.1f} KiB/device  ({old_bytes / 1e6:.1f} MB)")
+    print(f"memory, slotted Device  : {new_bytes / n / 1024:7.1f} KiB/device  ({new_bytes / 1e6:.1f} MB)")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--nodes", type=int, default=2000)
+    ap.add_argument("--passes", type=int, default=20)
+    ap.add_argument("--changed", type=float, default=0.01, help="share of nodes with new records per pass")
+    ap.add_argument("--flips", type=float, default=0.03, help="share of nodes changing online state per pass")
+    ap.add_argument("--installs", type=int, default=40,
+                    help="distinct software inventories in the fleet (same image → same list)")
+    args = ap.parse_args()
+
+    fd, path = tempfile.mkstemp(suffix=".db.json")
+    os.close(fd)
+    try:
+        write_export(path, args.nodes, installs=args.installs)
+        rs = load_export(path)
+    finally:
+        os.remove(path)
+
+    rnd = random.Random(2)
+    ids = list(rs.nodes)
+    online = set(rnd.sample(ids, len(ids) * 4 // 5))
+    measure_memory(rs, online)
+
+    warm = DeviceCache()
+    reference = warm.devices(rs, online)
+
+    full_t = incr_t = 0.0
+    for p in range(args.passes):
+        for nid in rnd.sample(ids, max(1, int(len(ids) * args.changed))):
+            lc = dict(rs.lastconnect.get(nid, {}), time=1700000000000 + p)
+            rs.put({**lc, "_id": "lc" + nid, "type": "lastconnect"})
+        for nid in rnd.sample(ids, max(1, int(len(ids) * args.flips))):
+            online.symmetric_difference_update({nid})
+
+        t0 = time.perf_counter()
+        full = DeviceCache().devices(rs, online)
+        full_t += time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        incr = warm.devices(rs, online)
+        incr_t += time.perf_counter() - t0
+
+        assert [d["id"] for d in full] == [d["id"] for d in incr]
+        for a, b in zip(full, incr):    # offline_hours differs by the clock between the two calls
+            assert {**a, "offline_hours": 0} == {**b, "offline_hours": 0}, "incremental differs from full"
+    assert len(reference) == args.nodes
+
+    st = warm.stats
+    print(f"fleet: {args.nodes} nodes, {args.passes} passes, "
+          f"{args.changed:.0%} changed records + {args.flips:.0%} online flips per pass")
+    print(f"full rebuild       : {full_t / args.passes * 1000:7.1f} ms/pass")
+    print(f"incremental rebuild: {incr_t / args.passes * 1000:7.1f} ms/pass  "
+          f"(re-parsed {st['rebuilt'] - args.nodes}, reused {st['reused']})")
+    print(f"speed-up           : {full_t / incr_t:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
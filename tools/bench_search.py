@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Latency benchmark for /search: the old linear substring scan vs the
+SearchIndex in bot/mc_search.py, on a synthetic fleet.
+
+Usage:
+    python tools/bench_search.py --nodes 5000
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "bot"))
+
+from bench_db_export import write_export  # noqa: E402
+from mc_db import load_export  # noqa: E402
+from mc_devices import DeviceCache  # noqa: E402
+from mc_search import SearchIndex  # noqa: E402
+
+QUERIES = ["pc-0123", "10.0.1.", "windows", "sn0000", "office-3", "i5", "ivanov",
+           "ip:10.0.3.", "sw:package 12", "sw:package user:petrov", "zzz-nothing"]
+
+
+def linear_scan(devs, query: str) -> list:
+    """What cmd_search did before the index (one page flip = one full scan)."""
+    q = query.lower()
+    results = [d for d in devs if q in d["name"].lower() or q in d["ip"].lower()
+               or q in d["os"].lower() or q in d["cpu"].lower()
+               or q in d["board_sn"].lower() or q in d["os_sn"].lower()
+               or q in d["group"].lower()
+               or any(q in nic.lower() for nic in d["nics"])]
+    results.sort(key=lambda x: x["name"])
+    return results
+
+
+def timed(fn, repeat: int = 5) -> float:
+    runs = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        runs.append(time.perf_counter() - t0)
+    return statistics.median(runs) * 1000
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--nodes", type=int, default=5000)
+    args = ap.parse_args()
+
+    fd, path = tempfile.mkstemp(suffix=".db.json")
+    os.close(fd)
+    try:
+        write_export(path, args.nodes, installs=60)
+        rs = load_export(path)
+    finally:
+        os.remove(path)
+    rnd = random.Random(3)
+    surnames = ["ivanov", "petrov", "sidorova", "kuznetsov", "smirnova", "popov"]
+    for nid, n in list(rs.nodes.items()):
+        n["users"] = [f"OFFICE\\{rnd.choice(surnames)}{rnd.randrange(50)}"]
+    devs = DeviceCache().devices(rs, set())
+
+    t0 = time.perf_counter()
+    index = SearchIndex(devs)
+    build_ms = (time.perf_counter() - t0) * 1000
+    print(f"fleet: {len(devs)} devices; index build {build_ms:.0f} ms "
+          f"({sum(len(f.values) for f in index.fields.values())} distinct values)")
+    print(f"{'query':26s} {'hits':>5s} {'scan ms':>8s} {'index ms':>9s} {'cached ms':>10s}")
+    for q in QUERIES:
+        scan_ms = timed(lambda: linear_scan(devs, q)) if ":" not in q and " " not in q else float("nan")
+        cold = []
+        for _ in range(5):
+            index._cache.clear()
+            t0 = time.perf_counter()
+            hits = index.search(q)
+            cold.append(time.perf_counter() - t0)
+        cold_ms = statistics.median(cold) * 1000
+        cached_ms = timed(lambda: index.search(q))
+        if scan_ms == scan_ms:  # unscoped single terms: index must find everything the scan did
+            assert {d.id for d in linear_scan(devs, q)} <= {d.id for d in hits}, q
+        print(f"{q:26s} {len(hits):5d} {scan_ms:8.2f} {cold_ms:9.2f} {cached_ms:10.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+"""
+Fake MeshCentral control channel (control.ashx) for local development.
+
+Speaks the subset of the MeshCentral WebSocket protocol the bot uses:
+serverinfo/userinfo on connect, meshes, nodes, runcommands (with reply),
+poweraction and wakedevices, plus nodeconnect events when an agent goes
+online/offline (--churn flips random nodes). Lets the bot's control-channel
+client and push-based online tracking run without a real hub. --capacity
+makes replies slow down once more commands are in flight than the hub can
+take, --hang makes a share of the agents never answer.
+
+Usage:
+    python tools/fake_mc_server.py --port 8443 --nodes 200 --churn 5
+    python tools/fake_mc_server.py --check        # self-check of mc_control / mc_presence / mc_bulk
+
+Point the bot at it with MC_WSS=ws://127.0.0.1:8443.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from pathlib import Path
+
+from aiohttp import web, WSMsgType
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "bot"))
+
+
+class FakeMeshCentral:
+    def __init__(self, nodes: int = 50, groups: int = 4, latency: float = 0.05,
+                 online_ratio: float = 0.8, seed: int = 1, capacity: int = 0, hang: float = 0):
+        rnd = random.Random(seed)
+        self.latency = latency
+        self.capacity = capacity     # commands in flight before replies slow down (0 = unlimited)
+        self.inflight = 0
+        self.meshes = [{"_id": f"mesh//fake{g}", "name": f"Office-{g + 1}", "type": 2}
+                       for g in range(groups)]
+        self.nodes: dict[str, dict] = {}
+        for i in range(nodes):
+            mesh = self.meshes[i % groups]
+            nid = f"node//fake{i:05d}"
+            self.nodes[nid] = {
+                "_id": nid, "name": f"PC-{i:05d}", "meshid": mesh["_id"],
+                "conn": 1 if rnd.random() < online_ratio else 0, "pwr": 1,
+                "ip": f"10.{i // 250 % 250}.{i % 250}.1",
+            }
+        self.hung = {nid for nid in self.nodes if rnd.random() < hang}   # agents that never reply
+        self.sockets: set[web.WebSocketResponse] = set()
+        self.stats = {"connects": 0, "requests": 0}
+
+    # ── HTTP/WS ──
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/control.ashx", self.handle_control)
+        return app
+
+    async def handle_control(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse(max_msg_size=0)
+        await ws.prepare(request)
+        self.stats["connects"] += 1
+        self.sockets.add(ws)
+        await ws.send_json({"action": "serverinfo", "serverinfo": {"name": "fake-mc", "domain": ""}})
+        await ws.send_json({"action": "userinfo", "userinfo": {"_id": "user//admin", "name": "admin"}})
+        try:
+            async for msg in ws:
+                if msg.type != WSMsgType.TEXT:
+                    continue
+                try:
+                    cmd = json.loads(msg.data)
+                except ValueError:
+                    continue
+                self.stats["requests"] += 1
+                asyncio.create_task(self.handle_command(ws, cmd))
+        finally:
+            self.sockets.discard(ws)
+        return ws
+
+    async def handle_command(self, ws: web.WebSocketResponse, cmd: dict):
+        action = cmd.get("action")
+        rid = cmd.get("responseid")
+        if action == "meshes":
+            await self._send(ws, {"action": "meshes", "meshes": self.meshes, "responseid": rid})
+        elif action == "nodes":
+            by_mesh: dict[str, list] = {}
+            for n in self.nodes.values():
+                by_mesh.setdefault(n["meshid"], []).append(dict(n))
+            await self._send(ws, {"action": "nodes", "nodes": by_mesh, "responseid": rid})
+        elif action == "runcommands":
+            nid = (cmd.get("nodeids") or [""])[0]
+            node = self.nodes.get(nid)
+            if not node:
+                await self._send(ws, {"action": "runcommands", "result": "Invalid node id", "responseid": rid})
+                return
+            await self._send(ws, {"action": "runcommands", "result": "OK", "responseid": rid})
+            if not cmd.get("reply") or nid in self.hung:
+                return
+            self.inflight += 1
+            try:
+                load = self.inflight / self.capacity if self.capacity else 1
+                await asyncio.sleep(self.latency * random.uniform(0.5, 1.5) * max(1, load))
+            finally:
+                self.inflight -= 1
+            lang = "PS" if cmd.get("type") == 2 else "CMD"
+            await self._send(ws, {
+                "action": "runcommands", "nodeid": nid, "responseid": rid,
+                "result": f"{node['name']} [{lang}]: {cmd.get('cmds', '')}",
+            })
+        elif action in ("poweraction", "wakedevices"):
+            await self._send(ws, {"action": action, "result": "OK", "responseid": rid})
+        else:
+            await self._send(ws, {"action": action, "result": "Unknown action", "responseid": rid})
+
+    async def _send(self, ws: web.WebSocketResponse, msg: dict):
+        if not ws.closed:
+            await ws.send_str(json.dumps(msg))
+
+    async def set_conn(self, nid: str, conn: int):
+        """Change a node's connection state and push the event like MC does."""
+        self.nodes[nid]["conn"] = conn
+        await self.broadcast({"action": "event", "event": {
+            "etype": "node", "action": "nodeconnect", "nodeid": nid, "domain": "",
+            "conn": conn, "pwr": 1 if conn else 0, "nolog": 1}})
+
+    async def broadcast(self, msg: dict):
+        for ws in list(self.sockets):
+            await self._send(ws, msg)
+
+    async def churn(self, interval: float, seed: int = 2):
+        rnd = random.Random(seed)
+        ids = list(self.nodes)
+        while True:
+            await asyncio.sleep(interval)
+            nid = rnd.choice(ids)
+            await self.set_conn(nid, 0 if self.nodes[nid]["conn"] & 1 else 1)
+
+    async def drop_all(self):
+        """Close every client socket (simulates a hub restart)."""
+        for ws in list(self.sockets):
+            await ws.close()
+
+
+async def _serve(fake: FakeMeshCentral, host: str, port: int) -> web.AppRunner:
+    runner = web.AppRunner(fake.app())
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+async def check_presence(fake: FakeMeshCentral, ch):
+    """Push-based online tracking: event latency, reconnect, drift correction."""
+    from mc_presence import PresenceTracker
+
+    tracker = PresenceTracker(ch, reconcile_interval=600)
+    changes: asyncio.Queue = asyncio.Queue()
+    tracker.add_listener(lambda nid, online: changes.put_nowait((nid, online, time.perf_counter())))
+
+    async def reconcile():
+        token = tracker.begin()
+        devs = await ch.list_devices()
+        return tracker.reconcile({d["_id"] for d in devs if d.get("conn", 0) & 1}, token)
+
+    def expected() -> set:
+        return {nid for nid, n in fake.nodes.items() if n["conn"] & 1}
+
+    assert not tracker.live
+    await reconcile()
+    assert tracker.live and tracker.online == expected() and changes.empty()
+
+    ids = list(fake.nodes)
+    delays = []
+    for nid in ids[:20]:
+        t0 = time.perf_counter()
+        await fake.set_conn(nid, 0 if fake.nodes[nid]["conn"] & 1 else 1)
+        got, online, t1 = await asyncio.wait_for(changes.get(), 1)
+        assert got == nid and online == bool(fake.nodes[nid]["conn"] & 1)
+        delays.append(t1 - t0)
+    assert tracker.online == expected()
+    print(f"presence: 20 nodeconnect events, max {max(delays) * 1000:.1f} ms to listener")
+
+    # events lost while the channel is down: not live until the next reconcile fixes them
+    await fake.drop_all()
+    flipped = ids[20:25]
+    for nid in flipped:
+        fake.nodes[nid]["conn"] ^= 1
+    await asyncio.sleep(0.1)
+    assert await ch.wait_ready(10)
+    assert not tracker.live, "tracker trusted a new connection without a reconcile"
+    drift = await reconcile()
+    assert drift == len(flipped) and tracker.live and tracker.online == expected()
+    print(f"presence: reconnect → reconcile corrected {drift} node(s), stats={tracker.stats}")
+
+
+async def check_bulk(fake: FakeMeshCentral, ch):
+    """Bulk runs: every device answered once, hung agents time out, cancel stops the run."""
+    from mc_bulk import CANCELLED, OK, TIMEOUT, BulkRunner
+
+    async def run(d, timeout):
+        return await ch.run_command(d["id"], f"hostname {d['name']}", timeout=timeout)
+
+    nodes = [{"id": nid, "name": n["name"]} for nid, n in fake.nodes.items()]
+    fake.hung = set(list(fake.nodes)[:3])
+    bulk = BulkRunner(max_concurrency=16)
+    t0 = time.perf_counter()
+    results = await bulk.run(nodes, run, timeout=1)
+    dt = time.perf_counter() - t0
+    states = {r.device["name"]: r.state for r in results}
+    assert len(results) == len(nodes) == len(states), "device answered twice or not at all"
+    assert sum(s == TIMEOUT for s in states.values()) == 3, states
+    assert all(r.device["name"] in r.output for r in results if r.state == OK), "replies mixed up"
+    print(f"bulk: {len(nodes)} devices in {dt * 1000:.0f} ms, {bulk.stats['last']}")
+
+    fake.hung = set()
+    fake.latency, latency = 0.5, fake.latency
+    run_ = bulk.start(nodes, run, timeout=5)
+    await asyncio.sleep(0.2)
+    run_.cancel()
+    results = await run_.wait()
+    fake.latency = latency
+    assert len(results) == len(nodes) and all(r.state == CANCELLED for r in results), run_.counts()
+    print(f"bulk: cancel after 0.2 s → {run_.counts()}")
+
+
+async def run_check(args):
+    """Exercise bot/mc_control.py, mc_presence.py and mc_bulk.py against the fake server."""
+    from mc_control import MCControlChannel
+
+    fake = FakeMeshCentral(nodes=args.nodes, latency=args.latency)
+    runner = await _serve(fake, "127.0.0.1", args.port)
+    ch = MCControlChannel(f"ws://127.0.0.1:{args.port}", user="admin", password="x")
+    ch.start()
+    try:
+        assert await ch.wait_ready(5), "channel did not connect"
+        t0 = time.perf_counter()
+        devs = await ch.list_devices()
+        print(f"list_devices: {len(devs)} nodes in {(time.perf_counter() - t0) * 1000:.1f} ms")
+        assert len(devs) == args.nodes and all(d["groupname"] for d in devs)
+
+        ids = [d["_id"] for d in devs]
+        t0 = time.perf_counter()
+        outs = await asyncio.gather(*[ch.run_command(nid, f"hostname #{i}", powershell=i % 2 == 0)
+                                      for i, nid in enumerate(ids)])
+        dt = time.perf_counter() - t0
+        assert all(f"#{i}" in o for i, o in enumerate(outs)), "replies mixed up"
+        print(f"run_command: {len(outs)} concurrent in {dt * 1000:.0f} ms "
+              f"(latency {args.latency * 1000:.0f} ms each)")
+
+        print(f"power: {await ch.device_power(ids[0], 'reset')}")
+
+        await fake.drop_all()
+        await asyncio.sleep(0.1)
+        assert await ch.wait_ready(10), "channel did not reconnect"
+        out = await ch.run_command(ids[0], "after-reconnect")
+        assert "after-reconnect" in out
+        print(f"reconnect: ok (server connects={fake.stats['connects']}, client stats={ch.stats})")
+
+        await check_presence(fake, ch)
+        await check_bulk(fake, ch)
+        print("OK")
+    finally:
+        await ch.close()
+        await runner.cleanup()
+
+
+async def run_server(args):
+    fake = FakeMeshCentral(nodes=args.nodes, latency=args.latency, capacity=args.capacity, hang=args.hang)
+    await _serve(fake, args.host, args.port)
+    print(f"fake MeshCentral on ws://{args.host}:{args.port}/control.ashx ({args.nodes} nodes)")
+    if args.churn:
+        asyncio.ensure_future(fake.churn(args.churn))
+    while True:
+        await asyncio.sleep(3600)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8443)
+    ap.add_argument("--nodes", type=int, default=50)
+    ap.add_argument("--latency", type=float, default=0.05, help="simulated agent reply time, s")
+    ap.add_argument("--capacity", type=int, default=0,
+                    help="commands in flight before replies slow down proportionally (0 = unlimited)")
+    ap.add_argument("--hang", type=float, default=0, help="share of agents that never reply to commands")
+    ap.add_argument("--churn", type=float, default=0, help="flip a random node online/offline every N s")
+    ap.add_argument("--check", action="store_true", help="run the client self-check and exit")
+    args = ap.parse_args()
+    try:
+        asyncio.run(run_check(args) if args.check else run_server(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()